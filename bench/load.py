@@ -0,0 +1,260 @@
+"""Load generation and reporting.
+
+A Workload is a reproducible stream of lookup paths. The runners send it at
+a fixed concurrency (each worker sends its next request as soon as the last
+one completes) or at a fixed rate. In rate mode latency is measured from
+the moment a request was due rather than when it was sent, so a server that
+falls behind is not flattered by the load generator slowing down with it.
+"""
+import asyncio
+import http.client
+import json
+import random
+import subprocess
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+
+class Workload(object):
+    """Lookups for `names` distinct names under zone, with record types
+    picked from rdtypes. The same seed always gives the same sequence."""
+
+    def __init__(self, rdtypes=('A',), names=1000, zone='bench.test', seed=1):
+        self.rdtypes = list(rdtypes)
+        self.names = names
+        self.zone = zone
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+
+    def next_path(self):
+        with self.lock:
+            rdtype = self.random.choice(self.rdtypes)
+            name = self.random.randrange(self.names)
+        return '/%s/host%d.%s' % (rdtype, name, self.zone)
+
+
+class Recorder(object):
+    """Latencies and status codes of completed requests"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.statuses = Counter()
+
+    def record(self, latency, status):
+        with self.lock:
+            self.latencies.append(latency)
+            self.statuses[status] += 1
+
+
+class WsgiTarget(object):
+    """Calls a Flask app in-process, leaving out the HTTP server"""
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, path):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        return client.get(path).status_code
+
+
+class HttpTarget(object):
+    """Sends requests to a running server over keep-alive connections"""
+
+    def __init__(self, url, timeout=10.0):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def request(self, path):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = http.client.HTTPConnection(
+                self.host, self.port, timeout=self.timeout)
+        try:
+            conn.request('GET', self.prefix + path)
+            response = conn.getresponse()
+            response.read()
+            return response.status
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            self.local.conn = None
+            return 'error'
+
+
+class AsgiTarget(object):
+    """Calls an ASGI app in-process from the runner's event loop"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def request(self, path):
+        status = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+
+        scope = {'type': 'http', 'method': 'GET', 'path': path,
+                 'client': ('127.0.0.1', 0)}
+        await self.app(scope, receive, send)
+        return status[0]
+
+
+def run_threads(target, workload, concurrency, duration, rate=None):
+    """Drive a blocking target from concurrency threads for duration
+    seconds, at a fixed rate if one is given. Returns the Recorder and the
+    elapsed time."""
+    recorder = Recorder()
+    start = time.perf_counter()
+    deadline = start + duration
+    schedule = Schedule(start, rate)
+
+    def worker():
+        while True:
+            due = schedule.next()
+            if due >= deadline:
+                return
+            wait = due - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            t1 = due if rate else time.perf_counter()
+            try:
+                status = target.request(workload.next_path())
+            except Exception:
+                status = 'error'
+            recorder.record(time.perf_counter() - t1, status)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder, time.perf_counter() - start
+
+
+def run_async(target, workload, concurrency, duration, rate=None):
+    """The asyncio counterpart of run_threads, with concurrency tasks"""
+    recorder = Recorder()
+
+    async def main():
+        start = time.perf_counter()
+        deadline = start + duration
+        schedule = Schedule(start, rate)
+
+        async def worker():
+            while True:
+                due = schedule.next()
+                if due >= deadline:
+                    return
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                t1 = due if rate else time.perf_counter()
+                try:
+                    status = await target.request(workload.next_path())
+                except Exception:
+                    status = 'error'
+                recorder.record(time.perf_counter() - t1, status)
+
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        return time.perf_counter() - start
+
+    elapsed = asyncio.run(main())
+    return recorder, elapsed
+
+
+class Schedule(object):
+    """Hands out send times: now for closed-loop runs, every 1/rate seconds
+    from start for fixed-rate runs."""
+
+    def __init__(self, start, rate=None):
+        self.start = start
+        self.rate = rate
+        self.sent = 0
+        self.lock = threading.Lock()
+
+    def next(self):
+        if not self.rate:
+            return time.perf_counter()
+        with self.lock:
+            due = self.start + self.sent / float(self.rate)
+            self.sent += 1
+        return due
+
+
+def percentile(samples, pct):
+    """pct-th percentile of already sorted samples"""
+    if not samples:
+        return None
+    index = min(int(len(samples) * pct / 100.0), len(samples) - 1)
+    return samples[index]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_report(recorder, elapsed, settings, upstream=None):
+    """Summarize a run as a JSON-serializable dict"""
+    latencies = sorted(recorder.latencies)
+    count = len(latencies)
+
+    def ms(value):
+        if value is None:
+            return None
+        return round(value * 1000, 3)
+
+    return {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'settings': settings,
+        'requests': count,
+        'duration': round(elapsed, 3),
+        'qps': round(count / elapsed, 1) if elapsed else 0,
+        'status': dict((str(k), v) for k, v in recorder.statuses.items()),
+        'latency_ms': {
+            'mean': ms(sum(latencies) / count) if count else None,
+            'p50': ms(percentile(latencies, 50)),
+            'p95': ms(percentile(latencies, 95)),
+            'p99': ms(percentile(latencies, 99)),
+            'max': ms(latencies[-1]) if count else None
+        },
+        'upstream': upstream
+    }
+
+
+def compare(base, current):
+    """Relative change of throughput and latency between two reports"""
+    def change(old, new):
+        if not old or new is None:
+            return None
+        return round((new - old) / float(old) * 100, 1)
+
+    changes = {'qps': change(base['qps'], current['qps'])}
+    for key, value in current['latency_ms'].items():
+        changes['latency_ms.%s' % key] = change(base['latency_ms'].get(key),
+                                                value)
+    return changes
+
+
+def save_report(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
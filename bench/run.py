@@ -0,0 +1,105 @@
+"""Benchmark the lookup routes against a local stub nameserver.
+
+    python -m bench.run --concurrency 32 --duration 10 --output base.json
+    python -m bench.run --rate 2000 --loss 0.01 --compare base.json
+
+By default the Flask app runs in-process (--target wsgi). --target asgi runs
+the asyncio app instead, and --url benchmarks a server that is already
+running; point its RESOLVERS at the stub (see --stub-port) to count its
+upstream queries.
+"""
+import argparse
+import json
+import sys
+
+from bench.load import (Workload, WsgiTarget, AsgiTarget, HttpTarget,
+                        run_threads, run_async, make_report, compare,
+                        save_report)
+from bench.stub import StubNameserver
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--target', choices=('wsgi', 'asgi'), default='wsgi')
+    parser.add_argument('--url', help='benchmark a running server instead')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--rate', type=float,
+                        help='requests per second, default as fast as possible')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--warmup', type=float, default=1.0,
+                        help='seconds of load before measuring')
+    parser.add_argument('--rdtypes', default='A',
+                        help='comma separated record types to query')
+    parser.add_argument('--names', type=int, default=1000,
+                        help='distinct names, fewer means more cache hits')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-cache', action='store_true',
+                        help='disable the answer cache of in-process targets')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the stub waits before answering')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--loss', type=float, default=0.0,
+                        help='fraction of UDP queries the stub drops')
+    parser.add_argument('--truncate', type=float, default=0.0,
+                        help='fraction of UDP answers truncated, forcing TCP')
+    parser.add_argument('--answers', type=int, default=1,
+                        help='records in each answer')
+    parser.add_argument('--ttl', type=int, default=300)
+    parser.add_argument('--txt-size', type=int, default=32)
+    parser.add_argument('--stub-port', type=int, default=0)
+    parser.add_argument('--output', help='save the report to this file')
+    parser.add_argument('--compare', help='report to compare the run with')
+    return parser.parse_args(argv)
+
+
+def make_target(args, stub):
+    if args.url:
+        return HttpTarget(args.url)
+
+    from resolverapi import create_app, answer_cache, resolver_pool
+    app = create_app('prod')
+    app.config['RESOLVERS'] = [stub.host]
+    # Resolvers are created on first use, so they all pick up the stub
+    resolver_pool.port = stub.port
+    if args.no_cache:
+        answer_cache.configure(0)
+    if args.target == 'asgi':
+        from resolverapi.asgi import AsyncApp
+        return AsgiTarget(AsyncApp(app))
+    return WsgiTarget(app)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    stub = StubNameserver(args.latency, args.jitter, args.loss, args.truncate,
+                          args.answers, args.ttl, args.txt_size,
+                          port=args.stub_port, seed=args.seed)
+    target = make_target(args, stub)
+    run = run_async if isinstance(target, AsgiTarget) else run_threads
+
+    if args.warmup:
+        run(target, Workload(args.rdtypes.split(','), args.names,
+                             seed=args.seed + 1),
+            args.concurrency, args.warmup, args.rate)
+        stub.reset()
+    workload = Workload(args.rdtypes.split(','), args.names, seed=args.seed)
+    recorder, elapsed = run(target, workload, args.concurrency,
+                            args.duration, args.rate)
+    stub.close()
+
+    settings = dict(vars(args))
+    settings.pop('output')
+    settings.pop('compare')
+    report = make_report(recorder, elapsed, settings, stub.stats())
+    if args.compare:
+        with open(args.compare) as f:
+            report['change_percent'] = compare(json.load(f), report)
+    if args.output:
+        save_report(report, args.output)
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""Local nameserver for benchmarks, answering over UDP and TCP.
+
+Every name exists. Answers are made up from the question, with `answers`
+records per RRset and TXT strings of `txt_size` bytes, so response sizes are
+under control. Replies can be delayed by `latency` seconds (plus up to
+`jitter`), dropped with probability `loss`, and truncated over UDP with
+probability `truncate` to force a retry over TCP. UDP answers larger than
+the payload size the query advertises (512 bytes without EDNS0) are
+truncated, and those larger than `fragment_limit` bytes are lost, as when
+the fragments of large responses are dropped on the way.
+"""
+import errno
+import heapq
+import random
+import socket
+import struct
+import threading
+import time
+from collections import Counter
+
+import dns.message
+import dns.rrset
+from dns import flags, rdatatype
+
+
+def make_rrset(name, rdtype, count, ttl, txt_size):
+    if rdtype == rdatatype.AAAA:
+        rdatas = ['2001:db8::%x' % (i + 1) for i in range(count)]
+    elif rdtype == rdatatype.MX:
+        rdatas = ['%d mail%d.%s' % (10 * (i + 1), i, name) for i in range(count)]
+    elif rdtype in (rdatatype.NS, rdatatype.CNAME, rdatatype.PTR):
+        rdatas = ['host%d.%s' % (i, name) for i in range(count)]
+    elif rdtype == rdatatype.TXT:
+        # One TXT string holds at most 255 bytes
+        rdatas = []
+        for i in range(count):
+            text = ('%d' % i * txt_size)[:txt_size]
+            rdatas.append(' '.join('"%s"' % text[j:j + 255]
+                                   for j in range(0, len(text), 255)))
+    elif rdtype == rdatatype.SOA:
+        rdatas = ['ns.%s hostmaster.%s 1 7200 900 1209600 %d' % (name, name, ttl)]
+    else:
+        rdatas = ['10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255)
+                  for i in range(1, count + 1)]
+    return dns.rrset.from_text(name, ttl, 'IN', rdatatype.to_text(rdtype),
+                               *rdatas)
+
+
+def bind_pair(host, port, attempts=20):
+    """A listening TCP socket and a UDP socket on the same port. For port 0
+    the TCP socket picks a free port first, and another is tried when that
+    one is taken for UDP."""
+    for attempt in range(attempts):
+        tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            tcp.bind((host, port))
+            udp.bind(tcp.getsockname())
+        except OSError as e:
+            tcp.close()
+            udp.close()
+            if (port or e.errno != errno.EADDRINUSE or
+                    attempt == attempts - 1):
+                raise
+            continue
+        tcp.listen(128)
+        return tcp, udp
+
+
+class StubNameserver(object):
+
+    def __init__(self, latency=0.0, jitter=0.0, loss=0.0, truncate=0.0,
+                 answers=1, ttl=300, txt_size=32, host='127.0.0.1', port=0,
+                 seed=None, fragment_limit=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.truncate = truncate
+        self.answers = answers
+        self.ttl = ttl
+        self.txt_size = txt_size
+        self.fragment_limit = fragment_limit
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.queries = Counter()
+        self.dropped = 0
+        self.truncated = 0
+        self.tcp_queries = 0
+        self.tcp_connections = 0
+        self.running = True
+
+        self.tcp, self.udp = bind_pair(host, port)
+        self.address = self.udp.getsockname()
+        self.host, self.port = self.address
+
+        # Delayed UDP replies, sent in due order by one thread
+        self.pending = []
+        self.pending_ready = threading.Condition(self.lock)
+        for target in (self.serve_udp, self.serve_tcp, self.send_delayed):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def delay(self):
+        with self.lock:
+            return self.latency + self.random.random() * self.jitter
+
+    def respond(self, data, tcp=False):
+        """Response bytes for a query, or None to drop it"""
+        query = dns.message.from_wire(data)
+        question = query.question[0]
+        with self.lock:
+            self.queries[rdatatype.to_text(question.rdtype)] += 1
+            if tcp:
+                self.tcp_queries += 1
+            if not tcp and self.random.random() < self.loss:
+                self.dropped += 1
+                return None
+            truncated = not tcp and self.random.random() < self.truncate
+            if truncated:
+                self.truncated += 1
+        response = dns.message.make_response(query)
+        if truncated:
+            response.flags |= flags.TC
+        else:
+            response.answer.append(make_rrset(
+                question.name, question.rdtype, self.answers, self.ttl,
+                self.txt_size))
+        wire = response.to_wire(max_size=65535)
+        if tcp:
+            return wire
+        if len(wire) > (query.payload if query.edns >= 0 else 512):
+            with self.lock:
+                self.truncated += 1
+            response.answer = []
+            response.flags |= flags.TC
+            wire = response.to_wire()
+        elif self.fragment_limit and len(wire) > self.fragment_limit:
+            with self.lock:
+                self.dropped += 1
+            return None
+        return wire
+
+    def serve_udp(self):
+        while self.running:
+            try:
+                data, addr = self.udp.recvfrom(65535)
+            except OSError:
+                return
+            try:
+                response = self.respond(data)
+            except Exception:
+                continue
+            if response is None:
+                continue
+            delay = self.delay()
+            if delay <= 0:
+                try:
+                    self.udp.sendto(response, addr)
+                except OSError:
+                    return
+                continue
+            with self.pending_ready:
+                heapq.heappush(self.pending,
+                               (time.time() + delay, id(response), response,
+                                addr))
+                self.pending_ready.notify()
+
+    def send_delayed(self):
+        while self.running:
+            with self.pending_ready:
+                while self.running and not self.pending:
+                    self.pending_ready.wait()
+                if not self.running:
+                    return
+                due = self.pending[0][0]
+                now = time.time()
+                if due > now:
+                    self.pending_ready.wait(due - now)
+                    continue
+                _, _, response, addr = heapq.heappop(self.pending)
+            try:
+                self.udp.sendto(response, addr)
+            except OSError:
+                return
+
+    def serve_tcp(self):
+        while self.running:
+            try:
+                conn, _ = self.tcp.accept()
+            except OSError:
+                return
+            with self.lock:
+                self.tcp_connections += 1
+            thread = threading.Thread(target=self.handle_tcp, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def handle_tcp(self, conn):
+        with conn:
+            reader = conn.makefile('rb')
+            while True:
+                header = reader.read(2)
+                if len(header) != 2:
+                    return
+                data = reader.read(struct.unpack('!H', header)[0])
+                try:
+                    response = self.respond(data, tcp=True)
+                except Exception:
+                    return
+                time.sleep(self.delay())
+                conn.sendall(struct.pack('!H', len(response)) + response)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'queries': dict(self.queries),
+                'tcp_queries': self.tcp_queries,
+                'tcp_connections': self.tcp_connections,
+                'dropped': self.dropped,
+                'truncated': self.truncated
+            }
+
+    def reset(self):
+        with self.lock:
+            self.queries.clear()
+            self.dropped = self.truncated = self.tcp_queries = 0
+            self.tcp_connections = 0
+
+    def close(self):
+        self.running = False
+        with self.pending_ready:
+            self.pending_ready.notify()
+        self.udp.close()
+        self.tcp.close()
@@ -1,12 +1,39 @@
+import atexit
+import json
+import math
 import os
+import random
+import threading
+import time
 
-from flask import Flask, jsonify
+from flask import Flask, Response, current_app, g, jsonify, request
 from flask_restful import Api
-from dns.resolver import Resolver
 from flask_cors import CORS
 
+from resolverapi.util import parse_timeout
+from resolverapi.util.admission import Admission, queue_time
+from resolverapi.util.cache import AnswerCache
+from resolverapi.util.flight import SingleFlight, HostFlight
+from resolverapi.util.health import HealthTracker
+from resolverapi.util.metrics import metrics
+from resolverapi.util.timing import PhaseTimer, StackSampler
+from resolverapi.util.prefetch import Prefetcher
+from resolverapi.util.remote import MemoryTier, RedisTier
+from resolverapi.util.shmcache import SharedStore
+from resolverapi.util.snapshot import Snapshotter, open_snapshot
+from resolverapi.util.tcp import TcpPool
+from resolverapi.util.upstream import ResolverPool
 
-dns_resolver = Resolver()
+
+resolver_pool = ResolverPool()
+tcp_pool = TcpPool()
+answer_cache = AnswerCache()
+health_tracker = HealthTracker()
+single_flight = SingleFlight()
+prefetcher = Prefetcher()
+admission = Admission()
+snapshotter = Snapshotter()
+atexit.register(snapshotter.save_at_exit)
 
 
 def create_app(config_name):
@@ -19,21 +46,226 @@ def create_app(config_name):
     # Get nameservers from environment variable or default to OpenDNS resolvers
     if os.environ.get('RESOLVERS'):
         app.config['RESOLVERS'] = [addr.strip() for addr in os.environ.get('RESOLVERS').split(',')]
+    # Directory shared by the uwsgi workers to aggregate their metrics
+    if os.environ.get('METRICS_DIR'):
+        app.config['METRICS_DIR'] = os.environ.get('METRICS_DIR')
+    # File the answer cache is saved to, to start warm after a restart
+    if os.environ.get('SNAPSHOT_PATH'):
+        app.config['SNAPSHOT_PATH'] = os.environ.get('SNAPSHOT_PATH')
     # Respond with Access-Control-Allow-Origin headers. Use * to accept all
     if os.environ.get('CORS_ORIGIN'):
         CORS(app, origins=os.environ.get('CORS_ORIGIN'))
 
-    dns_resolver.lifetime = 3.0
+    tcp_pool.configure(app.config['TCP_POOL_SIZE'],
+                       app.config['TCP_IDLE_TIMEOUT'],
+                       app.config['TCP_MAX_PIPELINE'])
+    resolver_pool.configure(app.config['RESOLVER_LIFETIME'],
+                            app.config['RESOLVER_TIMEOUT'],
+                            app.config['RESOLVER_PORT'],
+                            app.config['ADAPTIVE_TIMEOUT'],
+                            app.config['ADAPTIVE_TIMEOUT_PERCENTILE'],
+                            app.config['RESOLVER_MIN_TIMEOUT'],
+                            tcp_pool if tcp_pool.enabled else None,
+                            app.config['TCP_RDTYPES'],
+                            app.config['EDNS_PAYLOAD'],
+                            app.config['EDNS_RETRY_INTERVAL'])
+    stale_window = 0
+    if app.config['SERVE_STALE']:
+        stale_window = app.config['STALE_WINDOW']
+    cache_store = None
+    if app.config['CACHE_BACKEND'] == 'shared' and app.config['CACHE_MAX_BYTES']:
+        cache_store = SharedStore(app.config['SHARED_CACHE_PATH'],
+                                  app.config['CACHE_MAX_BYTES'],
+                                  app.config['SHARED_CACHE_SLOT_SIZE'],
+                                  stale_window)
+    remote = None
+    if app.config['REMOTE_CACHE'] == 'redis':
+        remote = RedisTier(app.config['REMOTE_CACHE_HOST'],
+                           app.config['REMOTE_CACHE_PORT'],
+                           app.config['REMOTE_CACHE_TIMEOUT'],
+                           app.config['REMOTE_CACHE_BACKOFF'])
+    elif app.config['REMOTE_CACHE'] == 'memory':
+        remote = MemoryTier(app.config['REMOTE_CACHE_BACKOFF'])
+    snapshot_path, snapshot = None, None
+    if app.config['CACHE_MAX_BYTES'] and app.config['SNAPSHOT_PATH']:
+        snapshot_path = app.config['SNAPSHOT_PATH']
+        snapshot = open_snapshot(snapshot_path)
+    answer_cache.configure(app.config['CACHE_MAX_BYTES'],
+                           app.config['CACHE_NEGATIVE_TTL'], stale_window,
+                           cache_store, remote, snapshot)
+    snapshotter.configure(answer_cache, snapshot_path,
+                          app.config['SNAPSHOT_INTERVAL'])
+    health_tracker.configure(app.config['HEALTH_FAILURE_THRESHOLD'],
+                             app.config['HEALTH_BACKOFF'],
+                             app.config['HEALTH_MAX_BACKOFF'],
+                             resolver_pool.lifetime)
+    host_flight = None
+    if app.config['SINGLE_FLIGHT_DIR']:
+        host_flight = HostFlight(app.config['SINGLE_FLIGHT_DIR'])
+    single_flight.configure(app.config['SINGLE_FLIGHT'], host_flight)
+    prefetcher.configure(app.config['PREFETCH'],
+                         app.config['PREFETCH_FRACTION'],
+                         app.config['PREFETCH_MIN_RATE'],
+                         app.config['PREFETCH_MAX_QPS'])
+    admission.configure(app.config['MAX_UPSTREAM_IN_FLIGHT'],
+                        app.config['MAX_QUEUE_TIME'],
+                        app.config['CLIENT_RATE'],
+                        app.config['CLIENT_BURST'],
+                        app.config['CLIENT_RATE_MAX_CLIENTS'])
+    metrics.configure(app.config['METRICS_DIR'])
 
     from resolverapi.endpoints import ReverseLookup
+    from resolverapi.endpoints import ReverseSweep
     from resolverapi.endpoints import LookupRecordType
+    from resolverapi.endpoints import BatchLookup
+    from resolverapi.endpoints import DnsQuery
+    from resolverapi.endpoints import AllRecords
     api = Api(app)
     api.add_resource(ReverseLookup, '/reverse/<ip>')
+    api.add_resource(ReverseSweep, '/reverse/<ip>/<int:prefixlen>')
     api.add_resource(LookupRecordType, '/<rdtype>/<domain>')
+    api.add_resource(BatchLookup, '/batch')
+    api.add_resource(DnsQuery, '/dns-query')
+    api.add_resource(AllRecords, '/all/<domain>')
+
+    @app.before_request
+    def start_timer():
+        snapshotter.start()
+        g.timer = PhaseTimer()
+        rate = app.config['PROFILE_SAMPLE_RATE']
+        if rate and random.random() < rate:
+            g.sampler = StackSampler(threading.get_ident(),
+                                     app.config['PROFILE_INTERVAL']).start()
+
+    @app.before_request
+    def admit():
+        """Turn away clients over their rate limit before doing any work"""
+        g.queued = queue_time(request.headers.get('X-Request-Start'),
+                              time.time())
+        if request.endpoint == 'prometheus_metrics':
+            return None
+        wait = admission.admit_client(request.remote_addr)
+        if wait:
+            g.error_cause = 'rate_limited'
+            response = jsonify({'message': 'Too many requests.'})
+            response.status_code = 429
+            response.headers['Retry-After'] = '%d' % math.ceil(wait)
+            return response
+
+    @app.before_request
+    def start_deadline():
+        """Upstream queries stop once the client's timeout has passed,
+        counting from when the request arrived"""
+        g.deadline = None
+        value = request.args.get('timeout', request.headers.get('X-Timeout'))
+        if value is None:
+            return None
+        seconds = parse_timeout(value)
+        if seconds is None:
+            response = jsonify({'message': 'The provided timeout is invalid'})
+            response.status_code = 400
+            return response
+        g.deadline = time.time() - (g.queued or 0) + seconds
+
+    @app.after_request
+    def record_metrics(response):
+        timer = g.get('timer')
+        if timer is None:
+            return response
+        route, rdtype = request_labels()
+        record_response(route, rdtype, response.status_code,
+                        g.get('error_cause', ''), timer.elapsed())
+
+        details = None
+        if app.config['SERVER_TIMING']:
+            response.headers['Server-Timing'] = timer.header()
+            details = {}
+        sampler = g.pop('sampler', None)
+        if sampler is not None:
+            sampler.stop()
+            if timer.elapsed() >= app.config['PROFILE_SLOW_THRESHOLD']:
+                details = dict(details or {}, samples=sampler.samples,
+                               hot_stacks=sampler.hot_stacks())
+        if details is not None:
+            details.update(timer.to_dict(), route=route, rdtype=rdtype,
+                           status=response.status_code)
+            app.logger.info('timing %s', json.dumps(details))
+        return response
 
     @app.route('/')
     def root():
         """Provide user a link to the main page. Also this route acts as a health check, returns 200."""
         return jsonify({'message': "Check out www.openresolve.com for usage."}), 200
 
+    @app.route('/nameservers')
+    def nameservers():
+        """Per-nameserver health, to see why traffic moved between them."""
+        servers = health_tracker.stats()
+        for nameserver, server in servers.items():
+            server['RetransmitTimeout'] = resolver_pool.timeout_for(
+                nameserver)
+            server['Edns'] = resolver_pool.edns_stats(nameserver)
+        return jsonify(servers), 200
+
+    @app.route('/stats')
+    def stats():
+        """Cache, coalescing and prefetch counters for this worker."""
+        return jsonify({
+            'cache': answer_cache.stats(),
+            'single_flight': single_flight.stats(),
+            'upstream_queries': prefetcher.stats(),
+            'admission': admission.stats(),
+            'tcp': tcp_pool.stats()
+        }), 200
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        """Counters and histograms of all workers, for Prometheus."""
+        return Response(metrics.render(), 200,
+                        mimetype='text/plain; version=0.0.4')
+
     return app
+
+
+# Cause recorded for errors the handlers did not explain
+ERROR_CAUSES = {
+    400: 'validation',
+    404: 'not_found',
+    405: 'method_not_allowed',
+    415: 'validation'
+}
+
+
+def record_response(route, rdtype, status, cause, elapsed):
+    """Count a response and how long it took"""
+    if status >= 400 and not cause:
+        cause = ERROR_CAUSES.get(status, 'other')
+    metrics.observe('openresolve_request_duration_seconds', elapsed,
+                    {'route': route, 'rdtype': rdtype})
+    metrics.inc('openresolve_responses_total', {
+        'route': route,
+        'status': str(status),
+        'cause': cause
+    })
+
+
+def rdtype_label(rdtype):
+    """Unsupported rdtypes share one label so clients cannot create new
+    series"""
+    rdtype = rdtype.upper()
+    if rdtype not in current_app.config['SUPPORTED_RDTYPES']:
+        return 'unsupported'
+    return rdtype
+
+
+def request_labels():
+    """Route and rdtype labels for the current request"""
+    if request.url_rule is None:
+        return 'unmatched', ''
+    route = request.url_rule.rule
+    args = request.view_args or {}
+    if 'rdtype' in args:
+        return route, rdtype_label(args['rdtype'])
+    if 'ip' in args:
+        return route, 'PTR'
+    return route, ''
@@ -0,0 +1,409 @@
+"""ASGI application serving the lookup routes from an asyncio event loop.
+
+GET /<rdtype>/<domain> and GET /reverse/<ip> are served natively: their
+upstream queries go over non-blocking sockets, so one process can hold
+thousands of lookups in flight instead of one per worker. Validation, the
+answer cache, health tracking, admission control, client timeouts, the
+encoded JSON bodies, their Cache-Control and ETag headers and the request
+metrics are shared with the Flask app, but these lookups do not coalesce or
+serve stale answers.
+
+Every other request (/batch, the reverse sweep, /all, /dns-query,
+/nameservers, /stats, /metrics, ...) is handed to the Flask app on a thread
+pool, and its body is sent on as the app yields it. Serve it with any ASGI
+server, e.g. `uvicorn run_asgi:app`.
+"""
+import asyncio
+import io
+import itertools
+import json
+import math
+import sys
+import time
+from urllib.parse import parse_qsl
+
+from dns import reversename, rdatatype
+from dns.exception import DNSException, Timeout
+from dns.resolver import NXDOMAIN, NoNameservers
+
+from werkzeug.http import quote_etag
+
+from resolverapi import create_app, resolver_pool, record_response
+from resolverapi import admission, answer_cache, health_tracker, rdtype_label
+from resolverapi.endpoints import cache_headers, encoded, not_modified
+from resolverapi.util import is_valid_hostname, is_valid_rdtype, is_valid_ip
+from resolverapi.util import aio, parse_timeout
+from resolverapi.util.admission import queue_time
+from resolverapi.util.cache import answer_ttl, negative_ttl, nxdomain_response
+from resolverapi.util.dns_query import EncodedResponse
+from resolverapi.util.upstream import hedge_delay
+
+
+# First path segments of the Flask routes that take two segments, which
+# would otherwise look like /<rdtype>/<domain>
+FORWARDED = ('all',)
+
+
+def wsgi_environ(scope, body):
+    """The WSGI environ for an ASGI HTTP scope and its request body"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name == 'CONTENT_LENGTH':
+            continue  # the body has been read in full already
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+
+class RequestState(object):
+    """What the Flask app keeps in g while it serves a request, for a
+    request served natively"""
+
+    def __init__(self, scope):
+        self.remote_addr = (scope.get('client') or ('', 0))[0]
+        self.headers = dict((name.decode('latin-1').lower(),
+                             value.decode('latin-1'))
+                            for name, value in scope.get('headers', ()))
+        self.args = {}
+        query_string = scope.get('query_string', b'').decode('latin-1')
+        for name, value in parse_qsl(query_string, keep_blank_values=True):
+            self.args.setdefault(name, value)
+        self.started = time.time()
+        self.queued = queue_time(self.headers.get('x-request-start'),
+                                 self.started)
+        self.deadline = None
+        self.retry_after = None
+        # Set once the request gets as far as a lookup
+        self.lookup = False
+        self.max_age = None
+        self.etag = None
+        self.error_cause = ''
+        self.route = None
+        self.rdtype = ''
+
+    def cacheable(self, ttl, etag=None):
+        """How long the lookup result stays valid, as endpoints.cacheable"""
+        self.max_age = ttl
+        self.etag = etag
+
+    def response(self, body, code):
+        """The status, headers and body to send for a result, as
+        endpoints.json_response makes them"""
+        if self.lookup:
+            headers = cache_headers(self.max_age, self.retry_after)
+        elif self.retry_after is not None:
+            headers = {'Retry-After': '%d' % self.retry_after}
+        else:
+            headers = {}
+        headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                   for name, value in headers.items()]
+        if self.etag is not None:
+            headers.append(
+                (b'etag', quote_etag(self.etag, weak=True).encode('latin-1')))
+            if code == 200 and not_modified(
+                    self.etag, self.headers.get('if-none-match')):
+                return 304, headers, b''
+        if isinstance(body, bytes):
+            body += b'\n'
+        else:
+            body = json.dumps(body).encode('utf-8')
+        headers.append((b'content-type', b'application/json'))
+        return code, headers, body
+
+
+class AsyncApp(object):
+
+    def __init__(self, flask_app):
+        # The Flask app provides configuration and the app context the
+        # validators need, and handles the requests that are forwarded
+        self.flask_app = flask_app
+        self.config = flask_app.config
+        self.logger = flask_app.logger
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            state = RequestState(scope)
+            response = await self.dispatch(scope, state)
+            if response is None:
+                await self.forward(scope, receive, send)
+                return
+            code, headers, body = state.response(*response)
+            await send({
+                'type': 'http.response.start',
+                'status': code,
+                'headers': headers
+            })
+            await send({
+                'type': 'http.response.body',
+                'body': body
+            })
+            record_response(state.route, state.rdtype, code,
+                            state.error_cause, time.time() - state.started)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def dispatch(self, scope, state):
+        """Serve the request natively, or return None to forward it"""
+        if scope['method'] != 'GET':
+            return None
+        parts = scope['path'].lstrip('/').split('/')
+        if parts == ['']:
+            state.route = '/'
+        elif len(parts) != 2 or parts[0] in FORWARDED:
+            return None
+        elif parts[0] == 'reverse':
+            state.route, state.rdtype = '/reverse/<ip>', 'PTR'
+        else:
+            state.route = '/<rdtype>/<domain>'
+            with self.flask_app.app_context():
+                state.rdtype = rdtype_label(parts[0])
+        error = self.admit(state)
+        if error is not None:
+            return error
+        if parts == ['']:
+            return {'message': "Check out www.openresolve.com for usage."}, 200
+        if parts[0] == 'reverse':
+            return await self.reverse_lookup(state, parts[1])
+        return await self.lookup_record_type(state, *parts)
+
+    def admit(self, state):
+        """The Flask app's admit and start_deadline: turn away clients over
+        their rate limit, and work out when the client's timeout runs out.
+        Returns an error response, or None to go ahead."""
+        wait = admission.admit_client(state.remote_addr)
+        if wait:
+            state.error_cause = 'rate_limited'
+            state.retry_after = math.ceil(wait)
+            return {'message': 'Too many requests.'}, 429
+        value = state.args.get('timeout', state.headers.get('x-timeout'))
+        if value is None:
+            return None
+        seconds = parse_timeout(value)
+        if seconds is None:
+            return {'message': 'The provided timeout is invalid'}, 400
+        state.deadline = time.time() - (state.queued or 0) + seconds
+        return None
+
+    async def forward(self, scope, receive, send):
+        """Run the request through the Flask app on worker threads.
+
+        The body is sent a chunk at a time as the WSGI iterable yields it,
+        so streamed responses such as the reverse sweep are not buffered.
+        """
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        environ = wsgi_environ(scope, body)
+        loop = asyncio.get_running_loop()
+        code, headers, result, chunks = await loop.run_in_executor(
+            None, self.start_wsgi, environ)
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': code,
+                'headers': headers
+            })
+            while True:
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({
+                        'type': 'http.response.body',
+                        'body': chunk,
+                        'more_body': True
+                    })
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(None, result.close)
+
+    def start_wsgi(self, environ):
+        """Call the Flask app up to the point where the status and headers
+        are known. Returns them with the WSGI iterable and an iterator over
+        the rest of the body."""
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [int(status.split(' ', 1)[0]), headers]
+        result = self.flask_app(environ, start_response)
+        chunks = iter(result)
+        if not started:
+            # start_response may be put off until the first chunk
+            try:
+                first = next(chunks, None)
+            except Exception:
+                if hasattr(result, 'close'):
+                    result.close()
+                raise
+            if first is not None:
+                chunks = itertools.chain([first], chunks)
+        code, headers = started
+        headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                   for name, value in headers]
+        return code, headers, result, chunks
+
+    async def lookup_record_type(self, state, rdtype, domain):
+        t1 = time.time()
+
+        rdtype = rdtype.upper()
+        self.logger.info('Request from %s - %s', state.remote_addr, rdtype)
+        with self.flask_app.app_context():
+            if not is_valid_rdtype(rdtype):
+                return {'message': "The provided record type is not supported"}, 400
+            try:
+                valid = is_valid_hostname(domain)
+            except DNSException:
+                valid = False
+            if not valid:
+                return {'message': "The provided domain name is invalid"}, 400
+
+        return await self.lookup(state, domain, rdtype, t1,
+                                 "No nameservers found for provided domain")
+
+    async def reverse_lookup(self, state, ip):
+        t1 = time.time()
+        if not is_valid_ip(ip):
+            return {'message': "The provided ip address is invalid"}, 400
+
+        return await self.lookup(state, reversename.from_address(ip),
+                                 rdatatype.PTR, t1,
+                                 'No nameserver found for the provided IP')
+
+    async def in_cache(self, method, *args):
+        """Call an answer_cache method, on a worker thread when there is a
+        remote tier since its client blocks on the network"""
+        if answer_cache.remote is None:
+            return method(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, method, *args)
+
+    async def lookup(self, state, qname, rdtype, t1, not_found_message):
+        """The asyncio counterpart of endpoints.lookup. Lookups that go
+        upstream take an admission slot, and the client waits on them at
+        most until its deadline."""
+        state.lookup = True
+        cached = await self.in_cache(answer_cache.get, qname, rdtype)
+        if cached is not None:
+            if cached.nxdomain:
+                state.error_cause = 'nxdomain'
+                state.cacheable(cached.ttl())
+                return {'message': not_found_message}, 404
+            body = encoded(cached)
+            state.cacheable(cached.ttl(), body.etag)
+            return body.render(time.time() - t1, cached.age()), 200
+
+        if state.deadline is not None and state.deadline <= time.time():
+            state.error_cause = 'timeout'
+            return {'message': 'All nameservers timed out.'}, 503
+        if not admission.acquire(state.queued):
+            state.error_cause = 'shed'
+            state.retry_after = self.config['SHED_RETRY_AFTER']
+            return {'message': 'The server is too busy, try again later.'}, 503
+        try:
+            return await self.lookup_upstream(state, qname, rdtype, t1,
+                                              not_found_message)
+        finally:
+            admission.release()
+
+    async def lookup_upstream(self, state, qname, rdtype, t1,
+                              not_found_message):
+        # The upstream query runs for its full lifetime and fills the cache
+        # even if the client stops waiting for it
+        task = aio.in_background(self.resolve_and_cache(qname, rdtype))
+        try:
+            if state.deadline is None:
+                answer, nameserver = await task
+            else:
+                answer, nameserver = await asyncio.wait_for(
+                    asyncio.shield(task), max(state.deadline - time.time(), 0))
+        except NXDOMAIN as e:
+            state.error_cause = 'nxdomain'
+            state.cacheable(negative_ttl(nxdomain_response(e),
+                                         answer_cache.default_negative_ttl))
+            return {'message': not_found_message}, 404
+        except NoNameservers:
+            state.error_cause = 'no_nameservers'
+            return {'message': not_found_message}, 404
+        except (Timeout, asyncio.TimeoutError) as e:
+            state.error_cause = 'timeout'
+            self.logger.info(e)
+            return {'message': 'All nameservers timed out.'}, 503
+        except Exception as e:
+            state.error_cause = 'unexpected'
+            self.logger.error(e)
+            return {'message': 'An unexpected error occured.'}, 500
+
+        if answer is None:
+            return {'message': 'An unexpected error occured.'}, 500
+
+        t2 = time.time()
+        duration = t2 - t1
+
+        body = EncodedResponse(answer, nameserver)
+        state.cacheable(answer_ttl(answer, answer_cache.default_negative_ttl),
+                        body.etag)
+        return body.render(duration), 200
+
+    async def resolve_and_cache(self, qname, rdtype):
+        """Query the upstream resolvers and cache the answer, or the
+        NXDOMAIN. Returns the answer and the nameserver."""
+        config = self.config
+        delay = config['HEDGE_DELAY']
+        if delay is not None:
+            delay = hedge_delay(delay, config['HEDGE_MIN_DELAY'])
+        tracker = health_tracker if config['HEALTH_TRACKING'] else None
+        try:
+            answer, nameserver = await aio.resolve(
+                config['RESOLVERS'], qname, rdtype, resolver_pool.port,
+                resolver_pool.lifetime, delay, tracker,
+                resolver_pool.edns_payload)
+        except NXDOMAIN as e:
+            await self.in_cache(answer_cache.put_nxdomain, qname, rdtype,
+                                nxdomain_response(e))
+            raise
+        if answer is not None:
+            await self.in_cache(answer_cache.put, qname, rdtype, answer,
+                                nameserver)
+        return answer, nameserver
+
+
+def create_asgi_app(config_name):
+    """Build the asyncio app with the same configuration as create_app"""
+    return AsyncApp(create_app(config_name))
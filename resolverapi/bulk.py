@@ -0,0 +1,233 @@
+"""Resolve a file of domain names without going through HTTP.
+
+    python -m resolverapi.bulk domains.txt --rdtypes A,MX > results.ndjson
+    zcat domains.gz | python -m resolverapi.bulk --format csv -o results.csv
+
+Names are read one per line, lazily, and resolved through the same cache,
+coalescing and upstream code as the API, with up to --concurrency lookups in
+flight. Results are written as they complete, in any order: NDJSON lines in
+the parse_query format of the lookup routes, or CSV rows. Progress goes to
+stderr. Memory use depends on the concurrency, not on the number of names.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import threading
+import time
+
+from dns.exception import DNSException
+
+from resolverapi import create_app, admission, answer_cache, resolver_pool
+from resolverapi.endpoints import lookup
+from resolverapi.util import is_valid_hostname
+from resolverapi.util.pool import imap_unordered
+
+
+NOT_FOUND_MESSAGE = "No nameservers found for provided domain"
+CSV_COLUMNS = ('domain', 'rdtype', 'status', 'rcode', 'ttl', 'answers',
+               'server', 'duration', 'message')
+# Fields every record in parse_query output has, the rest is its data
+COMMON_FIELDS = ('Name', 'Type', 'Class', 'TTL')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('input', nargs='?', default='-',
+                        help='file of domain names, - for stdin')
+    parser.add_argument('-o', '--output', default='-',
+                        help='file to write results to, - for stdout')
+    parser.add_argument('--format', choices=('ndjson', 'csv'),
+                        default='ndjson')
+    parser.add_argument('--rdtypes', default='A',
+                        help='comma separated record types to query')
+    parser.add_argument('--concurrency', type=int, default=256,
+                        help='lookups in flight at once')
+    parser.add_argument('--resolvers',
+                        help='comma separated nameservers, default RESOLVERS')
+    parser.add_argument('--port', type=int, help='port of the nameservers')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='disable the answer cache, for unique names')
+    parser.add_argument('--progress', type=float, default=5.0,
+                        help='seconds between progress reports, 0 for none')
+    return parser.parse_args(argv)
+
+
+def read_names(lines):
+    """Domain names in lines, skipping blank lines and # comments"""
+    for line in lines:
+        name = line.strip()
+        if name and not name.startswith('#'):
+            yield name
+
+
+def questions(names, rdtypes):
+    for name in names:
+        for rdtype in rdtypes:
+            yield name, rdtype
+
+
+def valid_hostname(domain):
+    try:
+        return is_valid_hostname(domain)
+    except DNSException:
+        return False
+
+
+def resolve_question(app, question):
+    """Returns (domain, rdtype, result, status code). The result is the
+    encoded parse_query JSON of an answer, or a dict with a message."""
+    domain, rdtype = question
+    if not valid_hostname(domain):
+        return (domain, rdtype,
+                {'message': 'The provided domain name is invalid'}, 400)
+    with app.app_context():
+        result, code = lookup(domain, rdtype, time.time(), NOT_FOUND_MESSAGE)
+    return domain, rdtype, result, code
+
+
+class NdjsonWriter(object):
+    """One JSON object per line. Errors carry the question they are for."""
+
+    def __init__(self, output):
+        self.output = output
+
+    def write(self, domain, rdtype, result, code):
+        if code == 200:
+            self.output.write(result.decode('utf-8'))
+        else:
+            self.output.write(json.dumps(dict(
+                result, domain=domain, rdtype=rdtype, status=code)))
+        self.output.write('\n')
+
+
+class CsvWriter(object):
+    """One row per question. The data of each answer record is joined by
+    spaces, and the records by semicolons."""
+
+    def __init__(self, output):
+        self.writer = csv.writer(output)
+        self.writer.writerow(CSV_COLUMNS)
+
+    def write(self, domain, rdtype, result, code):
+        if code != 200:
+            self.writer.writerow([domain, rdtype, code, '', '', '', '', '',
+                                  result.get('message', '')])
+            return
+        parsed = json.loads(result.decode('utf-8'))
+        answers = parsed['AnswerSection']
+        ttl = min(rr['TTL'] for rr in answers) if answers else ''
+        data = '; '.join(
+            ' '.join(str(value) for key, value in rr.items()
+                     if key not in COMMON_FIELDS) for rr in answers)
+        self.writer.writerow([
+            domain, rdtype, code, parsed['ReturnCode'], ttl, data,
+            parsed['Query']['Server'],
+            '%.3f' % parsed['Query']['Duration'], ''])
+
+
+class Progress(object):
+    """Counts results by status and reports them every interval seconds"""
+
+    def __init__(self, interval=5.0, stream=None):
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self.started = time.time()
+        self.done = 0
+        self.answered = 0
+        self.not_found = 0
+        self.invalid = 0
+        self.failed = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.interval:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.report()
+
+    def add(self, code):
+        self.done += 1
+        if code == 200:
+            self.answered += 1
+        elif code == 404:
+            self.not_found += 1
+        elif code == 400:
+            self.invalid += 1
+        else:
+            self.failed += 1
+
+    def report(self):
+        elapsed = time.time() - self.started
+        rate = self.done / elapsed if elapsed else 0.0
+        self.stream.write(
+            '%d resolved in %.1fs (%.0f/s): %d answered, %d not found, '
+            '%d failed, %d invalid\n' % (
+                self.done, elapsed, rate, self.answered, self.not_found,
+                self.failed, self.invalid))
+        self.stream.flush()
+
+
+def make_app(args):
+    app = create_app(os.environ.get('RESOLVER_ENV', 'prod'))
+    if args.resolvers:
+        app.config['RESOLVERS'] = [
+            addr.strip() for addr in args.resolvers.split(',')]
+    if args.port:
+        # Resolvers are created on first use, so they all pick up the port
+        resolver_pool.port = args.port
+    if args.no_cache:
+        answer_cache.configure(0)
+    # The concurrency window bounds the lookups in flight, nothing to shed
+    admission.configure()
+    return app
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    app = make_app(args)
+    rdtypes = [rdtype.strip().upper() for rdtype in args.rdtypes.split(',')]
+    for rdtype in rdtypes:
+        if rdtype not in app.config['SUPPORTED_RDTYPES']:
+            sys.exit('Unsupported record type: %s' % rdtype)
+
+    source = sys.stdin
+    if args.input != '-':
+        source = open(args.input)
+    output = sys.stdout
+    if args.output != '-':
+        output = open(args.output, 'w', newline='')
+    writer = (CsvWriter if args.format == 'csv' else NdjsonWriter)(output)
+    progress = Progress(interval=args.progress).start()
+    try:
+        results = imap_unordered(
+            lambda question: resolve_question(app, question),
+            questions(read_names(source), rdtypes), args.concurrency)
+        for domain, rdtype, result, code in results:
+            writer.write(domain, rdtype, result, code)
+            progress.add(code)
+    finally:
+        progress.stop()
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+        else:
+            output.flush()
+
+
+if __name__ == '__main__':
+    main()
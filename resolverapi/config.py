@@ -1,6 +1,141 @@
 class BaseConfig(object):
     DEBUG = False
     RESOLVERS = ['208.67.222.222', '208.67.220.220']
+    RESOLVER_PORT = 53
+    # Seconds to wait for one nameserver overall, and per retransmission
+    RESOLVER_LIFETIME = 3.0
+    RESOLVER_TIMEOUT = 2.0
+    # Retransmit after twice the ADAPTIVE_TIMEOUT_PERCENTILE of each
+    # nameserver's recent round trip times instead, but no sooner than
+    # RESOLVER_MIN_TIMEOUT and no later than RESOLVER_TIMEOUT. Clients can
+    # lower the overall wait further with a timeout parameter or X-Timeout
+    # header, in seconds, which is shared between the nameservers tried.
+    ADAPTIVE_TIMEOUT = True
+    ADAPTIVE_TIMEOUT_PERCENTILE = 99
+    RESOLVER_MIN_TIMEOUT = 0.05
+    # Advertise an EDNS0 UDP payload size of EDNS_PAYLOAD bytes, so answers
+    # up to that size need no TCP retry. Retransmits advertise 1232 and
+    # then 512 bytes. A resolver that times out at a size three times while
+    # it answers others, as when fragments are dropped, is queried with the
+    # smaller size from then on, and with EDNS_PAYLOAD again after
+    # EDNS_RETRY_INTERVAL seconds. 0 sends plain 512-byte queries.
+    EDNS_PAYLOAD = 1232
+    EDNS_RETRY_INTERVAL = 600
+    # Each worker keeps up to TCP_POOL_SIZE TCP connections open to every
+    # resolver, pipelining up to TCP_MAX_PIPELINE queries on each (RFC 7766)
+    # and closing them after TCP_IDLE_TIMEOUT idle seconds. When they are all
+    # full, queries wait for room within their timeout. Truncated DoH
+    # responses are retried over them, and lookups of TCP_RDTYPES, e.g.
+    # ('TXT', 'NAPTR'), always use them. 0 disables the pool.
+    TCP_POOL_SIZE = 2
+    TCP_MAX_PIPELINE = 64
+    TCP_IDLE_TIMEOUT = 10.0
+    TCP_RDTYPES = ()
+    # RFC 8767: keep answers for STALE_WINDOW seconds after they expire. If
+    # upstream fails, or has not answered within STALE_CLIENT_TIMEOUT, the
+    # expired answer is returned with a TTL of STALE_ANSWER_TTL and flagged
+    # as Stale. After a failure upstream is left alone for STALE_RETRY.
+    SERVE_STALE = True
+    STALE_WINDOW = 3600
+    STALE_CLIENT_TIMEOUT = 1.8
+    STALE_ANSWER_TTL = 30
+    STALE_RETRY = 30
+    # Also query the next resolver when the current one has not answered
+    # within this many seconds, and use whichever answers first. None tries
+    # them one at a time, 'p95' follows the observed upstream latency.
+    HEDGE_DELAY = None
+    HEDGE_MIN_DELAY = 0.02
+    # Try the healthiest resolvers first. After HEALTH_FAILURE_THRESHOLD
+    # timeouts in a row a resolver is skipped for HEALTH_BACKOFF seconds,
+    # doubling on every failed probe up to HEALTH_MAX_BACKOFF. Probes are
+    # sent in the background, so requests do not wait for them.
+    HEALTH_TRACKING = True
+    HEALTH_FAILURE_THRESHOLD = 3
+    HEALTH_BACKOFF = 5.0
+    HEALTH_MAX_BACKOFF = 300.0
+    # Upper bound on memory used by the answer cache. 0 disables caching.
+    CACHE_MAX_BYTES = 16 * 1024 * 1024
+    # TTL for negative answers that arrive without an SOA record
+    CACHE_NEGATIVE_TTL = 60
+    # 'memory' gives every worker its own cache. 'shared' keeps one cache for
+    # all the workers on a host in the file SHARED_CACHE_PATH, split into
+    # slots of SHARED_CACHE_SLOT_SIZE bytes; larger answers are not cached.
+    # The slot count and size are appended to the file name, so a worker
+    # with another configuration uses a new file.
+    # Its hits parse the answer and encode the JSON body again every time.
+    CACHE_BACKEND = 'memory'
+    SHARED_CACHE_PATH = '/dev/shm/openresolve-cache'
+    SHARED_CACHE_SLOT_SIZE = 2048
+    # Second-level cache shared by all nodes: None, 'redis' for a server
+    # speaking the Redis protocol at REMOTE_CACHE_HOST, or 'memory' for an
+    # in-process stand-in. Replies slower than REMOTE_CACHE_TIMEOUT count as
+    # misses and the tier is then skipped for REMOTE_CACHE_BACKOFF seconds.
+    REMOTE_CACHE = None
+    REMOTE_CACHE_HOST = '127.0.0.1'
+    REMOTE_CACHE_PORT = 6379
+    REMOTE_CACHE_TIMEOUT = 0.05
+    REMOTE_CACHE_BACKOFF = 5.0
+    # Save the answer cache to SNAPSHOT_PATH every SNAPSHOT_INTERVAL seconds
+    # and when a worker exits. After a restart, answers are taken from the
+    # snapshot until they expire. None disables snapshots.
+    SNAPSHOT_PATH = None
+    SNAPSHOT_INTERVAL = 300
+    # Identical lookups in flight at the same time share one upstream query.
+    # It runs for the full RESOLVER_LIFETIME, each client waiting on it only
+    # until its own timeout.
+    # Set SINGLE_FLIGHT_DIR to a directory on local disk to also share them
+    # between the uwsgi workers on a host.
+    SINGLE_FLIGHT = True
+    SINGLE_FLIGHT_DIR = None
+    # Refresh answers that have been served at least PREFETCH_MIN_RATE
+    # times a second since they were stored once less than
+    # PREFETCH_FRACTION of their TTL is left, at no more than
+    # PREFETCH_MAX_QPS refreshes per second
+    PREFETCH = True
+    PREFETCH_FRACTION = 0.1
+    PREFETCH_MIN_RATE = 0.05
+    PREFETCH_MAX_QPS = 20
+    # Largest number of queries accepted by POST /batch, and how many of
+    # them are resolved at the same time
+    BATCH_MAX_SIZE = 1000
+    BATCH_CONCURRENCY = 32
+    # Largest range GET /reverse/<ip>/<prefixlen> will sweep, and how many
+    # PTR queries it keeps in flight
+    REVERSE_SWEEP_MAX_ADDRESSES = 65536
+    REVERSE_SWEEP_CONCURRENCY = 32
+    # GET /all/<domain> gives up on a record type after this many seconds,
+    # or after the type's entry in ALL_RECORDS_TIMEOUTS, e.g. {'LOC': 0.5}
+    ALL_RECORDS_TIMEOUT = 2.0
+    ALL_RECORDS_TIMEOUTS = {}
+    # Admission control. Each worker lets at most MAX_UPSTREAM_IN_FLIGHT
+    # lookups wait on upstream at once, and sheds the upstream lookups of
+    # requests that queued for longer than MAX_QUEUE_TIME seconds before a
+    # worker picked them up (from the X-Request-Start header nginx adds).
+    # Shed lookups get a stale answer if there is one, otherwise a 503 with
+    # a Retry-After of SHED_RETRY_AFTER seconds. Cache hits are always
+    # served. None disables a limit.
+    MAX_UPSTREAM_IN_FLIGHT = 64
+    MAX_QUEUE_TIME = 1.0
+    SHED_RETRY_AFTER = 1
+    # Each client address may make CLIENT_RATE requests per second, in
+    # bursts of up to CLIENT_BURST, and gets a 429 beyond that. Limits are
+    # kept for the CLIENT_RATE_MAX_CLIENTS most recent clients of a worker.
+    # None disables the limit.
+    CLIENT_RATE = None
+    CLIENT_BURST = 50
+    CLIENT_RATE_MAX_CLIENTS = 10000
+    # Send the time spent in each phase of a request in a Server-Timing
+    # header and log it as JSON
+    SERVER_TIMING = True
+    # Sample the stacks of this fraction of requests every PROFILE_INTERVAL
+    # seconds, and log the hottest ones of those slower than
+    # PROFILE_SLOW_THRESHOLD seconds. 0 disables profiling.
+    PROFILE_SAMPLE_RATE = 0.0
+    PROFILE_INTERVAL = 0.005
+    PROFILE_SLOW_THRESHOLD = 0.5
+    # Directory where every worker keeps its metrics so /metrics can add
+    # them up. None keeps them in memory, per process.
+    METRICS_DIR = None
     SUPPORTED_RDTYPES = (
         'A',
         'AAAA',
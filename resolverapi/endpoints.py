@@ -1,14 +1,293 @@
-from flask import current_app, request
+from flask import current_app, g, request, Response, stream_with_context
 from flask_restful import Resource, abort
+from werkzeug.http import parse_etags
 from dns import reversename, rdatatype
 from dns.resolver import NXDOMAIN, NoNameservers
 
 from resolverapi.util import is_valid_hostname, is_valid_rdtype, is_valid_ip
-from resolverapi.util.dns_query import parse_query
-from resolverapi import dns_resolver
+from resolverapi.util.cache import (make_key, nxdomain_response, answer_ttl,
+                                   negative_ttl)
+from resolverapi.util.dns_query import EncodedResponse
+from resolverapi.util.metrics import metrics
+from resolverapi.util.timing import current_timer, phase
+from resolverapi.util.pool import imap_unordered
+from resolverapi.util.upstream import resolve, hedge_delay
+from resolverapi.util.wire import FormError, check_query, forward, min_ttl
+from resolverapi import resolver_pool, answer_cache, health_tracker
+from resolverapi import single_flight, prefetcher, admission
 
+import base64
+import binascii
+import ipaddress
+import json
 import time
-from dns.exception import Timeout
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from dns.exception import DNSException, Timeout
+
+
+# RFC 8484 media type for DNS wire format messages
+DNS_MESSAGE = 'application/dns-message'
+
+# Runs upstream queries that a request only waits on for a limited time
+stale_executor = ThreadPoolExecutor(max_workers=16)
+
+
+def query_upstream(qname, rdtype, deadline=None):
+    """Resolve against the configured RESOLVERS, hedging when enabled and
+    stopping at deadline, if given. Returns the answer and the nameserver
+    that provided it."""
+    config = current_app.config
+    delay = config['HEDGE_DELAY']
+    if delay is not None:
+        delay = hedge_delay(delay, config['HEDGE_MIN_DELAY'])
+    tracker = health_tracker if config['HEALTH_TRACKING'] else None
+    return resolve(resolver_pool, config['RESOLVERS'], qname, rdtype, delay,
+                   tracker, current_timer(), deadline)
+
+
+def resolve_and_cache(qname, rdtype):
+    """Query upstream and cache the outcome. Identical lookups already in
+    flight share one upstream query, which runs for the full resolver
+    lifetime so that no client's timeout cuts it short for the others.
+    Each client waits on it until its own deadline."""
+    deadline = g.get('deadline')
+    if deadline is not None and deadline <= time.time():
+        raise Timeout(timeout=0)
+    app = current_app._get_current_object()
+    timer = current_timer()
+
+    def shared_query():
+        with app.app_context():
+            g.timer = timer
+            return query_upstream(qname, rdtype)
+
+    try:
+        if single_flight.enabled:
+            answer, nameserver = single_flight.do(
+                make_key(qname, rdtype), shared_query, deadline=deadline)
+        else:
+            answer, nameserver = query_upstream(qname, rdtype, deadline)
+    except NXDOMAIN as e:
+        answer_cache.put_nxdomain(qname, rdtype, nxdomain_response(e))
+        raise
+    if answer is not None:
+        answer_cache.put(qname, rdtype, answer, nameserver)
+    return answer, nameserver
+
+
+def refresh(app, qname, rdtype):
+    """Re-resolve a cached answer off the request path"""
+    with app.app_context():
+        try:
+            resolve_and_cache(qname, rdtype)
+        except NXDOMAIN:
+            pass
+        except Exception as e:
+            app.logger.info(e)
+
+
+def resolve_within(qname, rdtype, deadline, retry=None):
+    """resolve_and_cache, giving up after deadline seconds. The upstream
+    query carries on in the background and still fills the cache. If it
+    fails, even after the request stopped waiting on it, upstream is not
+    asked about the question again for retry seconds."""
+    app = current_app._get_current_object()
+    timer = current_timer()
+    client_deadline = g.get('deadline')
+    if client_deadline is not None:
+        deadline = min(deadline, max(client_deadline - time.time(), 0))
+
+    def run():
+        # Without the client's deadline, so back_off sees how upstream
+        # fared rather than that this client stopped waiting
+        with app.app_context():
+            g.timer = timer
+            return resolve_and_cache(qname, rdtype)
+
+    def back_off(future):
+        error = future.exception()
+        if error is not None and not isinstance(error, NXDOMAIN):
+            answer_cache.retry_later(qname, rdtype, time.time() + retry)
+
+    future = stale_executor.submit(run)
+    if retry is not None:
+        future.add_done_callback(back_off)
+    return future.result(timeout=deadline)
+
+
+def upstream_error(e, not_found_message):
+    """Map an upstream failure to an error message and status code. The
+    cause is left in g for the response metrics."""
+    if isinstance(e, NXDOMAIN):
+        g.error_cause = 'nxdomain'
+        # TODO: this should still follow the RFC
+        return {'message': not_found_message}, 404
+    if isinstance(e, NoNameservers):
+        g.error_cause = 'no_nameservers'
+        return {'message': not_found_message}, 404
+    if isinstance(e, Timeout):
+        g.error_cause = 'timeout'
+        current_app.logger.info(e)
+        return {'message': 'All nameservers timed out.'}, 503
+    g.error_cause = 'unexpected'
+    current_app.logger.error(e)
+    return {'message': 'An unexpected error occured.'}, 500
+
+
+def encoded(entry):
+    """The cached entry's EncodedResponse, built on first use"""
+    if entry.body is None:
+        answer_cache.attach_body(
+            entry, EncodedResponse(entry.answer, entry.nameserver))
+    return entry.body
+
+
+def cache_control(ttl):
+    """Cache-Control for a response that may be reused for ttl seconds"""
+    if ttl is None:
+        return 'no-cache'
+    return 'max-age=%d' % ttl
+
+
+def cache_headers(max_age, retry_after=None):
+    """Cache-Control for a lookup result, and Retry-After if it was shed"""
+    headers = {'Cache-Control': cache_control(max_age)}
+    if retry_after is not None:
+        headers['Retry-After'] = '%d' % retry_after
+    return headers
+
+
+def not_modified(etag, if_none_match):
+    """Whether a conditional GET already holds the answer with this ETag"""
+    return (etag is not None and if_none_match is not None and
+            parse_etags(if_none_match).contains_weak(etag))
+
+
+def cacheable(ttl, etag=None):
+    """Let json_response know how long the lookup result stays valid"""
+    g.max_age = ttl
+    g.etag = etag
+
+
+def overloaded():
+    """Shed a lookup, asking the client to come back shortly"""
+    g.error_cause = 'shed'
+    g.retry_after = current_app.config['SHED_RETRY_AFTER']
+    return {'message': 'The server is too busy, try again later.'}, 503
+
+
+def json_response(result, code):
+    """Send a lookup result, passing encoded bodies through untouched.
+
+    Caches may keep the response for as long as its TTL. Answers carry a
+    weak ETag over their records, the duration and TTLs in the body change
+    with every request, and a conditional GET for the same records gets a
+    304.
+    """
+    headers = cache_headers(g.get('max_age'), g.get('retry_after'))
+    if not isinstance(result, bytes):
+        return result, code, headers
+    with phase('encode'):
+        response = Response(result + b'\n', code, mimetype='application/json',
+                            headers=headers)
+    etag = g.get('etag')
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+        response.make_conditional(request)
+    return response
+
+
+def lookup(qname, rdtype, t1, not_found_message):
+    """Answer a question from the cache or the upstream resolvers. Returns
+    the parse_query JSON encoded as bytes, or an error message and status
+    code.
+
+    When serving stale answers is enabled (RFC 8767) and the cache holds an
+    expired answer, it is returned if the upstream query fails or does not
+    complete within STALE_CLIENT_TIMEOUT, or if the lookup is shed because
+    the worker is overloaded.
+    """
+    with phase('cache'):
+        cached = answer_cache.get(qname, rdtype)
+    if cached is not None:
+        prefetcher.maybe_prefetch(make_key(qname, rdtype), cached, refresh,
+                                  current_app._get_current_object(),
+                                  qname, rdtype)
+        if cached.nxdomain:
+            g.error_cause = 'nxdomain'
+            cacheable(cached.ttl())
+            return {'message': not_found_message}, 404
+        with phase('serialize'):
+            body = encoded(cached)
+            cacheable(cached.ttl(), body.etag)
+            return body.render(time.time() - t1, cached.age()), 200
+
+    with phase('cache'):
+        stale = answer_cache.get_stale(qname, rdtype)
+    if stale is not None and stale.retry_after > time.time():
+        # Upstream failed recently, don't wait on it again yet
+        return stale_response(stale, t1, not_found_message)
+
+    if not admission.acquire(g.get('queued')):
+        if stale is not None:
+            return stale_response(stale, t1, not_found_message)
+        return overloaded()
+    try:
+        return lookup_upstream(qname, rdtype, t1, not_found_message, stale)
+    finally:
+        admission.release()
+
+
+def lookup_upstream(qname, rdtype, t1, not_found_message, stale):
+    """The upstream half of lookup, for a question the cache could not
+    answer"""
+    config = current_app.config
+    prefetcher.record_demand()
+    try:
+        if stale is not None:
+            answer, nameserver = resolve_within(
+                qname, rdtype, config['STALE_CLIENT_TIMEOUT'],
+                config['STALE_RETRY'])
+        else:
+            answer, nameserver = resolve_and_cache(qname, rdtype)
+    except NXDOMAIN as e:
+        cacheable(negative_ttl(nxdomain_response(e),
+                               answer_cache.default_negative_ttl))
+        return upstream_error(e, not_found_message)
+    except Exception as e:
+        if stale is None:
+            return upstream_error(e, not_found_message)
+        current_app.logger.info('Serving stale answer: %r', e)
+        if not isinstance(e, FutureTimeout):
+            answer_cache.retry_later(qname, rdtype,
+                                     time.time() + config['STALE_RETRY'])
+        return stale_response(stale, t1, not_found_message)
+
+    if answer is None:
+        return {'message': 'An unexpected error occured.'}, 500
+
+    t2 = time.time()
+    duration = t2 - t1
+
+    with phase('serialize'):
+        body = EncodedResponse(answer, nameserver)
+        cacheable(answer_ttl(answer, answer_cache.default_negative_ttl),
+                  body.etag)
+        return body.render(duration), 200
+
+
+def stale_response(entry, t1, not_found_message):
+    metrics.inc('openresolve_cache_lookups_total', {'result': 'stale'})
+    stale_ttl = current_app.config['STALE_ANSWER_TTL']
+    if entry.nxdomain:
+        g.error_cause = 'nxdomain'
+        cacheable(stale_ttl)
+        return {'message': not_found_message}, 404
+    with phase('serialize'):
+        body = encoded(entry)
+        cacheable(stale_ttl, body.etag)
+        return body.render(time.time() - t1, stale_ttl=stale_ttl), 200
 
 
 class LookupRecordType(Resource):
@@ -19,34 +298,11 @@ class LookupRecordType(Resource):
         rdtype = rdtype.upper()
         current_app.logger.info(
             'Request from %s - %s', request.remote_addr, rdtype)
-        self.valid_args(rdtype, domain)
+        with phase('validate'):
+            self.valid_args(rdtype, domain)
 
-        # Iterate through nameservers so that we can tell which one gets used.
-        nameservers = current_app.config['RESOLVERS']
-        for nameserver in nameservers:
-            dns_resolver.nameservers = [nameserver]
-            try:
-                answer = dns_resolver.query(
-                    domain, rdtype, raise_on_no_answer=False)
-                # Successful query
-                break
-            except (NoNameservers, NXDOMAIN):
-                # TODO: this should still follow the RFC
-                return {'message': "No nameservers found for provided domain"}, 404
-            except Timeout as e:
-                # Communication fail or timeout - try next nameserver
-                if nameserver is nameservers[-1]:
-                    current_app.logger.info(e)
-                    return {'message': 'All nameservers timed out.'}, 503
-                continue
-            except Exception as e:
-                current_app.logger.error(e)
-                return {'message': 'An unexpected error occured.'}, 500
-
-        t2 = time.time()
-        duration = t2 - t1
-
-        return parse_query(answer, nameserver, duration)
+        return json_response(*lookup(
+            domain, rdtype, t1, "No nameservers found for provided domain"))
 
     def valid_args(self, rdtype, domain):
         if not is_valid_rdtype(rdtype):
@@ -55,42 +311,274 @@ class LookupRecordType(Resource):
             abort(400, message="The provided domain name is invalid")
 
 
+class BatchLookup(Resource):
+    """Resolve a JSON list of queries in one request. Each query is either
+    {"rdtype": "A", "domain": "example.com"} or ["A", "example.com"].
+
+    Results come back in the same order. A query that fails carries its
+    error message and status instead of failing the whole batch.
+    """
+
+    def post(self):
+        t1 = time.time()
+        queries = request.get_json(silent=True)
+        if not isinstance(queries, list):
+            abort(400, message="Expected a JSON list of queries")
+        if len(queries) > current_app.config['BATCH_MAX_SIZE']:
+            abort(400, message="Too many queries in one batch")
+        current_app.logger.info(
+            'Batch request from %s - %d queries', request.remote_addr,
+            len(queries))
+
+        results = [None] * len(queries)
+        pending = []
+        with phase('validate'):
+            for i, query in enumerate(queries):
+                rdtype, domain = self.parse_item(query)
+                error = self.valid_args(rdtype, domain)
+                if error is not None:
+                    results[i] = {'message': error, 'status': 400}
+                else:
+                    pending.append((i, rdtype.upper(), domain))
+
+        # Fetch what other nodes already have in one round trip
+        with phase('cache'):
+            answer_cache.warm(
+                [(domain, rdtype) for _, rdtype, domain in pending])
+        app = current_app._get_current_object()
+        deadline = g.get('deadline')
+
+        def resolve_item(item):
+            i, rdtype, domain = item
+            with app.app_context():
+                g.deadline = deadline
+                return i, lookup(domain, rdtype, t1,
+                                 "No nameservers found for provided domain")
+
+        workers = min(len(pending), current_app.config['BATCH_CONCURRENCY'])
+        if workers:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for i, (result, code) in executor.map(resolve_item, pending):
+                    if code != 200:
+                        result = dict(result, status=code)
+                    results[i] = result
+        with phase('encode'):
+            body = b','.join(
+                result if isinstance(result, bytes)
+                else json.dumps(result).encode('utf-8') for result in results)
+            return Response(b'[' + body + b']\n', mimetype='application/json')
+
+    def parse_item(self, query):
+        if isinstance(query, dict):
+            return query.get('rdtype'), query.get('domain')
+        if isinstance(query, list) and len(query) == 2:
+            return query
+        return None, None
+
+    def valid_args(self, rdtype, domain):
+        """Return an error message for an invalid query, None otherwise"""
+        if not isinstance(rdtype, str) or not is_valid_rdtype(rdtype.upper()):
+            return "The provided record type is not supported"
+        try:
+            if isinstance(domain, str) and is_valid_hostname(domain):
+                return None
+        except DNSException:
+            pass
+        return "The provided domain name is invalid"
+
+
 class ReverseLookup(Resource):
 
     def get(self, ip):
         t1 = time.time()
-        self.valid_args(ip)
+        with phase('validate'):
+            self.valid_args(ip)
 
-        # Iterate through nameservers so that we can tell which one gets used.
-        nameservers = current_app.config['RESOLVERS']
-        for nameserver in nameservers:
-            dns_resolver.nameservers = [nameserver]
-            try:
-                # http://stackoverflow.com/a/19867936/1707152
-                answer = dns_resolver.query(
-                    reversename.from_address(ip), rdatatype.PTR,
-                    raise_on_no_answer=False)
-                # Successful query
-                break
-            except Timeout as e:
-                # Communication fail or timeout - try next nameserver
-                if nameserver is nameservers[-1]:
-                    current_app.logger.info(e)
-                    return {'message': 'All nameservers timed out.'}, 503
-                continue
-            except NXDOMAIN:
-                return {'message': 'No nameserver found for the provided IP'}, 404
-            except Exception as e:
-                current_app.logger.error(e)
-                return {'message': 'An unexpected error occured.'}, 500
-
-        t2 = time.time()
-        duration = t2 - t1
-
-        if answer is None:
-            return {'message': 'An unexpected error occured.'}, 500
-        return parse_query(answer, nameserver, duration)
+        # http://stackoverflow.com/a/19867936/1707152
+        return json_response(*lookup(
+            reversename.from_address(ip), rdatatype.PTR, t1,
+            'No nameserver found for the provided IP'))
 
     def valid_args(self, ip):
         if not is_valid_ip(ip):
             abort(400, message="The provided ip address is invalid")
+
+
+class ReverseSweep(Resource):
+    """PTR lookups for every address in a CIDR range, e.g. /reverse/10.0.0.0/24
+
+    Addresses are generated lazily and resolved with bounded concurrency.
+    Results are streamed back as newline delimited JSON in the order they
+    complete, so memory stays flat and the first lines arrive immediately.
+    """
+
+    def get(self, ip, prefixlen):
+        t1 = time.time()
+        network = self.valid_args(ip, prefixlen)
+        current_app.logger.info(
+            'Reverse sweep from %s - %d addresses', request.remote_addr,
+            network.num_addresses)
+
+        app = current_app._get_current_object()
+
+        def resolve_address(address):
+            with app.app_context():
+                result, code = lookup(
+                    reversename.from_address(str(address)), rdatatype.PTR,
+                    t1, 'No nameserver found for the provided IP')
+            prefix = '{"IP": %s, ' % json.dumps(str(address))
+            if code != 200:
+                result = dict(result, status=code)
+            if not isinstance(result, bytes):
+                result = json.dumps(result).encode('utf-8')
+            # Splice the address into the front of the encoded object
+            return prefix.encode('ascii') + result[1:] + b'\n'
+
+        def generate():
+            return imap_unordered(resolve_address, iter(network),
+                                  app.config['REVERSE_SWEEP_CONCURRENCY'])
+
+        return Response(stream_with_context(generate()),
+                        mimetype='application/x-ndjson')
+
+    def valid_args(self, ip, prefixlen):
+        if not is_valid_ip(ip):
+            abort(400, message="The provided ip address is invalid")
+        try:
+            network = ipaddress.ip_network(
+                u'%s/%d' % (ip, prefixlen), strict=False)
+        except ValueError:
+            abort(400, message="The provided prefix length is invalid")
+        max_addresses = current_app.config['REVERSE_SWEEP_MAX_ADDRESSES']
+        if network.num_addresses > max_addresses:
+            abort(400, message="The provided range is too large")
+        return network
+
+
+class AllRecords(Resource):
+    """Every supported record type for a domain in one request, keyed by
+    type, e.g. /all/opendns.com
+
+    The lookups run at the same time and cached answers are reused. Each
+    type waits at most its own timeout, so a slow one is reported as timed
+    out without holding up the rest. Its upstream query carries on in the
+    background and still fills the cache.
+    """
+
+    def get(self, domain):
+        t1 = time.time()
+        with phase('validate'):
+            if not is_valid_hostname(domain):
+                abort(400, message="The provided domain name is invalid")
+        config = current_app.config
+        rdtypes = config['SUPPORTED_RDTYPES']
+        current_app.logger.info('All records request from %s',
+                                request.remote_addr)
+
+        with phase('cache'):
+            answer_cache.warm([(domain, rdtype) for rdtype in rdtypes])
+        app = current_app._get_current_object()
+        timer = current_timer()
+        deadline = g.get('deadline')
+
+        def resolve_type(rdtype):
+            with app.app_context():
+                g.timer = timer
+                g.deadline = deadline
+                result, code = lookup(
+                    domain, rdtype, t1,
+                    "No nameservers found for provided domain")
+                return result, code, g.get('max_age')
+
+        executor = ThreadPoolExecutor(max_workers=len(rdtypes))
+        futures = [(rdtype, executor.submit(resolve_type, rdtype))
+                   for rdtype in rdtypes]
+        # Don't wait for the lookups that time out
+        executor.shutdown(wait=False)
+
+        items = []
+        max_ages = []
+        for rdtype, future in futures:
+            timeout = config['ALL_RECORDS_TIMEOUTS'].get(
+                rdtype, config['ALL_RECORDS_TIMEOUT'])
+            try:
+                result, code, max_age = future.result(
+                    max(t1 + timeout - time.time(), 0))
+            except FutureTimeout:
+                result, code, max_age = (
+                    {'message': 'The lookup timed out.'}, 503, None)
+            if code != 200:
+                result = dict(result, status=code)
+            if not isinstance(result, bytes):
+                result = json.dumps(result).encode('utf-8')
+            items.append(b'"' + rdtype.encode('ascii') + b'": ' + result)
+            max_ages.append(max_age)
+
+        # The response is only as fresh as its shortest lived answer
+        ttl = None
+        if None not in max_ages:
+            ttl = min(max_ages)
+        with phase('encode'):
+            return Response(b'{' + b', '.join(items) + b'}\n',
+                            mimetype='application/json',
+                            headers={'Cache-Control': cache_control(ttl)})
+
+
+class DnsQuery(Resource):
+    """DNS-over-HTTPS (RFC 8484). Takes a wire format query, base64url
+    encoded in the dns parameter of a GET or as the body of a POST, and
+    returns the upstream response bytes as they came. Only the message ID
+    is rewritten, the response is never parsed into objects or JSON.
+    """
+
+    def get(self):
+        dns_param = request.args.get('dns')
+        if not dns_param:
+            abort(400, message="The dns parameter is required")
+        try:
+            # RFC 8484 leaves out the base64 padding
+            wire = base64.urlsafe_b64decode(
+                dns_param.encode('ascii') + b'=' * (-len(dns_param) % 4))
+        except (binascii.Error, UnicodeEncodeError):
+            abort(400, message="The dns parameter is not valid base64url")
+        return self.resolve(wire)
+
+    def post(self):
+        if request.mimetype != DNS_MESSAGE:
+            abort(415, message="The request body must be %s" % DNS_MESSAGE)
+        return self.resolve(request.get_data())
+
+    def resolve(self, wire):
+        config = current_app.config
+        try:
+            with phase('validate'):
+                check_query(wire)
+        except FormError:
+            abort(400, message="The provided DNS message is invalid")
+        current_app.logger.info('DNS message from %s', request.remote_addr)
+
+        if not admission.acquire(g.get('queued')):
+            return json_response(*overloaded())
+        tracker = health_tracker if config['HEALTH_TRACKING'] else None
+        try:
+            response, nameserver = forward(
+                wire, config['RESOLVERS'], resolver_pool.port,
+                resolver_pool.lifetime, tracker, current_timer(),
+                g.get('deadline'), resolver_pool.tcp_pool)
+        except Timeout as e:
+            g.error_cause = 'timeout'
+            current_app.logger.info(e)
+            abort(503, message='All nameservers timed out.')
+        except (OSError, FormError) as e:
+            g.error_cause = 'unexpected'
+            current_app.logger.error(e)
+            abort(500, message='An unexpected error occured.')
+        finally:
+            admission.release()
+
+        try:
+            ttl = min_ttl(response)
+        except FormError:
+            ttl = None
+        return Response(response, 200, mimetype=DNS_MESSAGE,
+                        headers={'Cache-Control': cache_control(ttl)})
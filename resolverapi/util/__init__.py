@@ -46,5 +46,17 @@ def is_valid_ip(ip):
     return is_valid_ipv4_address(ip) or is_valid_ipv6_address(ip)
 
 
+def parse_timeout(value):
+    """Seconds a client is willing to wait, from the timeout parameter or
+    the X-Timeout header. None if it is not a positive number."""
+    try:
+        seconds = float(value)
+    except ValueError:
+        return None
+    if not 0 < seconds < float('inf'):
+        return None
+    return seconds
+
+
 def is_valid_rdtype(rdtype):
     return rdtype in current_app.config['SUPPORTED_RDTYPES']
@@ -0,0 +1,95 @@
+import threading
+from collections import OrderedDict
+
+from resolverapi.util.ratelimit import TokenBucket
+
+
+def queue_time(header, now):
+    """Seconds a request waited before a worker picked it up, from the
+    X-Request-Start header nginx adds ("t=<epoch seconds>"). None when the
+    header is missing or malformed."""
+    if not header:
+        return None
+    try:
+        started = float(header[2:] if header.startswith('t=') else header)
+    except ValueError:
+        return None
+    return max(now - started, 0)
+
+
+class Admission(object):
+    """Decides which requests a worker takes on when it is overloaded.
+
+    Each client address gets a token bucket of client_rate requests per
+    second, with bursts of up to client_burst. Buckets are kept for the
+    max_clients most recently seen clients.
+
+    Lookups that have to go upstream take one of max_in_flight slots for
+    as long as they wait on it, and are shed when there is none left or
+    when their request already queued longer than max_queue_time. Cache
+    hits never take a slot, so they are still served when upstream bound
+    lookups are shed. None disables a limit.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.configure()
+
+    def configure(self, max_in_flight=None, max_queue_time=None,
+                  client_rate=None, client_burst=None, max_clients=10000):
+        with self.lock:
+            self.max_in_flight = max_in_flight
+            self.max_queue_time = max_queue_time
+            self.client_rate = client_rate
+            self.client_burst = client_burst
+            self.max_clients = max_clients
+            self.buckets = OrderedDict()
+            self.in_flight = 0
+            self.shed = 0
+            self.rate_limited = 0
+
+    def admit_client(self, client):
+        """Seconds the client has to wait before it may make another
+        request, 0 if it may go ahead now"""
+        if not self.client_rate:
+            return 0
+        with self.lock:
+            bucket = self.buckets.pop(client, None)
+            if bucket is None:
+                bucket = TokenBucket(self.client_rate, self.client_burst)
+            self.buckets[client] = bucket
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        if bucket.consume():
+            return 0
+        with self.lock:
+            self.rate_limited += 1
+        return bucket.delay()
+
+    def acquire(self, queued=None):
+        """Take a slot for an upstream lookup, returning False if it should
+        be shed. Every successful acquire must be followed by release()."""
+        with self.lock:
+            if (self.max_queue_time is not None and queued is not None and
+                    queued > self.max_queue_time):
+                self.shed += 1
+                return False
+            if (self.max_in_flight is not None and
+                    self.in_flight >= self.max_in_flight):
+                self.shed += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'in_flight': self.in_flight,
+                'shed': self.shed,
+                'rate_limited': self.rate_limited,
+                'clients': len(self.buckets)
+            }
@@ -0,0 +1,187 @@
+"""Non-blocking DNS client for the asyncio serving path. Queries go out over
+UDP on the event loop and are retried over TCP when the answer is truncated,
+so a single process can keep thousands of lookups in flight."""
+import asyncio
+import struct
+import time
+
+import dns.message
+from dns import flags, rcode, rdataclass, rdatatype
+from dns.name import Name, from_unicode
+from dns.exception import Timeout
+from dns.resolver import Answer, NXDOMAIN, NoNameservers
+
+from resolverapi.util.metrics import metrics
+from resolverapi.util.upstream import rtt_window
+
+
+class DatagramProtocol(asyncio.DatagramProtocol):
+    """Resolves future with the first datagram that answers query"""
+
+    def __init__(self, query, future):
+        self.query = query
+        self.future = future
+
+    def datagram_received(self, data, addr):
+        try:
+            response = dns.message.from_wire(data)
+        except Exception:
+            return  # not a DNS message, keep waiting
+        if self.query.is_response(response) and not self.future.done():
+            self.future.set_result(response)
+
+    def error_received(self, exc):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+async def udp_query(query, nameserver, port):
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: DatagramProtocol(query, future),
+        remote_addr=(nameserver, port))
+    try:
+        transport.sendto(query.to_wire())
+        return await future
+    finally:
+        transport.close()
+
+
+async def tcp_query(query, nameserver, port):
+    reader, writer = await asyncio.open_connection(nameserver, port)
+    try:
+        wire = query.to_wire()
+        writer.write(struct.pack('!H', len(wire)) + wire)
+        await writer.drain()
+        (length,) = struct.unpack('!H', await reader.readexactly(2))
+        return dns.message.from_wire(await reader.readexactly(length))
+    finally:
+        writer.close()
+
+
+async def exchange(query, nameserver, port, lifetime):
+    """Send query over UDP, falling back to TCP if the answer has the TC bit
+    set. Raises Timeout if no answer arrives within lifetime seconds."""
+    deadline = time.time() + lifetime
+    try:
+        response = await asyncio.wait_for(
+            udp_query(query, nameserver, port), lifetime)
+        if response.flags & flags.TC:
+            metrics.inc('openresolve_upstream_truncated_total',
+                        {'nameserver': nameserver})
+            response = await asyncio.wait_for(
+                tcp_query(query, nameserver, port), deadline - time.time())
+    except asyncio.TimeoutError:
+        raise Timeout(timeout=lifetime)
+    return response
+
+
+async def query_nameserver(nameserver, qname, rdtype, port=53, lifetime=3.0,
+                           tracker=None, payload=0):
+    """The asyncio counterpart of Resolver.query against one nameserver,
+    raising the same exceptions and returning a dns.resolver.Answer. A
+    payload advertises that EDNS0 UDP payload size."""
+    if not isinstance(qname, Name):
+        qname = from_unicode(qname)
+    if not isinstance(rdtype, int):
+        rdtype = rdatatype.from_text(rdtype)
+    query = dns.message.make_query(qname, rdtype)
+    if payload:
+        query.use_edns(0, 0, payload)
+    t1 = time.time()
+    try:
+        response = await exchange(query, nameserver, port, lifetime)
+    except Timeout:
+        metrics.record_upstream(nameserver, 'timeout')
+        if tracker is not None:
+            tracker.record_timeout(nameserver)
+        raise
+    except Exception:
+        metrics.record_upstream(nameserver, 'error')
+        if tracker is not None:
+            tracker.record_error(nameserver)
+        raise
+    rtt = time.time() - t1
+    rtt_window.add(rtt)
+    if response.rcode() not in (rcode.NOERROR, rcode.NXDOMAIN):
+        metrics.record_upstream(nameserver, 'error')
+        if tracker is not None:
+            tracker.record_error(nameserver)
+        raise NoNameservers()
+    metrics.record_upstream(nameserver, 'success', rtt)
+    if tracker is not None:
+        tracker.record_success(nameserver, rtt)
+    if response.rcode() == rcode.NXDOMAIN:
+        raise NXDOMAIN(qnames=[qname], responses={qname: response})
+    return Answer(qname, rdtype, rdataclass.IN, response,
+                  raise_on_no_answer=False)
+
+
+# Tasks no request waits for, such as the probes of nameservers coming out
+# of backoff
+background = set()
+
+
+def in_background(awaitable):
+    """Run a task that may be left unawaited, holding on to it until it is
+    done and retrieving its exception so none is reported as unhandled"""
+    task = asyncio.ensure_future(awaitable)
+    background.add(task)
+    task.add_done_callback(background_done)
+    return task
+
+
+def background_done(task):
+    background.discard(task)
+    if not task.cancelled():
+        task.exception()
+
+
+async def resolve(nameservers, qname, rdtype, port=53, lifetime=3.0,
+                  delay=None, tracker=None, payload=0):
+    """Same contract as upstream.resolve: returns (answer, nameserver), tries
+    the nameservers in turn, or hedges them every delay seconds."""
+    if tracker is not None:
+        probes = []
+        nameservers = tracker.order(nameservers, probes)
+        for nameserver in probes:
+            in_background(query_nameserver(
+                nameserver, qname, rdtype, port, lifetime, tracker, payload))
+    if delay is None:
+        for nameserver in nameservers:
+            try:
+                answer = await query_nameserver(
+                    nameserver, qname, rdtype, port, lifetime, tracker,
+                    payload)
+                return answer, nameserver
+            except Timeout:
+                # Communication fail or timeout - try next nameserver
+                if nameserver is nameservers[-1]:
+                    raise
+        return None, None
+
+    remaining = list(nameservers)
+    pending = {}
+    error = None
+    try:
+        while remaining or pending:
+            if remaining:
+                nameserver = remaining.pop(0)
+                task = asyncio.ensure_future(query_nameserver(
+                    nameserver, qname, rdtype, port, lifetime, tracker,
+                    payload))
+                pending[task] = nameserver
+            done, _ = await asyncio.wait(
+                list(pending), timeout=delay if remaining else None,
+                return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                nameserver = pending.pop(task)
+                try:
+                    return task.result(), nameserver
+                except Timeout as e:
+                    error = e
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
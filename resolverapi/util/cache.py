@@ -0,0 +1,404 @@
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+import dns.message
+from dns import rdataclass, rdatatype
+from dns.name import Name, from_text, from_unicode
+from dns.resolver import Answer
+
+from resolverapi.util.metrics import metrics
+
+
+# Memory held by a cached answer, measured with tracemalloc for answers of
+# 1 to 16 records of A, AAAA, MX and TXT: the CacheEntry, Answer and Message
+# objects, and the dnspython objects built for every RRset and record, on
+# top of one and a half times the wire size. Rounded up so the estimate
+# stays above what is really used.
+ENTRY_OVERHEAD = 2048
+RRSET_OVERHEAD = 512
+RDATA_OVERHEAD = 288
+# stored, expires, nxdomain, rdtype, rdclass, qname and nameserver lengths
+ENTRY_HEADER = struct.Struct('<dd?HHHB')
+
+
+def make_key(qname, rdtype, rdclass=rdataclass.IN):
+    """Normalize a question into a hashable cache key. Names are compared
+    case-insensitively, so 'OpenDNS.com' and 'opendns.com.' share an entry.
+    """
+    if not isinstance(qname, Name):
+        qname = from_unicode(qname)
+    if not isinstance(rdtype, int):
+        rdtype = rdatatype.from_text(rdtype)
+    return qname.to_text().lower(), rdtype, rdclass
+
+
+def key_bytes(key):
+    """Flatten a cache key into bytes for stores outside this process"""
+    qname, rdtype, rdclass = key
+    return ('%s|%d|%d' % (qname, rdtype, rdclass)).encode('utf-8')
+
+
+def negative_ttl(response, default):
+    """RFC 2308: a negative answer may be cached for the lesser of the SOA
+    record's TTL and its MINIMUM field. Without an SOA use the default."""
+    if response is not None:
+        for rrset in response.authority:
+            if rrset.rdtype == rdatatype.SOA and len(rrset):
+                return min(rrset.ttl, rrset[0].minimum)
+    return default
+
+
+def answer_ttl(answer, default):
+    """The lifetime of a positive answer is its smallest RRset TTL. Answers
+    without any RRsets (NODATA) are cached negatively."""
+    ttls = [rrset.ttl for rrset in answer.response.answer]
+    if ttls:
+        return min(ttls)
+    return negative_ttl(answer.response, default)
+
+
+def estimate_size(response, wire_length=None):
+    """Approximate the memory held by a cached response, from its wire size
+    and the number of RRsets and records it holds."""
+    if wire_length is None:
+        try:
+            wire_length = len(response.to_wire())
+        except Exception:
+            wire_length = 512
+    rrsets = response.answer + response.authority + response.additional
+    return (ENTRY_OVERHEAD + RRSET_OVERHEAD * len(rrsets) +
+            RDATA_OVERHEAD * sum(len(rrset) for rrset in rrsets) +
+            wire_length * 3 // 2)
+
+
+class CacheEntry(object):
+    """An upstream answer (or NXDOMAIN) and the window it is valid for."""
+    __slots__ = ('answer', 'nameserver', 'nxdomain', 'stored', 'expires',
+                 'size', 'hits', 'retry_after', 'body')
+
+    def __init__(self, answer, nameserver, nxdomain, stored, expires, size):
+        self.answer = answer
+        self.nameserver = nameserver
+        self.nxdomain = nxdomain
+        self.stored = stored
+        self.expires = expires
+        self.size = size
+        self.hits = 0
+        # While stale: don't ask upstream again before this time
+        self.retry_after = 0
+        # EncodedResponse for the answer, built on the first hit
+        self.body = None
+
+    def age(self, now=None):
+        """Whole seconds since the entry was stored, used to decrement TTLs"""
+        if now is None:
+            now = time.time()
+        return int(now - self.stored)
+
+    def ttl(self, now=None):
+        if now is None:
+            now = time.time()
+        return max(int(self.expires - now), 0)
+
+
+def pack_entry(entry):
+    """Serialize a CacheEntry to bytes, with the answer in wire format, so
+    it can be shared with other processes or written to disk."""
+    qname, rdtype, rdclass, wire = b'', 0, 0, b''
+    if entry.answer is not None:
+        qname = entry.answer.qname.to_text().encode('utf-8')
+        rdtype = entry.answer.rdtype
+        rdclass = entry.answer.rdclass
+        wire = entry.answer.response.to_wire()
+    nameserver = (entry.nameserver or '').encode('utf-8')
+    header = ENTRY_HEADER.pack(entry.stored, entry.expires, entry.nxdomain,
+                               rdtype, rdclass, len(qname), len(nameserver))
+    return header + qname + nameserver + wire
+
+
+def unpack_entry(data):
+    """Rebuild a CacheEntry from the output of pack_entry"""
+    (stored, expires, nxdomain, rdtype, rdclass, qname_len,
+     nameserver_len) = ENTRY_HEADER.unpack_from(data)
+    offset = ENTRY_HEADER.size
+    qname = bytes(data[offset:offset + qname_len]).decode('utf-8')
+    offset += qname_len
+    nameserver = bytes(data[offset:offset + nameserver_len]).decode('utf-8')
+    offset += nameserver_len
+    answer = None
+    size = ENTRY_OVERHEAD
+    if not nxdomain:
+        wire = bytes(data[offset:])
+        response = dns.message.from_wire(wire)
+        answer = Answer(from_text(qname), rdtype, rdclass, response,
+                        raise_on_no_answer=False)
+        size = estimate_size(response, len(wire))
+    return CacheEntry(answer, nameserver or None, nxdomain, stored, expires,
+                      size)
+
+
+class MemoryStore(object):
+    """Bounded LRU of CacheEntry objects private to this process."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def touch(self, key, entry):
+        """Record a cache hit on entry"""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            entry.hits += 1
+
+    def put(self, key, entry):
+        if entry.size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def attach(self, key, entry, body):
+        """Keep an entry's encoded body with it, counting its memory"""
+        size = body.size()
+        with self.lock:
+            if entry.body is not None:
+                return
+            entry.body = body
+            entry.size += size
+            if self.entries.get(key) is entry:
+                self.size += size
+                while self.size > self.max_bytes:
+                    self._remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def set_retry_after(self, key, retry_after):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry.retry_after = retry_after
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size}
+
+    def dump(self):
+        """Yield (key bytes, expires, packed entry) for every entry"""
+        with self.lock:
+            entries = list(self.entries.items())
+        for key, entry in entries:
+            yield key_bytes(key), entry.expires, pack_entry(entry)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.size -= entry.size
+
+
+class AnswerCache(object):
+    """Cache of upstream answers keyed on (qname, rdtype, class).
+
+    Entries expire with the smallest TTL of the answer they hold. NXDOMAIN
+    and NODATA answers are cached using the SOA minimum. Entries are held by
+    a store, by default a MemoryStore that evicts the least recently used
+    entries once their estimated size passes max_bytes. A max_bytes of 0
+    disables caching.
+
+    Expired entries are kept for another stale_window seconds, so they can
+    still be served with get_stale() when upstream is unavailable.
+
+    With a remote tier (see remote.py) local misses are looked up there
+    before going upstream, and new entries are written to both.
+
+    With a snapshot (see snapshot.py) local misses are first looked up in
+    the entries saved before the last restart.
+    """
+
+    def __init__(self, max_bytes=0, default_negative_ttl=60, stale_window=0):
+        self.lock = threading.Lock()
+        self.configure(max_bytes, default_negative_ttl, stale_window)
+
+    def configure(self, max_bytes, default_negative_ttl=60, stale_window=0,
+                  store=None, remote=None, snapshot=None):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.default_negative_ttl = default_negative_ttl
+            self.stale_window = stale_window
+            self.store = store if store is not None else MemoryStore(max_bytes)
+            self.remote = remote
+            self.snapshot = snapshot
+            self.hits = 0
+            self.misses = 0
+            self.remote_hits = 0
+            self.snapshot_hits = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, qname, rdtype, rdclass=rdataclass.IN):
+        """Return the live CacheEntry for a question, or None on a miss."""
+        if not self.enabled:
+            return None
+        key = make_key(qname, rdtype, rdclass)
+        now = time.time()
+        entry = self.store.get(key)
+        if entry is None:
+            entry = self._from_snapshot(key, now)
+        if entry is not None and entry.expires <= now:
+            if entry.expires + self.stale_window <= now:
+                self.store.remove(key)
+            entry = None
+        if entry is None and self.remote is not None:
+            entry = self._from_remote([key], now)[0]
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if entry is None:
+            metrics.inc('openresolve_cache_lookups_total', {'result': 'miss'})
+            return None
+        metrics.inc('openresolve_cache_lookups_total', {'result': 'hit'})
+        self.store.touch(key, entry)
+        return entry
+
+    def warm(self, questions):
+        """Copy the live remote entries for a list of (qname, rdtype)
+        questions missing here into this cache, in one round trip."""
+        if not self.enabled or self.remote is None:
+            return
+        now = time.time()
+        keys = []
+        for qname, rdtype in questions:
+            key = make_key(qname, rdtype)
+            entry = self.store.get(key)
+            if (entry is None or entry.expires <= now) and key not in keys:
+                keys.append(key)
+        self._from_remote(keys, now)
+
+    def _from_remote(self, keys, now):
+        entries = self.remote.get_many(keys)
+        for i, key in enumerate(keys):
+            entry = entries[i]
+            if entry is None or entry.expires <= now:
+                entries[i] = None
+                continue
+            self.store.put(key, entry)
+            with self.lock:
+                self.remote_hits += 1
+        return entries
+
+    def _from_snapshot(self, key, now):
+        """Copy an entry from the snapshot into the store, if it is live or
+        still within the stale window"""
+        if self.snapshot is None:
+            return None
+        entry = self.snapshot.get(key)
+        if entry is None or entry.expires + self.stale_window <= now:
+            return None
+        self.store.put(key, entry)
+        with self.lock:
+            self.snapshot_hits += 1
+        return entry
+
+    def get_stale(self, qname, rdtype, rdclass=rdataclass.IN):
+        """Return an expired entry that is still within the stale window"""
+        if not self.enabled or not self.stale_window:
+            return None
+        key = make_key(qname, rdtype, rdclass)
+        now = time.time()
+        entry = self.store.get(key)
+        if entry is None:
+            entry = self._from_snapshot(key, now)
+        if entry is None or entry.expires > now:
+            return None
+        if entry.expires + self.stale_window <= now:
+            self.store.remove(key)
+            return None
+        return entry
+
+    def attach_body(self, entry, body):
+        """Keep the EncodedResponse of a cached answer with the entry, so
+        later hits reuse it. It counts towards max_bytes."""
+        answer = entry.answer
+        self.store.attach(make_key(answer.qname, answer.rdtype,
+                                   answer.rdclass), entry, body)
+
+    def retry_later(self, qname, rdtype, retry_after, rdclass=rdataclass.IN):
+        """Don't ask upstream for a stale entry again before retry_after"""
+        self.store.set_retry_after(make_key(qname, rdtype, rdclass),
+                                   retry_after)
+
+    def put(self, qname, rdtype, answer, nameserver, rdclass=rdataclass.IN):
+        """Cache a positive or NODATA answer for as long as its TTL allows."""
+        ttl = answer_ttl(answer, self.default_negative_ttl)
+        self._store(make_key(qname, rdtype, rdclass), answer, nameserver,
+                    False, ttl, estimate_size(answer.response))
+
+    def put_nxdomain(self, qname, rdtype, response=None,
+                     rdclass=rdataclass.IN):
+        """Cache a non-existent domain. The upstream response is optional since
+        older dnspython versions do not attach it to the NXDOMAIN exception."""
+        ttl = negative_ttl(response, self.default_negative_ttl)
+        size = ENTRY_OVERHEAD
+        if response is not None:
+            size = estimate_size(response)
+        self._store(make_key(qname, rdtype, rdclass), None, None, True, ttl,
+                    size)
+
+    def clear(self):
+        self.store.clear()
+
+    def stats(self):
+        stats = self.store.stats()
+        with self.lock:
+            stats.update({
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            })
+            if self.remote is not None:
+                stats['remote_hits'] = self.remote_hits
+            if self.snapshot is not None:
+                stats['snapshot_hits'] = self.snapshot_hits
+        if self.remote is not None:
+            stats['remote'] = self.remote.stats()
+        return stats
+
+    def _store(self, key, answer, nameserver, nxdomain, ttl, size):
+        if not self.enabled or ttl <= 0:
+            return
+        now = time.time()
+        entry = CacheEntry(answer, nameserver, nxdomain, now, now + ttl, size)
+        self.store.put(key, entry)
+        if self.remote is not None:
+            self.remote.put(key, pack_entry(entry), ttl + self.stale_window)
+
+
+def nxdomain_response(exc):
+    """Dig the upstream response out of an NXDOMAIN exception, if present."""
+    responses = getattr(exc, 'kwargs', {}).get('responses') or {}
+    for response in responses.values():
+        return response
+    return None
@@ -1,26 +1,52 @@
+import hashlib
+import json
+import re
+
 from dns import rdatatype, rdataclass, flags, rcode
 
 
-def parse_query(query, nameserver, duration):
+# Stand-ins for the fields EncodedResponse fills in when rendering. JSON
+# escapes the NUL characters, which never occur in presentation format.
+DURATION_MARK = '\x00duration\x00'
+TTL_MARK = '\x00ttl\x00'
+MARKS = re.compile(r'"\\u0000(?:duration|ttl)\\u0000"')
+# Memory held by an EncodedResponse besides one and a half times its bytes,
+# measured with tracemalloc like cache.ENTRY_OVERHEAD
+BODY_OVERHEAD = 384
+BODY_TTL_OVERHEAD = 96
+
+
+def parse_query(query, nameserver, duration, age=0, stale_ttl=None):
     """ Parse a dns response into a dict based on record type.
     Should adhere to propsed rfc format:
     http://tools.ietf.org/html/draft-bortzmeyer-dns-json-00
+
+    age is the number of seconds the answer has spent in the cache, it is
+    subtracted from every TTL. An expired answer served because upstream is
+    unavailable is flagged as Stale and all of its TTLs are set to
+    stale_ttl (RFC 8767).
     """
-    flag_list = flags.to_text(query.response.flags)
-    return {
+    response = query.response
+    header_flags = response.flags
+    parsed = {
         'Query': get_query(nameserver, duration),
         'QuestionSection': get_question(query),
-        'AnswerSection': get_rrs_from_rrsets(query.response.answer),
-        'AdditionalSection': get_rrs_from_rrsets(query.response.additional),
-        'AuthoritySection': get_rrs_from_rrsets(query.response.authority),
-        'ReturnCode': rcode.to_text(query.response.rcode()),
-        'ID': query.response.id,
-        'AA': 'AA' in flag_list,
-        'TC': 'TC' in flag_list,
-        'RD': 'RD' in flag_list,
-        'RA': 'RA' in flag_list,
-        'AD': 'AD' in flag_list
+        'AnswerSection': get_rrs_from_rrsets(response.answer, age, stale_ttl),
+        'AdditionalSection': get_rrs_from_rrsets(
+            response.additional, age, stale_ttl),
+        'AuthoritySection': get_rrs_from_rrsets(
+            response.authority, age, stale_ttl),
+        'ReturnCode': rcode.to_text(response.rcode()),
+        'ID': response.id,
+        'AA': bool(header_flags & flags.AA),
+        'TC': bool(header_flags & flags.TC),
+        'RD': bool(header_flags & flags.RD),
+        'RA': bool(header_flags & flags.RA),
+        'AD': bool(header_flags & flags.AD)
     }
+    if stale_ttl is not None:
+        parsed['Stale'] = True
+    return parsed
 
 
 def get_query(nameserver, duration):
@@ -38,19 +64,23 @@ def get_question(query):
     }
 
 
-def get_rrs_from_rrsets(rrsets):
-    """This works for answer, authority, and additional rrsets"""
+def get_rrs_from_rrsets(rrsets, age=0, fixed_ttl=None):
+    """This works for answer, authority, and additional rrsets. TTLs are
+    decreased by age, or all replaced by fixed_ttl when it is given."""
     rr_list = []
     for rrset in rrsets:
         common_rr_dict = {
             "Name":  str(rrset.name),
             "Type": rdatatype.to_text(rrset.rdtype),
             "Class": rdataclass.to_text(rrset.rdclass),
-            "TTL": rrset.ttl  # TODO: doesn't each rr have it's own ttl?
+            # TODO: doesn't each rr have it's own ttl?
+            "TTL": (fixed_ttl if fixed_ttl is not None
+                    else max(rrset.ttl - age, 0))
         }
+        fields = RECORD_FIELDS.get(rrset.rdtype, no_fields)
         for rr in rrset:
             rr_dict = common_rr_dict.copy()
-            rr_dict.update(get_record_specific_answer_fields(rr))
+            rr_dict.update(fields(rr))
             rr_list.append(rr_dict)
     return rr_list
 
@@ -60,52 +90,134 @@ def get_record_specific_answer_fields(rr):
     given dns answer.
     E.g. 'A' records have an 'address' field. 'NS' hava a 'target' field etc.
     """
-    if rr.rdtype == rdatatype.A or rr.rdtype == rdatatype.AAAA:
-        return {"Address": rr.address}
-
-    if (rr.rdtype == rdatatype.CNAME or
-            rr.rdtype == rdatatype.PTR or
-            rr.rdtype == rdatatype.NS):
-        return {"Target": str(rr.target)}
-
-    if rr.rdtype == rdatatype.MX:
-        return {
-            "Preference": rr.preference,
-            "MailExchanger": str(rr.exchange)
-        }
+    return RECORD_FIELDS.get(rr.rdtype, no_fields)(rr)
 
-    if rr.rdtype == rdatatype.SOA:
-        return {
-            "MasterServerName": str(rr.mname),
-            "MaintainerName": str(rr.rname),
-            "Serial": rr.serial,
-            "Refresh": rr.refresh,
-            "Retry": rr.retry,
-            "Expire": rr.expire,
-            "NegativeTtl": rr.minimum  # Note: keyname changes in JSON RFC
-        }
 
-    if rr.rdtype == rdatatype.TXT:
-        # TXT was not described in the JSON RFC
-        return {
-            "TxtData": str(rr),
-        }
+def address_fields(rr):
+    return {"Address": rr.address}
 
-    if rr.rdtype == rdatatype.NAPTR:
-        return {
-            "Flags": rr.flags,
-            "Order": rr.order,
-            "Service": rr.service,
-            "Preference": rr.preference,
-            "Regexp": rr.regexp,
-            "Replacement": str(rr.replacement)
-        }
 
-    if rr.rdtype == rdatatype.LOC:
-        return {
-            "Altitude": rr.altitude / 100,  # .altitude is in centimeters
-            "Longitude": rr.longitude,
-            "Latitude": rr.latitude
-        }
+def target_fields(rr):
+    return {"Target": str(rr.target)}
+
+
+def mx_fields(rr):
+    return {
+        "Preference": rr.preference,
+        "MailExchanger": str(rr.exchange)
+    }
+
 
+def soa_fields(rr):
+    return {
+        "MasterServerName": str(rr.mname),
+        "MaintainerName": str(rr.rname),
+        "Serial": rr.serial,
+        "Refresh": rr.refresh,
+        "Retry": rr.retry,
+        "Expire": rr.expire,
+        "NegativeTtl": rr.minimum  # Note: keyname changes in JSON RFC
+    }
+
+
+def txt_fields(rr):
+    # TXT was not described in the JSON RFC
+    return {
+        "TxtData": str(rr),
+    }
+
+
+def naptr_fields(rr):
+    return {
+        "Flags": rr.flags,
+        "Order": rr.order,
+        "Service": rr.service,
+        "Preference": rr.preference,
+        "Regexp": rr.regexp,
+        "Replacement": str(rr.replacement)
+    }
+
+
+def loc_fields(rr):
+    return {
+        "Altitude": rr.altitude / 100,  # .altitude is in centimeters
+        "Longitude": rr.longitude,
+        "Latitude": rr.latitude
+    }
+
+
+def no_fields(rr):
     return {}
+
+
+# Record type specific fields, by rdtype
+RECORD_FIELDS = {
+    rdatatype.A: address_fields,
+    rdatatype.AAAA: address_fields,
+    rdatatype.CNAME: target_fields,
+    rdatatype.PTR: target_fields,
+    rdatatype.NS: target_fields,
+    rdatatype.MX: mx_fields,
+    rdatatype.SOA: soa_fields,
+    rdatatype.TXT: txt_fields,
+    rdatatype.NAPTR: naptr_fields,
+    rdatatype.LOC: loc_fields
+}
+
+
+def answer_etag(query):
+    """Hash of the question, return code and records of an answer. TTLs,
+    the message ID and the order of records in an RRset are left out, so
+    the hash stays the same for as long as the data does."""
+    response = query.response
+    records = sorted(
+        '%s %d %d %s' % (rrset.name, rrset.rdclass, rrset.rdtype,
+                         rdata.to_text())
+        for section in (response.answer, response.authority,
+                        response.additional)
+        for rrset in section for rdata in rrset)
+    data = '\n'.join(['%s %d %d' % (query.qname, query.rdtype,
+                                     response.rcode())] + records)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class EncodedResponse(object):
+    """The parse_query JSON for an answer, encoded once so cache hits only
+    have to patch in the duration and the TTLs."""
+    __slots__ = ('parts', 'ttls', 'etag')
+
+    def __init__(self, query, nameserver):
+        response = query.response
+        body = json.dumps(parse_query(query, nameserver, DURATION_MARK,
+                                      stale_ttl=TTL_MARK))
+        # Drop the Stale flag, render() adds it back when needed
+        body = body[:body.rindex(', "Stale"')] + '}'
+        self.parts = [part.encode('utf-8') for part in MARKS.split(body)]
+        # Query comes first, then the sections in the order parse_query
+        # lists them
+        self.ttls = [rrset.ttl
+                     for section in (response.answer, response.additional,
+                                     response.authority)
+                     for rrset in section for _ in rrset]
+        self.etag = answer_etag(query)
+
+    def size(self):
+        """Approximate memory held, for the answer cache's accounting"""
+        return (BODY_OVERHEAD + BODY_TTL_OVERHEAD * len(self.ttls) +
+                sum(len(part) for part in self.parts) * 3 // 2)
+
+    def render(self, duration, age=0, stale_ttl=None):
+        """The same bytes as encoding parse_query(query, nameserver,
+        duration, age, stale_ttl)"""
+        parts = self.parts
+        chunks = [parts[0], json.dumps(duration).encode('ascii'), parts[1]]
+        for i, ttl in enumerate(self.ttls):
+            if stale_ttl is not None:
+                ttl = stale_ttl
+            else:
+                ttl = max(ttl - age, 0)
+            chunks.append(b'%d' % ttl)
+            chunks.append(parts[i + 2])
+        if stale_ttl is not None:
+            chunks[-1] = chunks[-1][:-1] + b', "Stale": true}'
+        return b''.join(chunks)
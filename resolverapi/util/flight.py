@@ -0,0 +1,221 @@
+import base64
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import dns.message
+from dns import rdataclass
+from dns.name import from_text
+from dns.exception import Timeout
+from dns.resolver import Answer, NXDOMAIN
+
+from resolverapi.util.cache import nxdomain_response
+
+
+# Appended to a lock file by a process waiting for the holder's answer,
+# and what the holder's answer starts with
+WAITING = b'.'
+ANSWER = b'\n'
+
+# Runs the shared query when its first caller has a deadline, so it can
+# carry on for the other callers once that caller stops waiting
+executor = ThreadPoolExecutor(max_workers=32)
+
+
+class Call(object):
+    """An upstream query in progress that other callers can wait on"""
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesces identical lookups that are in flight at the same time.
+
+    The first caller for a key runs the query, later callers with the same
+    key wait for it and get the same result or exception. When a HostFlight
+    is attached the first caller also coalesces with the other worker
+    processes on the host.
+
+    The query itself should not depend on any caller's deadline. Each
+    caller, the first included, waits for it until its own deadline and
+    then raises Timeout, while the query carries on for the rest.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.configure()
+
+    def configure(self, enabled=True, shared=None):
+        with self.lock:
+            self.enabled = enabled
+            self.shared = shared
+            self.calls = {}
+            self.leaders = 0
+            self.coalesced = 0
+
+    def do(self, key, fn, *args, deadline=None):
+        """Run fn(*args), or wait for the identical call in flight. deadline
+        is the time.time() by which this caller gives up."""
+        if not self.enabled:
+            return fn(*args)
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        if leader:
+            if deadline is None:
+                self.lead(call, key, fn, args)
+            else:
+                executor.submit(self.lead, call, key, fn, args)
+
+        if deadline is None:
+            call.event.wait()
+        elif not call.event.wait(max(deadline - time.time(), 0)):
+            raise Timeout(timeout=0)
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def lead(self, call, key, fn, args):
+        try:
+            if self.shared is not None:
+                call.result = self.shared.do(key, fn, *args)
+            else:
+                call.result = fn(*args)
+        except Exception as e:
+            call.error = e
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+
+    def stats(self):
+        stats = {'leaders': self.leaders, 'coalesced': self.coalesced}
+        if self.shared is not None:
+            stats['shared'] = self.shared.hits
+        return stats
+
+
+class HostFlight(object):
+    """Coalesces lookups across the worker processes on one host.
+
+    Each key in flight has a lock file in directory, which the process
+    querying upstream holds exclusively. A process that finds the lock taken
+    appends a mark to the file and blocks on a shared lock, so all the
+    waiters read at once. The holder then appends the answer, in wire
+    format, behind a newline, but only when the file was marked, so
+    uncontended lookups cost an open and a lock. The file is only ever
+    appended to, so late marks cannot damage the answer. The holder removes
+    the file before releasing the lock; waiters still read it through their
+    open descriptors. If the query failed with anything but NXDOMAIN, or
+    the answer could not be read, waiters query upstream themselves.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def do(self, key, fn, *args):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        path = os.path.join(self.directory, digest + '.lock')
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                # Another worker is resolving this, wait for it to finish
+                os.write(fd, WAITING)
+                fcntl.flock(fd, fcntl.LOCK_SH)
+                shared = self.read(fd)
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                if shared is not None:
+                    self.hits += 1
+                    return self.unpack(shared)
+                return fn(*args)
+            return self.lead(fd, path, key, fn, *args)
+        finally:
+            os.close(fd)
+
+    def lead(self, fd, path, key, fn, *args):
+        try:
+            answer, nameserver = fn(*args)
+        except NXDOMAIN as e:
+            self.write(fd, lambda: {
+                'nxdomain': True,
+                'qname': key[0],
+                'wire': self.encode(nxdomain_response(e))
+            })
+            raise
+        except Exception:
+            self.write(fd, None)
+            raise
+        else:
+            self.write(fd, lambda: {
+                'nxdomain': False,
+                'qname': answer.qname.to_text(),
+                'rdtype': answer.rdtype,
+                'wire': self.encode(answer.response),
+                'nameserver': nameserver
+            })
+        finally:
+            # A file already removed by an earlier holder has been replaced
+            # by another worker's, leave that one alone
+            if os.fstat(fd).st_nlink:
+                os.unlink(path)
+        return answer, nameserver
+
+    def read(self, fd):
+        """Load the result the holder left in the lock file"""
+        try:
+            data = os.pread(fd, os.fstat(fd).st_size, 0)
+            start = data.find(ANSWER)
+            if start < 0:
+                return None
+            # Marks appended after the answer are ignored
+            return json.JSONDecoder().raw_decode(
+                data[start + len(ANSWER):].decode('utf-8'))[0]
+        except (IOError, OSError, ValueError):
+            return None
+
+    def write(self, fd, shared):
+        """Append the result of shared() to the lock file, if anyone is
+        waiting for it. None leaves nothing, so waiters query themselves."""
+        try:
+            if shared is None or not os.fstat(fd).st_size:
+                return
+            os.write(fd, ANSWER + json.dumps(shared()).encode('utf-8'))
+        except (IOError, OSError):
+            pass  # the waiters query upstream themselves
+
+    def encode(self, response):
+        if response is None:
+            return None
+        return base64.b64encode(response.to_wire()).decode('ascii')
+
+    def unpack(self, shared):
+        qname = from_text(shared['qname'])
+        response = None
+        if shared['wire'] is not None:
+            response = dns.message.from_wire(base64.b64decode(shared['wire']))
+        if shared['nxdomain']:
+            if response is None:
+                raise NXDOMAIN()
+            raise NXDOMAIN(qnames=[qname], responses={qname: response})
+        answer = Answer(qname, shared['rdtype'], rdataclass.IN, response,
+                        raise_on_no_answer=False)
+        return answer, shared['nameserver']
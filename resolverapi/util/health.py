@@ -0,0 +1,137 @@
+import threading
+import time
+
+
+# Weight given to the newest sample in the moving averages
+EWMA_ALPHA = 0.3
+
+
+class ServerHealth(object):
+    """Moving averages and circuit breaker state for one nameserver."""
+
+    def __init__(self, nameserver):
+        self.nameserver = nameserver
+        self.rtt = None
+        self.timeout_rate = 0.0
+        self.queries = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.backoff = 0.0
+        self.open_until = None
+
+    def to_dict(self, now):
+        return {
+            'Rtt': self.rtt,
+            'TimeoutRate': self.timeout_rate,
+            'Queries': self.queries,
+            'Timeouts': self.timeouts,
+            'Errors': self.errors,
+            'ConsecutiveFailures': self.consecutive_failures,
+            'CircuitOpen': self.open_until is not None,
+            'RetryIn': max(self.open_until - now, 0) if self.open_until else 0
+        }
+
+
+class HealthTracker(object):
+    """Tracks per-nameserver round trip time and timeout rate so the
+    healthiest servers are tried first.
+
+    After failure_threshold consecutive timeouts a server's circuit opens
+    and it is skipped for backoff seconds. When the backoff expires the next
+    request probes it alongside its own query: success closes the circuit,
+    another timeout doubles the backoff up to max_backoff.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.configure()
+
+    def configure(self, failure_threshold=3, backoff=5.0, max_backoff=300.0,
+                  timeout_penalty=3.0):
+        with self.lock:
+            self.failure_threshold = failure_threshold
+            self.initial_backoff = backoff
+            self.max_backoff = max_backoff
+            # Seconds a timeout costs, used to rank flaky servers
+            self.timeout_penalty = timeout_penalty
+            self.servers = {}
+
+    def _server(self, nameserver):
+        server = self.servers.get(nameserver)
+        if server is None:
+            server = self.servers[nameserver] = ServerHealth(nameserver)
+        return server
+
+    def record_success(self, nameserver, rtt):
+        with self.lock:
+            server = self._server(nameserver)
+            server.queries += 1
+            if server.rtt is None:
+                server.rtt = rtt
+            else:
+                server.rtt += EWMA_ALPHA * (rtt - server.rtt)
+            server.timeout_rate *= 1 - EWMA_ALPHA
+            server.consecutive_failures = 0
+            server.backoff = 0.0
+            server.open_until = None
+
+    def record_error(self, nameserver):
+        """The server responded but could not give an answer (SERVFAIL etc)"""
+        with self.lock:
+            server = self._server(nameserver)
+            server.queries += 1
+            server.errors += 1
+
+    def record_timeout(self, nameserver):
+        with self.lock:
+            server = self._server(nameserver)
+            server.queries += 1
+            server.timeouts += 1
+            server.timeout_rate += EWMA_ALPHA * (1 - server.timeout_rate)
+            server.consecutive_failures += 1
+            if server.consecutive_failures >= self.failure_threshold:
+                if server.backoff:
+                    server.backoff = min(server.backoff * 2, self.max_backoff)
+                else:
+                    server.backoff = self.initial_backoff
+                server.open_until = time.time() + server.backoff
+
+    def score(self, server):
+        """Expected cost in seconds of sending a query to the server"""
+        rtt = server.rtt or 0.0
+        return ((1 - server.timeout_rate) * rtt +
+                server.timeout_rate * self.timeout_penalty)
+
+    def order(self, nameservers, probes=None):
+        """Return the nameservers healthiest first, leaving out those with an
+        open circuit. A server whose backoff has expired is due a probe. It
+        goes after the healthy servers, so no request waits on it, and is
+        added to probes, if given, for the caller to query in the background.
+        It is not handed out again until the next backoff expires. If every
+        circuit is open all servers are returned."""
+        now = time.time()
+        with self.lock:
+            due, healthy, broken = [], [], []
+            for nameserver in nameservers:
+                server = self._server(nameserver)
+                if server.open_until is None:
+                    healthy.append(server)
+                elif server.open_until <= now:
+                    server.open_until = now + server.backoff
+                    due.append(server)
+                else:
+                    broken.append(server)
+            healthy.sort(key=self.score)
+            if healthy and probes is not None:
+                probes.extend(server.nameserver for server in due)
+            ordered = healthy + due
+            if not ordered:
+                ordered = sorted(broken, key=lambda s: s.open_until)
+            return [server.nameserver for server in ordered]
+
+    def stats(self):
+        now = time.time()
+        with self.lock:
+            return dict((nameserver, server.to_dict(now))
+                        for nameserver, server in self.servers.items())
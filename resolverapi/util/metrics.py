@@ -0,0 +1,230 @@
+"""Counters and histograms exposed at /metrics in the Prometheus text format.
+
+Each process keeps its values in memory, or with a directory configured, in
+its own memory-mapped file there. Rendering then sums the files of every
+process, so the totals served by any uwsgi worker cover all of them and do
+not reset when a single worker is recycled.
+"""
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+# name: (type, help, histogram buckets)
+DEFINITIONS = {
+    'openresolve_request_duration_seconds': (
+        'histogram', 'Time taken to answer a request, by route and rdtype',
+        LATENCY_BUCKETS),
+    'openresolve_responses_total': (
+        'counter', 'Responses by route, status code and cause of errors',
+        None),
+    'openresolve_upstream_rtt_seconds': (
+        'histogram', 'Round trip time of answered upstream queries',
+        LATENCY_BUCKETS),
+    'openresolve_upstream_queries_total': (
+        'counter', 'Upstream queries by nameserver and outcome', None),
+    'openresolve_upstream_truncated_total': (
+        'counter', 'Upstream answers truncated over UDP, by nameserver',
+        None),
+    'openresolve_edns_fallbacks_total': (
+        'counter', 'Steps down to a smaller EDNS0 payload size, by nameserver',
+        None),
+    'openresolve_cache_lookups_total': (
+        'counter', 'Answer cache lookups by result', None),
+}
+
+ENTRY_LENGTH = struct.Struct('<I')
+VALUE = struct.Struct('<d')
+# Bytes in use, padded so entries stay 8-byte aligned
+FILE_HEADER = struct.Struct('<I4x')
+
+
+def read_entries(data, used):
+    """Yield (key, value, value offset) for every entry in a values file"""
+    offset = FILE_HEADER.size
+    while offset < used:
+        (length,) = ENTRY_LENGTH.unpack_from(data, offset)
+        key = bytes(data[offset + 4:offset + 4 + length]).decode('utf-8')
+        offset += 4 + length + padding(length)
+        yield key, VALUE.unpack_from(data, offset)[0], offset
+        offset += VALUE.size
+
+
+def padding(length):
+    return (8 - (ENTRY_LENGTH.size + length) % 8) % 8
+
+
+class ValueFile(object):
+    """Float values written by one process to a memory-mapped file that the
+    other processes read. Entries are only ever appended, and the header
+    is updated after an entry is complete, so readers never see a partial
+    one."""
+
+    def __init__(self, path, size=64 * 1024):
+        self.path = path
+        self.f = open(path, 'a+b')
+        self.size = max(os.fstat(self.f.fileno()).st_size, size)
+        self.f.truncate(self.size)
+        self.mm = mmap.mmap(self.f.fileno(), self.size)
+        self.used = FILE_HEADER.unpack_from(self.mm)[0] or FILE_HEADER.size
+        self.positions = dict(
+            (key, offset)
+            for key, _, offset in read_entries(self.mm, self.used))
+
+    def add(self, key, amount):
+        offset = self.positions.get(key)
+        if offset is None:
+            offset = self.append(key)
+        value = VALUE.unpack_from(self.mm, offset)[0]
+        VALUE.pack_into(self.mm, offset, value + amount)
+
+    def append(self, key):
+        data = key.encode('utf-8')
+        entry = (ENTRY_LENGTH.pack(len(data)) + data +
+                 b'\0' * padding(len(data)) + VALUE.pack(0.0))
+        while self.used + len(entry) > self.size:
+            self.size *= 2
+            self.mm.close()
+            self.f.truncate(self.size)
+            self.mm = mmap.mmap(self.f.fileno(), self.size)
+        self.mm[self.used:self.used + len(entry)] = entry
+        offset = self.used + len(entry) - VALUE.size
+        self.used += len(entry)
+        FILE_HEADER.pack_into(self.mm, 0, self.used)
+        self.positions[key] = offset
+        return offset
+
+    def close(self):
+        self.mm.close()
+        self.f.close()
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < FILE_HEADER.size:
+        return {}
+    used = FILE_HEADER.unpack_from(data)[0]
+    return dict((key, value) for key, value, _ in read_entries(data, used))
+
+
+def escape(value):
+    return (value.replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if value == int(value):
+        return '%d' % value
+    return repr(value)
+
+
+class Metrics(object):
+    """Registry of the series in DEFINITIONS"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.configure()
+
+    def configure(self, directory=None):
+        with self.lock:
+            self.directory = directory
+            self.values = {}
+            self.file = None
+            self.pid = None
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+
+    def add(self, sample, labels, amount):
+        key = json.dumps([sample, sorted(labels.items())])
+        with self.lock:
+            if self.directory:
+                self.process_file().add(key, amount)
+            else:
+                self.values[key] = self.values.get(key, 0) + amount
+
+    def process_file(self):
+        if self.pid != os.getpid():
+            # First use in this process, forked workers get their own file
+            self.pid = os.getpid()
+            self.file = ValueFile(os.path.join(
+                self.directory, 'metrics_%d.db' % self.pid))
+        return self.file
+
+    def inc(self, name, labels=None, amount=1):
+        self.add(name, labels or {}, amount)
+
+    def observe(self, name, value, labels=None):
+        labels = labels or {}
+        for bound in DEFINITIONS[name][2]:
+            if value <= bound:
+                self.add(name + '_bucket', dict(labels, le=repr(bound)), 1)
+        self.add(name + '_bucket', dict(labels, le='+Inf'), 1)
+        self.add(name + '_sum', labels, value)
+        self.add(name + '_count', labels, 1)
+
+    def collect(self):
+        """Every sample summed over all processes, keyed as in add()"""
+        if not self.directory:
+            with self.lock:
+                return dict(self.values)
+        totals = {}
+        for path in glob.glob(os.path.join(self.directory, 'metrics_*.db')):
+            try:
+                values = read_file(path)
+            except (IOError, OSError, struct.error, ValueError):
+                continue
+            for key, value in values.items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def render(self):
+        samples = {}
+        for key, value in self.collect().items():
+            sample, labels = json.loads(key)
+            name = sample
+            for suffix in ('_bucket', '_sum', '_count'):
+                base = sample[:-len(suffix)]
+                if sample.endswith(suffix) and base in DEFINITIONS:
+                    name = base
+            samples.setdefault(name, []).append((sample, labels, value))
+
+        lines = []
+        for name in sorted(samples):
+            kind, help_text, _ = DEFINITIONS[name]
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for sample, labels, value in sorted(samples[name], key=sort_key):
+                label_text = ','.join('%s="%s"' % (k, escape(v))
+                                      for k, v in labels)
+                if label_text:
+                    sample = '%s{%s}' % (sample, label_text)
+                lines.append('%s %s' % (sample, format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def record_upstream(self, nameserver, outcome, rtt=None):
+        """Count an upstream query: 'success', 'timeout' or 'error'"""
+        self.inc('openresolve_upstream_queries_total',
+                 {'nameserver': nameserver, 'outcome': outcome})
+        if rtt is not None:
+            self.observe('openresolve_upstream_rtt_seconds', rtt,
+                         {'nameserver': nameserver})
+
+
+def sort_key(sample):
+    """Order samples by labels, with histogram buckets in ascending le"""
+    name, labels, _ = sample
+    other = [item for item in labels if item[0] != 'le']
+    bound = [float(v) for k, v in labels if k == 'le']
+    return other, name, bound
+
+
+metrics = Metrics()
@@ -0,0 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+
+
+def imap_unordered(func, iterable, concurrency):
+    """Apply func to every item using at most concurrency threads, yielding
+    results as they complete. Items are pulled from the iterable lazily, so
+    memory stays proportional to concurrency rather than to the input size.
+    """
+    items = iter(iterable)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = set(executor.submit(func, item)
+                      for item in islice(items, concurrency))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for item in islice(items, 1):
+                    pending.add(executor.submit(func, item))
+                yield future.result()
@@ -0,0 +1,81 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from resolverapi.util.ratelimit import TokenBucket
+
+
+class Prefetcher(object):
+    """Refreshes popular cache entries shortly before they expire, so hot
+    names never miss the cache.
+
+    An entry is refreshed once less than fraction of its TTL remains, if it
+    has been served at least min_rate times a second since it was stored
+    (the last refresh stores a new entry). A name that was busy once but
+    has gone quiet is left to expire. Refreshes run on a background pool
+    and are capped at max_qps; over the budget they are dropped and the
+    entry expires normally.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.configure()
+
+    def configure(self, enabled=True, fraction=0.1, min_rate=0.05,
+                  max_qps=20):
+        with self.lock:
+            self.enabled = enabled
+            self.fraction = fraction
+            self.min_rate = min_rate
+            self.budget = TokenBucket(max_qps)
+            self.in_progress = set()
+            self.demand = 0
+            self.prefetches = 0
+            self.dropped = 0
+
+    def record_demand(self):
+        """Count an upstream query made because of a cache miss"""
+        with self.lock:
+            self.demand += 1
+
+    def due(self, entry, now=None):
+        if now is None:
+            now = time.time()
+        lifetime = entry.expires - entry.stored
+        if entry.ttl(now) > lifetime * self.fraction:
+            return False
+        # At least a second, so an entry with a tiny TTL is not hot on
+        # its first hit
+        elapsed = max(now - entry.stored, 1.0)
+        return entry.hits / elapsed >= self.min_rate
+
+    def maybe_prefetch(self, key, entry, fn, *args):
+        """Schedule fn(*args) to refresh the entry for key if it is due"""
+        if not self.enabled or not self.due(entry):
+            return False
+        with self.lock:
+            if key in self.in_progress:
+                return False
+            if not self.budget.consume():
+                self.dropped += 1
+                return False
+            self.in_progress.add(key)
+            self.prefetches += 1
+        self.executor.submit(self.run, key, fn, *args)
+        return True
+
+    def run(self, key, fn, *args):
+        try:
+            fn(*args)
+        finally:
+            with self.lock:
+                self.in_progress.discard(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'demand': self.demand,
+                'prefetch': self.prefetches,
+                'dropped': self.dropped
+            }
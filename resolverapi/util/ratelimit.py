@@ -0,0 +1,35 @@
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Allows rate events per second on average, with bursts of up to burst
+    events."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, tokens=1):
+        """Take tokens from the bucket, returning False if there are not
+        enough."""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+    def delay(self, tokens=1):
+        """Seconds until tokens will be available"""
+        with self.lock:
+            missing = tokens - min(
+                self.burst,
+                self.tokens + (time.time() - self.updated) * self.rate)
+            return max(missing / self.rate, 0)
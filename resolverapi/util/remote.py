@@ -0,0 +1,207 @@
+"""Second-level answer cache shared by every API node.
+
+On a local miss AnswerCache asks the remote tier before going upstream, and
+answers from upstream are written to both, so a node that was just deployed
+or scaled out starts with the answers its peers already hold. Entries are
+stored with pack_entry under the question's cache key and expire with the
+answer's TTL plus the stale window.
+
+Errors and replies slower than the timeout count as misses, and after one the
+tier is skipped for backoff seconds. A struggling cache server therefore
+costs at most one timeout per backoff instead of one per request.
+"""
+import socket
+import struct
+import threading
+import time
+
+from dns.exception import DNSException
+
+from resolverapi.util.cache import key_bytes, unpack_entry
+
+
+class RedisError(Exception):
+    """The server answered a command with an error reply"""
+
+
+class RemoteTier(object):
+    """Failure handling and counters shared by the remote tiers. Subclasses
+    implement fetch(names) and store(name, value, ttl)."""
+
+    def __init__(self, backoff=5.0, prefix='openresolve:'):
+        self.backoff = backoff
+        self.prefix = prefix.encode('utf-8')
+        self.lock = threading.Lock()
+        self.down_until = 0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def name(self, key):
+        return self.prefix + key_bytes(key)
+
+    def available(self):
+        return time.time() >= self.down_until
+
+    def failed(self):
+        with self.lock:
+            self.errors += 1
+            self.down_until = time.time() + self.backoff
+
+    def get_many(self, keys):
+        """Return a CacheEntry, or None, for every key in one round trip"""
+        if not keys or not self.available():
+            return [None] * len(keys)
+        try:
+            values = self.fetch([self.name(key) for key in keys])
+        except (OSError, RedisError, ValueError):
+            self.failed()
+            return [None] * len(keys)
+        entries = [self.decode(value) for value in values]
+        found = len(keys) - entries.count(None)
+        with self.lock:
+            self.hits += found
+            self.misses += len(keys) - found
+        return entries
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def decode(self, value):
+        """Unpack a stored entry, treating unreadable values as misses"""
+        if not value:
+            return None
+        try:
+            return unpack_entry(value)
+        except (struct.error, ValueError, DNSException):
+            return None
+
+    def put(self, key, data, ttl):
+        """Store a packed entry for ttl seconds"""
+        if ttl <= 0 or not self.available():
+            return
+        try:
+            self.store(self.name(key), data, ttl)
+        except (OSError, RedisError, ValueError):
+            self.failed()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'errors': self.errors,
+                'available': time.time() >= self.down_until
+            }
+
+
+class MemoryTier(RemoteTier):
+    """Remote tier held in this process, for tests and single-node setups."""
+
+    def __init__(self, backoff=5.0, prefix='openresolve:'):
+        super(MemoryTier, self).__init__(backoff, prefix)
+        self.values = {}
+
+    def fetch(self, names):
+        now = time.time()
+        values = []
+        with self.lock:
+            for name in names:
+                value, expires = self.values.get(name, (None, 0))
+                values.append(value if expires > now else None)
+        return values
+
+    def store(self, name, value, ttl):
+        with self.lock:
+            self.values[name] = (value, time.time() + ttl)
+
+
+def encode_command(*args):
+    """Encode a command in the Redis serialization protocol"""
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode('utf-8')
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+
+def read_reply(reader):
+    line = reader.readline()
+    if not line.endswith(b'\r\n'):
+        raise ValueError('Connection closed by the cache server')
+    kind, rest = line[:1], line[1:-2]
+    if kind == b'+':
+        return rest
+    if kind == b'-':
+        raise RedisError(rest.decode('utf-8', 'replace'))
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        length = int(rest)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        if len(data) != length + 2:
+            raise ValueError('Connection closed by the cache server')
+        return data[:-2]
+    if kind == b'*':
+        length = int(rest)
+        if length < 0:
+            return None
+        return [read_reply(reader) for _ in range(length)]
+    raise ValueError('Unexpected reply from the cache server: %r' % line)
+
+
+class RedisTier(RemoteTier):
+    """Remote tier on any server speaking the Redis protocol. Every thread
+    keeps its own connection, and lookups for a batch are pipelined."""
+
+    def __init__(self, host='127.0.0.1', port=6379, timeout=0.05, backoff=5.0,
+                 prefix='openresolve:'):
+        super(RedisTier, self).__init__(backoff, prefix)
+        self.address = (host, port)
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            sock = socket.create_connection(self.address, self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = self.local.conn = (sock, sock.makefile('rb'))
+        return conn
+
+    def disconnect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            self.local.conn = None
+            conn[1].close()
+            conn[0].close()
+
+    def execute(self, commands):
+        """Send the commands in one pipeline and return their replies. A
+        failed connection is dropped so the next call reconnects."""
+        sock, reader = self.connection()
+        replies, error = [], None
+        try:
+            sock.sendall(b''.join(encode_command(*c) for c in commands))
+            for _ in commands:
+                try:
+                    replies.append(read_reply(reader))
+                except RedisError as e:
+                    # Keep reading so the connection stays in step
+                    error = e
+                    replies.append(None)
+        except (OSError, ValueError):
+            self.disconnect()
+            raise
+        if error is not None:
+            raise error
+        return replies
+
+    def fetch(self, names):
+        return self.execute([(b'GET', name) for name in names])
+
+    def store(self, name, value, ttl):
+        self.execute([(b'SET', name, value, b'PX', int(ttl * 1000))])
@@ -0,0 +1,283 @@
+"""Answer cache shared by every worker process on a host.
+
+The cache lives in a memory-mapped file divided into fixed-size slots that
+form an open-addressing hash table. A key hashes to a slot and may live in
+any of the PROBE_LIMIT slots that follow it. Every slot holds one
+serialized CacheEntry (see pack_entry) and is overwritten in place when
+the entry is refreshed, removed or evicted.
+
+Reads take no lock: each slot starts with a sequence number that writers
+make odd while they change the slot, and readers retry when it was odd or
+changed under them. Writers serialize on one of STRIPES lock stripes,
+using a thread lock within the process and a byte-range lock on the file
+between processes. Puts and removes also hold a lock stripe for their key
+while they probe, so two workers storing the same key cannot each take a
+slot for it, and a remove cannot blank a slot another key has moved into.
+
+The slot count and size are part of the file name, so workers configured
+differently use separate files and a file is never resized under a worker
+that has it mapped.
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+from resolverapi.util.cache import key_bytes, pack_entry, unpack_entry
+
+
+MAGIC = b'ORCACHE1'
+HEADER = struct.Struct('<8sII')  # magic, slot count, slot size
+HEADER_SIZE = 4096
+# sequence, key hash, expires, retry after, payload length, hits
+SLOT = struct.Struct('<QQddII')
+SEQ = struct.Struct('<Q')
+HITS_OFFSET = SLOT.size - 4
+KEY_LENGTH = struct.Struct('<H')
+PROBE_LIMIT = 8
+STRIPES = 64
+READ_RETRIES = 16
+
+
+def key_hash(data):
+    digest = hashlib.blake2b(data, digest_size=8).digest()
+    # 0 marks an empty slot
+    return struct.unpack('<Q', digest)[0] or 1
+
+
+class SharedStore(object):
+    """Store for AnswerCache backed by a shared memory-mapped file. Entries
+    that do not fit in a slot are not cached. Once all of a key's probe
+    slots are taken the entry closest to expiry is evicted.
+
+    Slots hold answers in wire format only. Every hit unpacks a new
+    CacheEntry, so the answer is parsed and its JSON body encoded again on
+    each hit, where a MemoryStore encodes it once.
+    """
+
+    def __init__(self, path, max_bytes, slot_size=2048, grace=0):
+        self.slot_size = slot_size
+        self.slot_count = max(max_bytes // slot_size, 1)
+        self.path = '%s.%d.%d' % (path, self.slot_count, slot_size)
+        # Expired entries younger than grace (the stale window) are kept
+        # in preference to evicting live ones
+        self.grace = grace
+        self.thread_locks = [threading.Lock() for _ in range(STRIPES)]
+        self.key_locks = [threading.Lock() for _ in range(STRIPES)]
+        size = HEADER_SIZE + self.slot_count * slot_size
+
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            header = HEADER.pack(MAGIC, self.slot_count, slot_size)
+            if os.pread(self.fd, HEADER.size, 0) != header:
+                # A new file, which only grows to its size
+                if os.fstat(self.fd).st_size < size:
+                    os.ftruncate(self.fd, size)
+                os.pwrite(self.fd, header, 0)
+            self.mm = mmap.mmap(self.fd, size)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+
+    @contextmanager
+    def locked(self, index):
+        stripe = index % STRIPES
+        with self.thread_locks[stripe]:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, stripe)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, stripe)
+
+    @contextmanager
+    def key_locked(self, slot_hash):
+        """Lock the stripe of a key. Taken before any slot stripe, on bytes
+        of its own, so the two cannot deadlock."""
+        stripe = slot_hash % STRIPES
+        with self.key_locks[stripe]:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, STRIPES + stripe)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, STRIPES + stripe)
+
+    def offset(self, index):
+        return HEADER_SIZE + index * self.slot_size
+
+    def probe(self, slot_hash):
+        start = slot_hash % self.slot_count
+        for i in range(min(PROBE_LIMIT, self.slot_count)):
+            yield (start + i) % self.slot_count
+
+    def read(self, index):
+        """Consistent copy of a slot's header and payload, or (None, None)
+        if a writer kept changing it."""
+        offset = self.offset(index)
+        for _ in range(READ_RETRIES):
+            (seq,) = SEQ.unpack_from(self.mm, offset)
+            if seq & 1:
+                time.sleep(0)
+                continue
+            header = SLOT.unpack_from(self.mm, offset)
+            start = offset + SLOT.size
+            payload = self.mm[start:start + header[4]]
+            if SEQ.unpack_from(self.mm, offset)[0] == seq:
+                return header, payload
+        return None, None
+
+    def write(self, index, slot_hash, expires, retry_after, payload, hits=0):
+        """Overwrite a slot. The caller holds the slot's lock stripe."""
+        offset = self.offset(index)
+        (seq,) = SEQ.unpack_from(self.mm, offset)
+        SEQ.pack_into(self.mm, offset, seq + 1)
+        SLOT.pack_into(self.mm, offset, seq + 1, slot_hash, expires,
+                       retry_after, len(payload), hits)
+        start = offset + SLOT.size
+        self.mm[start:start + len(payload)] = payload
+        SEQ.pack_into(self.mm, offset, seq + 2)
+
+    def find(self, key):
+        """Return (index, header, payload) of the slot holding key"""
+        data = key_bytes(key)
+        slot_hash = key_hash(data)
+        prefix = KEY_LENGTH.pack(len(data)) + data
+        for index in self.probe(slot_hash):
+            header, payload = self.read(index)
+            if (header is not None and header[1] == slot_hash and
+                    payload.startswith(prefix)):
+                return index, header, payload[len(prefix):]
+        return None, None, None
+
+    def get(self, key):
+        index, header, payload = self.find(key)
+        if index is None:
+            return None
+        entry = unpack_entry(payload)
+        entry.retry_after = header[3]
+        entry.hits = header[5]
+        return entry
+
+    def attach(self, key, entry, body):
+        # The entry is this hit's own copy, the body goes with it
+        entry.body = body
+
+    def touch(self, key, entry):
+        entry.hits += 1
+        index, header, _ = self.find(key)
+        if index is not None:
+            # Hit counts are advisory, so skip the lock and sequence bump
+            struct.pack_into('<I', self.mm, self.offset(index) + HITS_OFFSET,
+                             header[5] + 1)
+
+    def put(self, key, entry):
+        data = key_bytes(key)
+        slot_hash = key_hash(data)
+        payload = KEY_LENGTH.pack(len(data)) + data + pack_entry(entry)
+        if SLOT.size + len(payload) > self.slot_size:
+            return
+        prefix = payload[:KEY_LENGTH.size + len(data)]
+        with self.key_locked(slot_hash):
+            victim = self.choose_slot(slot_hash, prefix)
+            if victim is None:
+                return
+            with self.locked(victim):
+                self.write(victim, slot_hash, entry.expires,
+                           entry.retry_after, payload)
+
+    def choose_slot(self, slot_hash, prefix):
+        """The slot already holding the key, else an empty or expired one,
+        else the one closest to expiry. The caller holds the key's lock."""
+        now = time.time()
+        free, victim, victim_expires = None, None, None
+        for index in self.probe(slot_hash):
+            header, slot_payload = self.read(index)
+            if header is None:
+                continue
+            if header[1] == slot_hash and slot_payload.startswith(prefix):
+                return index
+            expires = header[2] + self.grace if header[1] else 0
+            if expires <= now:
+                # Empty, or expired beyond the stale window
+                if free is None:
+                    free = index
+            elif victim is None or expires < victim_expires:
+                victim, victim_expires = index, expires
+        return victim if free is None else free
+
+    def holds(self, index, slot_hash, prefix):
+        """Whether a slot still holds the key. The caller holds the slot's
+        lock stripe, so the slot cannot change while it is checked."""
+        offset = self.offset(index)
+        header = SLOT.unpack_from(self.mm, offset)
+        start = offset + SLOT.size
+        return (header[1] == slot_hash and
+                self.mm[start:start + len(prefix)] == prefix)
+
+    def remove(self, key):
+        data = key_bytes(key)
+        slot_hash = key_hash(data)
+        prefix = KEY_LENGTH.pack(len(data)) + data
+        with self.key_locked(slot_hash):
+            index, _, _ = self.find(key)
+            if index is None:
+                return
+            with self.locked(index):
+                # Another key may have been put in the slot since find
+                if self.holds(index, slot_hash, prefix):
+                    self.write(index, 0, 0, 0, b'')
+
+    def set_retry_after(self, key, retry_after):
+        data = key_bytes(key)
+        slot_hash = key_hash(data)
+        prefix = KEY_LENGTH.pack(len(data)) + data
+        index, _, _ = self.find(key)
+        if index is None:
+            return
+        with self.locked(index):
+            if self.holds(index, slot_hash, prefix):
+                struct.pack_into('<d', self.mm, self.offset(index) + 24,
+                                 retry_after)
+
+    def clear(self):
+        # Every slot stripe, as the thread locks and then the bytes. Byte
+        # locks belong to the process, so without the thread locks this
+        # process's other writers would not be kept out, and the unlock
+        # would drop the stripes they hold.
+        for lock in self.thread_locks:
+            lock.acquire()
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, STRIPES, 0)
+            try:
+                for index in range(self.slot_count):
+                    self.write(index, 0, 0, 0, b'')
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, STRIPES, 0)
+        finally:
+            for lock in self.thread_locks:
+                lock.release()
+
+    def dump(self):
+        """Yield (key bytes, expires, packed entry) for every entry"""
+        for index in range(self.slot_count):
+            header, payload = self.read(index)
+            if header is None or not header[1]:
+                continue
+            (length,) = KEY_LENGTH.unpack_from(payload)
+            start = KEY_LENGTH.size
+            yield (payload[start:start + length], header[2],
+                   payload[start + length:])
+
+    def stats(self):
+        entries = 0
+        for index in range(self.slot_count):
+            if SLOT.unpack_from(self.mm, self.offset(index))[1]:
+                entries += 1
+        return {'entries': entries, 'bytes': entries * self.slot_size}
@@ -0,0 +1,209 @@
+"""Snapshots of the answer cache on disk, so a restarted worker is warm.
+
+A snapshot is a hash table of packed cache entries (see pack_entry) with
+their absolute expiry times. Opening one only maps the file; an entry is
+unpacked when a lookup misses the cache and finds it there, so startup
+costs the same however large the snapshot is.
+
+    header | index: slot_count x (key hash, offset, length) | records
+
+Each record is the key (see key_bytes) followed by the packed entry.
+"""
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+
+from resolverapi.util.cache import key_bytes, unpack_entry
+from resolverapi.util.shmcache import key_hash
+
+
+MAGIC = b'ORSNAP01'
+HEADER = struct.Struct('<8sdII')  # magic, saved at, slot count, entries
+INDEX_SLOT = struct.Struct('<QQI4x')
+KEY_LENGTH = struct.Struct('<H')
+EXPIRES = struct.Struct('<8xd')
+
+
+def record_expires(entry_data):
+    """Absolute expiry time of a packed entry"""
+    return EXPIRES.unpack_from(entry_data)[0]
+
+
+def write_snapshot(path, records, saved_at=None):
+    """Write (key bytes, packed entry) records to a snapshot at path. The
+    file is replaced in one rename, so readers never see a partial one."""
+    if saved_at is None:
+        saved_at = time.time()
+    slot_count = 1
+    while slot_count < len(records) * 2:
+        slot_count *= 2
+    index = [(0, 0, 0)] * slot_count
+    data = []
+    offset = HEADER.size + slot_count * INDEX_SLOT.size
+    for key, entry_data in records:
+        record = KEY_LENGTH.pack(len(key)) + key + entry_data
+        slot_hash = key_hash(key)
+        slot = slot_hash % slot_count
+        while index[slot][0]:
+            slot = (slot + 1) % slot_count
+        index[slot] = (slot_hash, offset, len(record))
+        data.append(record)
+        offset += len(record)
+
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, saved_at, slot_count, len(records)))
+        f.write(b''.join(INDEX_SLOT.pack(*slot) for slot in index))
+        f.write(b''.join(data))
+    os.replace(tmp, path)
+
+
+class Snapshot(object):
+    """Read-only view of a snapshot file"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, self.saved_at, self.slot_count,
+             self.entries) = HEADER.unpack_from(self.mm)
+            if (magic != MAGIC or not self.slot_count or len(self.mm) <
+                    HEADER.size + self.slot_count * INDEX_SLOT.size):
+                raise ValueError('%s is not a cache snapshot' % path)
+        except (struct.error, ValueError):
+            self.mm.close()
+            raise ValueError('%s is not a cache snapshot' % path)
+
+    def find(self, data):
+        """The packed entry stored under key bytes data, or None"""
+        slot_hash = key_hash(data)
+        prefix = KEY_LENGTH.pack(len(data)) + data
+        slot = slot_hash % self.slot_count
+        for _ in range(self.slot_count):
+            stored_hash, offset, length = INDEX_SLOT.unpack_from(
+                self.mm, HEADER.size + slot * INDEX_SLOT.size)
+            if not stored_hash:
+                return None
+            if (stored_hash == slot_hash and
+                    self.mm[offset:offset + len(prefix)] == prefix):
+                return self.mm[offset + len(prefix):offset + length]
+            slot = (slot + 1) % self.slot_count
+        return None
+
+    def get(self, key):
+        entry_data = self.find(key_bytes(key))
+        if entry_data is None:
+            return None
+        return unpack_entry(entry_data)
+
+    def records(self):
+        """Yield (key bytes, packed entry) for every entry"""
+        for slot in range(self.slot_count):
+            stored_hash, offset, length = INDEX_SLOT.unpack_from(
+                self.mm, HEADER.size + slot * INDEX_SLOT.size)
+            if stored_hash:
+                (key_length,) = KEY_LENGTH.unpack_from(self.mm, offset)
+                start = offset + KEY_LENGTH.size
+                yield (self.mm[start:start + key_length],
+                       self.mm[start + key_length:offset + length])
+
+    def __len__(self):
+        return self.entries
+
+    def close(self):
+        self.mm.close()
+
+
+def open_snapshot(path):
+    """The Snapshot at path, or None if there is no usable one"""
+    try:
+        return Snapshot(path)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class Snapshotter(object):
+    """Saves an AnswerCache to a snapshot every interval seconds, from a
+    thread started in each worker process on its first request, and when
+    the worker exits.
+
+    Workers with caches of their own take turns writing the file, holding
+    a lock on path + '.lock' for the whole save, and each save also keeps
+    the entries of the snapshot on disk that are still usable and not in
+    this worker's cache.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.configure()
+
+    def configure(self, cache=None, path=None, interval=300):
+        with self.lock:
+            self.stopped.set()
+            self.stopped = threading.Event()
+            self.cache = cache
+            self.path = path
+            self.interval = interval
+            self.pid = None
+            self.saves = 0
+
+    def start(self):
+        """Start saving in this process, if not done yet"""
+        if not self.path or self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            thread = threading.Thread(target=self.run, args=(self.stopped,))
+            thread.daemon = True
+            thread.start()
+
+    def run(self, stopped):
+        while not stopped.wait(self.interval):
+            try:
+                self.save()
+            except (IOError, OSError):
+                # Try again next time, the last snapshot is still there
+                pass
+
+    def save(self):
+        """Write the entries that are live or still in the stale window"""
+        cache = self.cache
+        now = time.time()
+        keep_until = now - cache.stale_window
+        records = {}
+        for key, expires, entry_data in cache.store.dump():
+            if expires > keep_until:
+                records[key] = entry_data
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            # Other workers may be saving too, merge with what they wrote
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            previous = open_snapshot(self.path)
+            if previous is not None:
+                for key, entry_data in previous.records():
+                    key = bytes(key)
+                    if (key not in records and
+                            record_expires(entry_data) > keep_until):
+                        records[key] = bytes(entry_data)
+                previous.close()
+            write_snapshot(self.path, list(records.items()), now)
+        finally:
+            os.close(fd)
+        with self.lock:
+            self.saves += 1
+        return len(records)
+
+    def save_at_exit(self):
+        """Save on the way out of a worker that has been serving requests.
+        Other processes, like the uwsgi master, leave the file alone."""
+        if self.path and self.pid == os.getpid():
+            try:
+                self.save()
+            except (IOError, OSError):
+                pass
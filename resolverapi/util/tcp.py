@@ -0,0 +1,254 @@
+"""Persistent, pipelined TCP connections to the upstream nameservers.
+
+RFC 7766 lets a client keep a TCP connection open and send further queries
+on it without waiting for earlier responses, which the server may return
+in any order. A TcpPool keeps up to size such connections to each
+nameserver for the threads of one worker. Each connection has a reader
+thread that hands responses to the queries waiting on them by message ID,
+notices at once when the server closes the connection, and closes it
+itself after idle_timeout seconds without queries.
+"""
+import os
+import random
+import socket
+import struct
+import threading
+import time
+
+from dns.exception import Timeout
+
+
+LENGTH = struct.Struct('!H')
+
+
+class ConnectionClosed(OSError):
+    """The connection was closed before the response arrived"""
+
+
+class Waiter(object):
+    __slots__ = ('event', 'response')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+
+
+class Connection(object):
+    """One TCP connection to a nameserver, shared by many queries"""
+
+    def __init__(self, nameserver, port, timeout, idle_timeout):
+        self.nameserver = nameserver
+        self.idle_timeout = idle_timeout
+        self.sock = socket.create_connection((nameserver, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(idle_timeout)
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.pending = {}
+        self.closed = False
+        self.last_used = time.time()
+        self.queries = 0
+        # Queries the pool has handed this connection that are not done,
+        # guarded by the pool's lock for the nameserver
+        self.in_use = 0
+        self.reader = threading.Thread(target=self.read_responses)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def exchange(self, query, timeout):
+        """Send a query and wait up to timeout seconds for its response.
+        The query goes out under an ID unused on this connection, and the
+        response comes back with the query's own ID."""
+        waiter = Waiter()
+        with self.lock:
+            if self.closed:
+                raise ConnectionClosed()
+            while True:
+                query_id = random.getrandbits(16)
+                if query_id not in self.pending:
+                    break
+            self.pending[query_id] = waiter
+            self.queries += 1
+            self.last_used = time.time()
+        message = LENGTH.pack(len(query)) + LENGTH.pack(query_id) + query[2:]
+        try:
+            with self.send_lock:
+                self.sock.sendall(message)
+        except OSError:
+            self.close()
+            raise ConnectionClosed()
+        if not waiter.event.wait(timeout):
+            with self.lock:
+                self.pending.pop(query_id, None)
+            raise Timeout(timeout=timeout)
+        if waiter.response is None:
+            raise ConnectionClosed()
+        return query[:2] + waiter.response[2:]
+
+    def read_responses(self):
+        buffered = b''
+        while True:
+            try:
+                data = self.sock.recv(65535)
+            except socket.timeout:
+                if self.close_if_idle():
+                    return
+                continue
+            except OSError:
+                break
+            if not data:
+                break
+            buffered += data
+            while len(buffered) >= LENGTH.size:
+                (length,) = LENGTH.unpack_from(buffered)
+                end = LENGTH.size + length
+                if len(buffered) < end:
+                    break
+                self.dispatch(buffered[LENGTH.size:end])
+                buffered = buffered[end:]
+        self.close()
+
+    def dispatch(self, response):
+        if len(response) < LENGTH.size:
+            return
+        (query_id,) = LENGTH.unpack_from(response)
+        with self.lock:
+            waiter = self.pending.pop(query_id, None)
+        # Late responses to queries that timed out are dropped
+        if waiter is not None:
+            waiter.response = response
+            waiter.event.set()
+
+    def close_if_idle(self):
+        with self.lock:
+            if (self.pending or
+                    time.time() - self.last_used < self.idle_timeout):
+                return False
+            self.closed = True
+        self.sock.close()
+        return True
+
+    def close(self):
+        """Close the connection, failing the queries waiting on it"""
+        with self.lock:
+            self.closed = True
+            waiters = list(self.pending.values())
+            self.pending.clear()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        for waiter in waiters:
+            waiter.event.set()
+
+    @property
+    def in_flight(self):
+        return len(self.pending)
+
+
+class TcpPool(object):
+    """Up to size connections to each nameserver, each carrying up to
+    max_pipeline queries at a time. Queries go to the least busy open
+    connection, and a new one is only opened when they are all full. Once
+    there are size full connections, queries wait for one of them to have
+    room, and time out if none does in time."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = {}
+        self.configure()
+
+    def configure(self, size=2, idle_timeout=10.0, max_pipeline=64):
+        with self.lock:
+            connections = self.connections
+            self.size = size
+            self.idle_timeout = idle_timeout
+            self.max_pipeline = max_pipeline
+            self.connections = {}
+            # Held while picking or opening a connection to one nameserver,
+            # and notified when one of its connections has room again
+            self.nameserver_ready = {}
+            self.pid = os.getpid()
+            self.opened = 0
+            self.reused = 0
+        for pool in connections.values():
+            for connection in pool:
+                connection.close()
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def acquire(self, nameserver, port, deadline):
+        """An open connection to the nameserver with room for a query, and
+        the condition to release it with. Waits until deadline for room on
+        a full connection."""
+        key = (nameserver, port)
+        with self.lock:
+            if self.pid != os.getpid():
+                # Connections of the parent process are not ours to use
+                self.connections = {}
+                self.nameserver_ready = {}
+                self.pid = os.getpid()
+            ready = self.nameserver_ready.setdefault(
+                key, threading.Condition())
+        with ready:
+            while True:
+                pool = [c for c in self.connections.get(key, ())
+                        if not c.closed]
+                best = min(pool, key=lambda c: c.in_use, default=None)
+                if best is not None and best.in_use < self.max_pipeline:
+                    with self.lock:
+                        self.reused += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Timeout()
+                if len(pool) < self.size:
+                    best = Connection(nameserver, port, remaining,
+                                      self.idle_timeout)
+                    self.connections[key] = pool + [best]
+                    with self.lock:
+                        self.opened += 1
+                    break
+                ready.wait(remaining)
+            best.in_use += 1
+        return best, ready
+
+    def exchange(self, query, nameserver, port=53, timeout=3.0):
+        """Send a wire format query over a pooled connection and return the
+        response. A query on a reused connection that the server has
+        closed meanwhile is retried once on a new one."""
+        deadline = time.time() + timeout
+        for attempt in range(2):
+            try:
+                connection, ready = self.acquire(nameserver, port, deadline)
+            except (socket.timeout, Timeout):
+                raise Timeout(timeout=timeout)
+            reused = connection.queries > 0
+            try:
+                return connection.exchange(
+                    query, max(deadline - time.time(), 0))
+            except ConnectionClosed:
+                if not reused or attempt:
+                    raise
+            finally:
+                with ready:
+                    connection.in_use -= 1
+                    ready.notify()
+        raise ConnectionClosed()
+
+    def stats(self):
+        with self.lock:
+            open_connections = dict(
+                ('%s:%d' % key, len([c for c in pool if not c.closed]))
+                for key, pool in self.connections.items())
+            return {
+                'connections': open_connections,
+                'opened': self.opened,
+                'reused': self.reused
+            }
+
+    def close(self):
+        self.configure(self.size, self.idle_timeout, self.max_pipeline)
@@ -0,0 +1,119 @@
+"""Per-request phase timing and sampled stack profiling.
+
+A PhaseTimer records how long each phase of a request took (validation,
+cache lookup, every upstream attempt, serialization, encoding). The app
+sends the phases in a Server-Timing header and logs them as JSON.
+
+A StackSampler is attached to a sampled fraction of requests. It snapshots
+the request thread's stack at a fixed interval from a background thread,
+so a slow request can be logged with the stacks it spent its time in.
+"""
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+
+
+class PhaseTimer(object):
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.phases = []
+
+    def add(self, name, duration, desc=None):
+        """Record a phase. Upstream attempts may finish on other threads."""
+        with self.lock:
+            self.phases.append((name, duration, desc))
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def header(self):
+        """Server-Timing value, with durations in milliseconds"""
+        with self.lock:
+            phases = list(self.phases)
+        phases.append(('total', self.elapsed(), None))
+        entries = []
+        for name, duration, desc in phases:
+            entry = '%s;dur=%.3f' % (name, duration * 1000)
+            if desc:
+                entry += ';desc="%s"' % desc.replace('"', '')
+            entries.append(entry)
+        return ', '.join(entries)
+
+    def to_dict(self):
+        phases = []
+        with self.lock:
+            for name, duration, desc in self.phases:
+                entry = {'name': name, 'ms': round(duration * 1000, 3)}
+                if desc:
+                    entry['desc'] = desc
+                phases.append(entry)
+        return {'phases': phases, 'total_ms': round(self.elapsed() * 1000, 3)}
+
+
+def current_timer():
+    """The PhaseTimer of the request being handled, if any"""
+    if has_app_context():
+        return g.get('timer')
+    return None
+
+
+@contextmanager
+def phase(name, desc=None):
+    """Time a block as a phase of the current request"""
+    timer = current_timer()
+    if timer is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - started, desc)
+
+
+class StackSampler(object):
+    """Counts the stacks one thread is seen in, sampling every interval"""
+
+    def __init__(self, thread_id, interval=0.005, depth=20):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.depth = depth
+        self.stacks = Counter()
+        self.samples = 0
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            stack = []
+            while frame is not None and len(stack) < self.depth:
+                code = frame.f_code
+                stack.append('%s:%d %s' % (code.co_filename, frame.f_lineno,
+                                           code.co_name))
+                frame = frame.f_back
+            self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+        return self
+
+    def hot_stacks(self, limit=5):
+        """The most sampled stacks, innermost frame last"""
+        return [{'samples': count, 'stack': list(stack)}
+                for stack, count in self.stacks.most_common(limit)]
@@ -0,0 +1,477 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import dns.message
+import dns.query
+from dns import flags, rcode, rdatatype
+from dns.exception import DNSException, Timeout
+from dns.resolver import Answer, Resolver, NXDOMAIN, NoAnswer, NoNameservers
+
+from resolverapi.util.metrics import metrics
+
+
+# Hedge delay used by 'p95' mode until enough round trips have been seen
+DEFAULT_HEDGE_DELAY = 0.2
+MIN_SAMPLES = 20
+# Adaptive retransmit timeouts are this many times the chosen percentile of
+# a nameserver's round trip times, and are recomputed every so many answers
+TIMEOUT_MARGIN = 2.0
+TIMEOUT_UPDATE_INTERVAL = 20
+# EDNS0 payload sizes a nameserver steps down to when queries advertising a
+# larger one keep timing out, how many timeouts that takes, how far apart
+# they may be before the count starts again, and how recently the
+# nameserver must have answered for them to be put down to dropped
+# fragments rather than the nameserver being down
+EDNS_FALLBACK_PAYLOADS = (1232, 512)
+EDNS_FALLBACK_TIMEOUTS = 3
+EDNS_TIMEOUT_WINDOW = 60.0
+EDNS_ALIVE_WINDOW = 10.0
+
+
+class LatencyWindow(object):
+    """Rolling window of the most recent upstream round trip times."""
+
+    def __init__(self, size=1000):
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, rtt):
+        with self.lock:
+            self.samples.append(rtt)
+
+    def percentile(self, pct):
+        """Return the pct-th percentile in seconds, or None when empty."""
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return None
+        index = min(int(len(samples) * pct / 100.0), len(samples) - 1)
+        return samples[index]
+
+    def __len__(self):
+        return len(self.samples)
+
+
+class ResolverPool(object):
+    """One resolver per nameserver, all sharing the same settings.
+
+    Resolvers are never modified once created, so lookups running on
+    different threads cannot overwrite each other's choice of nameserver.
+
+    With adaptive timeouts a query is retransmitted once it has been
+    unanswered for TIMEOUT_MARGIN times the percentile of the nameserver's
+    recent round trip times, bounded by min_timeout and timeout, and retried
+    until its lifetime runs out. A new resolver replaces the old one when
+    the timeout changes.
+
+    Questions for tcp_rdtypes, whose answers tend to be too large for UDP,
+    skip the truncated UDP round trip and go over a connection of the
+    tcp_pool straight away.
+
+    With an edns_payload, queries advertise that EDNS0 UDP payload size so
+    large answers are not truncated to 512 bytes. They are sent with
+    dns.query rather than a resolver, so the truncation bit of the UDP
+    response can be seen. A query that goes unanswered is retransmitted
+    advertising the next smaller of EDNS_FALLBACK_PAYLOADS. When a
+    nameserver that is otherwise answering times out at a size
+    EDNS_FALLBACK_TIMEOUTS times, fragments of large responses are likely
+    being dropped on the way, so it is queried with the next smaller size
+    from then on. Small answers say nothing about fragments and leave the
+    count alone; only a response too large for the smaller size clears it.
+    The full size is tried again after edns_retry seconds.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.configure()
+
+    def configure(self, lifetime=3.0, timeout=2.0, port=53, adaptive=False,
+                  percentile=99, min_timeout=0.05, tcp_pool=None,
+                  tcp_rdtypes=(), edns_payload=0, edns_retry=600):
+        with self.lock:
+            self.lifetime = lifetime
+            self.timeout = timeout
+            self.port = port
+            self.adaptive = adaptive
+            self.percentile = percentile
+            self.min_timeout = min_timeout
+            self.tcp_pool = tcp_pool
+            self.tcp_rdtypes = frozenset(tcp_rdtypes)
+            self.resolvers = {}
+            self.windows = {}
+            self.answered = {}
+            self.timeouts = {}
+            self.edns_payload = edns_payload
+            self.edns_retry = edns_retry
+            self.payloads = {}
+            self.answered_at = {}
+            self.edns_timeouts = {}
+            self.edns_counts = {}
+
+    def get(self, nameserver):
+        resolver = self.resolvers.get(nameserver)
+        if resolver is None:
+            resolver = Resolver(configure=False)
+            resolver.nameservers = [nameserver]
+            resolver.lifetime = self.lifetime
+            resolver.timeout = self.timeout_for(nameserver)
+            resolver.port = self.port
+            with self.lock:
+                resolver = self.resolvers.setdefault(nameserver, resolver)
+        return resolver
+
+    def timeout_for(self, nameserver):
+        """Seconds to wait for the nameserver before retransmitting"""
+        return self.timeouts.get(nameserver, self.timeout)
+
+    def payload_for(self, nameserver):
+        """EDNS0 payload size to advertise to the nameserver, 0 for none"""
+        learned = self.payloads.get(nameserver)
+        if learned is None:
+            return self.edns_payload
+        payload, since = learned
+        if time.time() - since >= self.edns_retry:
+            with self.lock:
+                if self.payloads.get(nameserver) == learned:
+                    del self.payloads[nameserver]
+            return self.edns_payload
+        return payload
+
+    def edns_stats(self, nameserver):
+        """Payload size in use and how often answers were truncated, or
+        queries timed out and stepped down to a smaller size"""
+        queries, truncated, fallbacks = self.edns_counts.get(
+            nameserver, (0, 0, 0))
+        return {
+            'Payload': self.payload_for(nameserver),
+            'Queries': queries,
+            'Truncated': truncated,
+            'Fallbacks': fallbacks,
+            'TruncationRate': float(truncated) / queries if queries else 0.0,
+            'FallbackRate': float(fallbacks) / queries if queries else 0.0
+        }
+
+    def count_edns(self, nameserver, truncated=0, fallbacks=0):
+        with self.lock:
+            counts = self.edns_counts.get(nameserver, (0, 0, 0))
+            self.edns_counts[nameserver] = (counts[0] + 1,
+                                            counts[1] + truncated,
+                                            counts[2] + fallbacks)
+
+    def record_answer(self, nameserver, truncated, timed_out=None):
+        """Count an answer, and whether its UDP response was truncated so
+        it had to be retried over TCP. timed_out is the larger payload size
+        the query went unanswered at before a smaller one got through."""
+        self.answered_at[nameserver] = time.time()
+        if truncated:
+            metrics.inc('openresolve_upstream_truncated_total',
+                        {'nameserver': nameserver})
+        fallback = 0
+        if timed_out:
+            fallback = self.count_timeout(nameserver, timed_out)
+        self.count_edns(nameserver, int(truncated), fallback)
+
+    def record_timeout(self, nameserver, payload):
+        self.count_edns(nameserver,
+                        fallbacks=self.count_timeout(nameserver, payload))
+
+    def count_timeout(self, nameserver, payload):
+        """Step down to a smaller payload size after repeated timeouts, if
+        the nameserver answered other queries recently. Returns 1 if it
+        stepped down."""
+        now = time.time()
+        fallback = 0
+        with self.lock:
+            answered = self.answered_at.get(nameserver)
+            learned = self.payloads.get(nameserver, (self.edns_payload, 0))
+            smaller = smaller_payload(payload)
+            timeouts, last = self.edns_timeouts.get(nameserver, (0, now))
+            if now - last > EDNS_TIMEOUT_WINDOW:
+                timeouts = 0
+            timeouts += 1
+            self.edns_timeouts[nameserver] = (timeouts, now)
+            # Another query may have stepped down already
+            if (timeouts >= EDNS_FALLBACK_TIMEOUTS and answered is not None
+                    and now - answered <= EDNS_ALIVE_WINDOW and smaller
+                    and learned[0] == payload):
+                self.payloads[nameserver] = (smaller, now)
+                del self.edns_timeouts[nameserver]
+                fallback = 1
+        if fallback:
+            metrics.inc('openresolve_edns_fallbacks_total',
+                        {'nameserver': nameserver})
+        return fallback
+
+    def record_rtt(self, nameserver, rtt):
+        """Adjust the nameserver's timeout to an answered query"""
+        if not self.adaptive:
+            return
+        with self.lock:
+            window = self.windows.get(nameserver)
+            if window is None:
+                window = self.windows[nameserver] = LatencyWindow(200)
+            window.add(rtt)
+            answered = self.answered.get(nameserver, 0) + 1
+            self.answered[nameserver] = answered
+            if (answered < MIN_SAMPLES or
+                    answered % TIMEOUT_UPDATE_INTERVAL):
+                return
+            timeout = window.percentile(self.percentile) * TIMEOUT_MARGIN
+            self.timeouts[nameserver] = min(max(timeout, self.min_timeout),
+                                            self.timeout)
+            self.resolvers.pop(nameserver, None)
+
+    def query(self, nameserver, qname, rdtype, lifetime=None):
+        """Query one nameserver, giving up after lifetime seconds or the
+        pool's lifetime"""
+        if self.tcp_pool is not None and self.tcp_rdtypes:
+            if not isinstance(rdtype, int):
+                rdtype = rdatatype.from_text(rdtype)
+            if rdatatype.to_text(rdtype) in self.tcp_rdtypes:
+                return self.tcp_query(nameserver, qname, rdtype, lifetime)
+        if not self.edns_payload:
+            return self.get(nameserver).query(
+                qname, rdtype, raise_on_no_answer=False, lifetime=lifetime)
+        payload = self.payload_for(nameserver)
+        try:
+            answer, truncated, sent = self.udp_query(
+                nameserver, qname, rdtype, payload, lifetime)
+        except Timeout:
+            self.record_timeout(nameserver, payload)
+            raise
+        except Exception:
+            # NXDOMAIN, SERVFAIL and the like still show it is reachable
+            self.answered_at[nameserver] = time.time()
+            raise
+        if sent < payload:
+            # Only a retransmit advertising a smaller size got an answer
+            self.record_answer(nameserver, truncated, timed_out=payload)
+            return answer
+        if (not truncated and nameserver in self.edns_timeouts and
+                len(answer.response.to_wire()) >
+                (smaller_payload(payload) or 0)):
+            # A response the smaller size would not fit got through
+            self.edns_timeouts.pop(nameserver, None)
+        self.record_answer(nameserver, truncated)
+        return answer
+
+    def udp_query(self, nameserver, qname, rdtype, payload, lifetime=None):
+        """Query over UDP advertising the EDNS0 payload size, retransmitting
+        every timeout_for(nameserver) seconds until lifetime runs out and
+        retrying a truncated response over TCP. Each retransmit advertises
+        the next smaller payload size, if there is one. Returns the answer,
+        whether the UDP response was truncated and the payload size of the
+        request that was answered."""
+        request = dns.message.make_query(qname, rdtype, use_edns=0,
+                                         payload=payload)
+        lifetime = lifetime or self.lifetime
+        deadline = time.time() + lifetime
+        timeout = self.timeout_for(nameserver)
+        truncated = False
+        try:
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Timeout(timeout=lifetime)
+                try:
+                    response = dns.query.udp(request, nameserver,
+                                             min(timeout, remaining),
+                                             self.port)
+                    break
+                except Timeout:
+                    smaller = smaller_payload(payload)
+                    if smaller:
+                        payload = smaller
+                        request = dns.message.make_query(
+                            qname, rdtype, use_edns=0, payload=payload)
+                    continue
+            truncated = bool(response.flags & flags.TC)
+            if truncated and self.tcp_pool is None:
+                response = dns.query.tcp(request, nameserver,
+                                         max(deadline - time.time(), 0),
+                                         self.port)
+        except Timeout:
+            raise
+        except (OSError, DNSException) as e:
+            # Resolver.query gives up on the nameserver in the same way
+            raise NoNameservers(request=request, errors=[
+                (nameserver, truncated, self.port, e, None)])
+        if truncated and self.tcp_pool is not None:
+            return self.tcp_query(nameserver, qname, rdtype,
+                                  deadline - time.time()), True, payload
+        return (self.make_answer(request, nameserver, response), truncated,
+                payload)
+
+    def tcp_query(self, nameserver, qname, rdtype, lifetime=None):
+        """Query over a pooled TCP connection, raising the same exceptions
+        as Resolver.query. A nameserver that cannot be reached counts as a
+        timeout, so the next one is tried."""
+        request = dns.message.make_query(qname, rdtype)
+        try:
+            wire = self.tcp_pool.exchange(request.to_wire(), nameserver,
+                                          self.port, lifetime or self.lifetime)
+        except OSError:
+            raise Timeout()
+        return self.make_answer(request, nameserver,
+                                dns.message.from_wire(wire))
+
+    def make_answer(self, request, nameserver, response):
+        """The Answer to request, raising the exceptions Resolver.query
+        raises for NXDOMAIN and other error codes"""
+        qname = request.question[0].name
+        code = response.rcode()
+        if code == rcode.NXDOMAIN:
+            raise NXDOMAIN(qnames=[qname], responses={qname: response})
+        if code != rcode.NOERROR:
+            raise NoNameservers(request=request, errors=[
+                (nameserver, True, self.port, rcode.to_text(code), response)])
+        question = request.question[0]
+        return Answer(qname, question.rdtype, question.rdclass, response,
+                      raise_on_no_answer=False)
+
+
+rtt_window = LatencyWindow()
+executor = ThreadPoolExecutor(max_workers=32)
+
+
+def smaller_payload(payload):
+    """The next of EDNS_FALLBACK_PAYLOADS below payload, or None"""
+    for size in EDNS_FALLBACK_PAYLOADS:
+        if size < payload:
+            return size
+    return None
+
+
+def hedge_delay(setting, min_delay=0.0):
+    """Turn the HEDGE_DELAY setting into seconds. 'p95' follows the observed
+    upstream latency, anything else is taken as a fixed number of seconds."""
+    if setting == 'p95':
+        if len(rtt_window) < MIN_SAMPLES:
+            return DEFAULT_HEDGE_DELAY
+        return max(rtt_window.percentile(95), min_delay)
+    return float(setting)
+
+
+def attempt_lifetime(lifetime, deadline, attempts):
+    """Seconds the next of attempts queries may take: an equal share of
+    the time left before the deadline, at most lifetime. Raises Timeout
+    once the deadline has passed."""
+    if deadline is None:
+        return lifetime
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise Timeout(timeout=0)
+    return min(lifetime, remaining / attempts)
+
+
+def timed_query(pool, nameserver, qname, rdtype, tracker=None, timer=None,
+                lifetime=None):
+    """Query one nameserver, recording the round trip time and outcome with
+    the health tracker, and as a phase of the request's timer."""
+    t1 = time.time()
+    try:
+        answer = pool.query(nameserver, qname, rdtype, lifetime)
+    except Timeout:
+        if timer is not None:
+            timer.add('upstream', time.time() - t1, nameserver)
+        metrics.record_upstream(nameserver, 'timeout')
+        if tracker is not None:
+            tracker.record_timeout(nameserver)
+        raise
+    except (NXDOMAIN, NoAnswer):
+        # The nameserver answered, the name just does not exist
+        rtt = time.time() - t1
+        pool.record_rtt(nameserver, rtt)
+        if timer is not None:
+            timer.add('upstream', rtt, nameserver)
+        metrics.record_upstream(nameserver, 'success', rtt)
+        if tracker is not None:
+            tracker.record_success(nameserver, rtt)
+        raise
+    except Exception:
+        if timer is not None:
+            timer.add('upstream', time.time() - t1, nameserver)
+        metrics.record_upstream(nameserver, 'error')
+        if tracker is not None:
+            tracker.record_error(nameserver)
+        raise
+    rtt = time.time() - t1
+    rtt_window.add(rtt)
+    pool.record_rtt(nameserver, rtt)
+    if timer is not None:
+        timer.add('upstream', rtt, nameserver)
+    metrics.record_upstream(nameserver, 'success', rtt)
+    if tracker is not None:
+        tracker.record_success(nameserver, rtt)
+    return answer
+
+
+def resolve(pool, nameservers, qname, rdtype, delay=None, tracker=None,
+            timer=None, deadline=None):
+    """Resolve qname against the nameservers, returning (answer, nameserver).
+
+    Without a delay the nameservers are tried one at a time and only a
+    timeout moves on to the next. With a delay the query is hedged: each
+    following nameserver is also queried once the previous ones have been
+    silent for delay seconds, and the first answer wins. Errors other than
+    a timeout (NXDOMAIN, NoNameservers, ...) are an answer and are raised.
+
+    With a health tracker the nameservers are reordered by health first,
+    and those due a probe are queried in the background. Every attempt is added to the timer, if one is given. Nothing runs past
+    the deadline (a time.time() value), if one is given: one at a time,
+    each nameserver gets an equal share of the time left for the ones not
+    tried yet.
+    """
+    if tracker is not None:
+        probes = []
+        nameservers = tracker.order(nameservers, probes)
+        for nameserver in probes:
+            executor.submit(timed_query, pool, nameserver, qname, rdtype,
+                            tracker)
+    if delay is None:
+        return sequential_query(pool, nameservers, qname, rdtype, tracker,
+                                timer, deadline)
+    return hedged_query(pool, nameservers, qname, rdtype, delay, tracker,
+                        timer, deadline)
+
+
+def sequential_query(pool, nameservers, qname, rdtype, tracker=None,
+                     timer=None, deadline=None):
+    for i, nameserver in enumerate(nameservers):
+        lifetime = attempt_lifetime(pool.lifetime, deadline,
+                                    len(nameservers) - i)
+        try:
+            answer = timed_query(pool, nameserver, qname, rdtype, tracker,
+                                 timer, lifetime)
+            return answer, nameserver
+        except Timeout:
+            # Communication fail or timeout - try next nameserver
+            if nameserver is nameservers[-1]:
+                raise
+
+
+def hedged_query(pool, nameservers, qname, rdtype, delay, tracker=None,
+                 timer=None, deadline=None):
+    remaining = list(nameservers)
+    pending = {}
+    error = None
+    while remaining or pending:
+        if remaining:
+            nameserver = remaining.pop(0)
+            # Queries run side by side, each may use all the time left
+            lifetime = attempt_lifetime(pool.lifetime, deadline, 1)
+            future = executor.submit(
+                timed_query, pool, nameserver, qname, rdtype, tracker, timer,
+                lifetime)
+            pending[future] = nameserver
+        done, _ = wait(pending, timeout=delay if remaining else None,
+                       return_when=FIRST_COMPLETED)
+        for future in done:
+            nameserver = pending.pop(future)
+            try:
+                return future.result(), nameserver
+            except Timeout as e:
+                error = e
+    raise error
@@ -0,0 +1,205 @@
+"""Raw DNS messages for the DNS-over-HTTPS endpoint (RFC 8484).
+
+Queries are forwarded and responses returned as bytes. Only the header, the
+question and the resource record framing are read, to validate queries and
+find TTLs, so no dnspython message objects are built on this path.
+"""
+import os
+import socket
+import struct
+import time
+
+from dns.exception import Timeout
+
+from resolverapi.util.metrics import metrics
+from resolverapi.util.upstream import attempt_lifetime, executor
+
+
+HEADER = struct.Struct('!HHHHHH')  # id, flags, and the four section counts
+RR_FIXED = struct.Struct('!HHIH')  # type, class, ttl, rdlength
+LENGTH = struct.Struct('!H')
+QR = 0x8000
+TC = 0x0200
+SOA = 6
+
+
+class FormError(ValueError):
+    """The bytes are not a DNS message we can handle"""
+
+
+def skip_name(wire, offset):
+    """Return the offset just past the (possibly compressed) name at offset"""
+    while True:
+        if offset >= len(wire):
+            raise FormError('Name runs past the end of the message')
+        length = wire[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        if length & 0xC0:
+            raise FormError('Unknown label type')
+        offset += length + 1
+
+
+def check_query(wire):
+    """Raise FormError unless wire is a query with a single question"""
+    if len(wire) < HEADER.size:
+        raise FormError('Message is shorter than a DNS header')
+    _, flags, qdcount, _, _, _ = HEADER.unpack_from(wire)
+    if flags & QR or qdcount != 1:
+        raise FormError('Message is not a query for one question')
+    if skip_name(wire, HEADER.size) + 4 > len(wire):
+        raise FormError('Question is truncated')
+
+
+def min_ttl(wire):
+    """Seconds a response may be cached for: the smallest TTL in the answer
+    section, or for a negative answer the lesser of the SOA's TTL and
+    MINIMUM (RFC 2308). None when the response has neither."""
+    try:
+        _, _, qdcount, ancount, nscount, _ = HEADER.unpack_from(wire)
+        offset = HEADER.size
+        for _ in range(qdcount):
+            offset = skip_name(wire, offset) + 4
+        ttls = []
+        negative = None
+        for i in range(ancount + nscount):
+            offset = skip_name(wire, offset)
+            rdtype, _, ttl, rdlength = RR_FIXED.unpack_from(wire, offset)
+            offset += RR_FIXED.size + rdlength
+            if i < ancount:
+                ttls.append(ttl)
+            elif rdtype == SOA:
+                # MINIMUM is the last field of the SOA rdata
+                (minimum,) = struct.unpack_from('!I', wire, offset - 4)
+                negative = min(ttl, minimum)
+    except struct.error:
+        raise FormError('Resource record is truncated')
+    if ttls:
+        return min(ttls)
+    return negative
+
+
+def address_family(nameserver):
+    if ':' in nameserver:
+        return socket.AF_INET6
+    return socket.AF_INET
+
+
+def udp_exchange(query, nameserver, port, deadline):
+    query_id = query[:2]
+    with socket.socket(address_family(nameserver), socket.SOCK_DGRAM) as sock:
+        sock.connect((nameserver, port))
+        sock.send(query)
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise Timeout()
+            sock.settimeout(remaining)
+            try:
+                response = sock.recv(65535)
+            except socket.timeout:
+                raise Timeout()
+            # Ignore anything that is not the response to our query
+            if (len(response) >= HEADER.size and response[:2] == query_id and
+                    HEADER.unpack_from(response)[1] & QR):
+                return response
+
+
+def tcp_exchange(query, nameserver, port, deadline):
+    try:
+        with socket.create_connection(
+                (nameserver, port), max(deadline - time.time(), 0)) as sock:
+            sock.sendall(LENGTH.pack(len(query)) + query)
+            reader = sock.makefile('rb')
+            header = reader.read(LENGTH.size)
+            if len(header) != LENGTH.size:
+                raise FormError('Connection closed by the nameserver')
+            (length,) = LENGTH.unpack(header)
+            response = reader.read(length)
+            if len(response) != length:
+                raise FormError('Connection closed by the nameserver')
+            return response
+    except socket.timeout:
+        raise Timeout()
+
+
+def exchange(wire, nameserver, port=53, timeout=3.0, tcp_pool=None):
+    """Send a query to one nameserver and return its response.
+
+    The query goes upstream under a random ID, which stub clients following
+    RFC 8484 leave at 0. The response is returned with the client's ID
+    again. Truncated UDP responses are retried over TCP, on a connection
+    from the tcp_pool if one is given."""
+    deadline = time.time() + timeout
+    query = os.urandom(2) + wire[2:]
+    response = udp_exchange(query, nameserver, port, deadline)
+    if HEADER.unpack_from(response)[1] & TC:
+        metrics.inc('openresolve_upstream_truncated_total',
+                    {'nameserver': nameserver})
+        if tcp_pool is not None:
+            response = tcp_pool.exchange(query, nameserver, port,
+                                         deadline - time.time())
+        else:
+            response = tcp_exchange(query, nameserver, port, deadline)
+    return wire[:2] + response[2:]
+
+
+def timed_exchange(wire, nameserver, port=53, timeout=3.0, tracker=None,
+                   timer=None, tcp_pool=None):
+    """exchange, recording the round trip time and outcome with the health
+    tracker, and as a phase of the request's timer."""
+    t1 = time.time()
+    try:
+        response = exchange(wire, nameserver, port, timeout, tcp_pool)
+    except Timeout:
+        if timer is not None:
+            timer.add('upstream', time.time() - t1, nameserver)
+        metrics.record_upstream(nameserver, 'timeout')
+        if tracker is not None:
+            tracker.record_timeout(nameserver)
+        raise
+    except (OSError, FormError):
+        if timer is not None:
+            timer.add('upstream', time.time() - t1, nameserver)
+        metrics.record_upstream(nameserver, 'error')
+        if tracker is not None:
+            tracker.record_error(nameserver)
+        raise
+    rtt = time.time() - t1
+    if timer is not None:
+        timer.add('upstream', rtt, nameserver)
+    metrics.record_upstream(nameserver, 'success', rtt)
+    if tracker is not None:
+        tracker.record_success(nameserver, rtt)
+    return response
+
+
+def forward(wire, nameservers, port=53, timeout=3.0, tracker=None,
+            timer=None, deadline=None, tcp_pool=None):
+    """Forward a query to the nameservers in turn until one responds.
+    Returns the response and the nameserver. Any response, including
+    SERVFAIL, is passed through; timeouts and socket errors move on to the
+    next nameserver. Every attempt is added to the timer, if one is given,
+    and shares in the time left before the deadline, if one is given.
+    Nameservers due a health probe are queried in the background."""
+    if tracker is not None:
+        probes = []
+        nameservers = tracker.order(nameservers, probes)
+        for nameserver in probes:
+            executor.submit(timed_exchange, wire, nameserver, port, timeout,
+                            tracker, None, tcp_pool)
+    error = None
+    for i, nameserver in enumerate(nameservers):
+        lifetime = attempt_lifetime(timeout, deadline, len(nameservers) - i)
+        try:
+            response = timed_exchange(wire, nameserver, port, lifetime,
+                                      tracker, timer, tcp_pool)
+        except (Timeout, OSError, FormError) as e:
+            error = e
+            continue
+        return response, nameserver
+    if error is None:
+        error = Timeout()
+    raise error
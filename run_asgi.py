@@ -0,0 +1,4 @@
+import os
+from resolverapi.asgi import create_asgi_app
+
+app = create_asgi_app(os.environ.get('RESOLVER_ENV', 'prod'))
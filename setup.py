@@ -6,6 +6,14 @@ setup(
     maintainer_email=["kevincfunk@gmail.com, rpiaget@gmail.com"],
     version='0.0.1',
     license="BSD 2 clause",
-    packages=['resolverapi'],
+    packages=['resolverapi', 'resolverapi.util'],
+    python_requires='>=3.10',
+    extras_require={
+        # ASGI server for run_asgi.py
+        'asgi': ['uvicorn']
+    },
+    entry_points={
+        'console_scripts': ['openresolve-bulk = resolverapi.bulk:main']
+    },
     long_description=open('README.md').read()
 )
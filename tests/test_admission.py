@@ -0,0 +1,84 @@
+import time
+
+from tests import BaseTest
+
+from mock import patch
+
+from resolverapi import admission, answer_cache
+from resolverapi.util.admission import queue_time
+from resolverapi.util.ratelimit import TokenBucket
+from tests.test_util import make_answer, TEST_DOMAIN
+
+
+@patch('resolverapi.endpoints.resolver_pool.query')
+class AdmissionTests(BaseTest):
+
+    def lookup(self, headers=None):
+        return self.test_client.get('/A/%s' % TEST_DOMAIN, headers=headers)
+
+    def test_client_rate_limit(self, query):
+        admission.configure(client_rate=1, client_burst=2)
+        query.return_value = make_answer('A', answers=['10.0.0.1'])
+
+        self.assert200(self.lookup().status_code)
+        self.assert200(self.lookup().status_code)
+        r = self.lookup()
+        self.assertEqual(r.status_code, 429)
+        self.assertEqual(r.headers['Retry-After'], '1')
+        self.assertEqual(query.call_count, 1)
+
+        # Other clients and the metrics scrape are not held back
+        r = self.test_client.get('/A/%s' % TEST_DOMAIN,
+                                 environ_base={'REMOTE_ADDR': '10.9.9.9'})
+        self.assert200(r.status_code)
+        self.assert200(self.test_client.get('/metrics').status_code)
+        self.assertEqual(admission.stats()['rate_limited'], 1)
+
+    def test_upstream_lookups_are_shed_first(self, query):
+        query.return_value = make_answer('A', answers=['10.0.0.1'])
+        self.lookup()
+        admission.configure(max_in_flight=0)
+
+        # Cached
+        self.assert200(self.lookup().status_code)
+
+        r = self.test_client.get('/MX/%s' % TEST_DOMAIN)
+        self.assert503(r.status_code)
+        self.assertEqual(r.headers['Retry-After'], '1')
+        self.assertEqual(query.call_count, 1)
+        self.assertEqual(admission.stats()['shed'], 1)
+
+    def test_shed_lookup_gets_stale_answer(self, query):
+        query.return_value = make_answer('A', answers=['10.0.0.1'])
+        self.lookup()
+        entry = answer_cache.get(TEST_DOMAIN, 'A')
+        entry.stored -= 120
+        entry.expires -= 120
+        admission.configure(max_in_flight=0)
+
+        resp, code = self.get('A/%s' % TEST_DOMAIN)
+        self.assert200(code)
+        self.assertTrue(resp['Stale'])
+        self.assertEqual(query.call_count, 1)
+
+    def test_requests_that_queued_too_long(self, query):
+        query.return_value = make_answer('A', answers=['10.0.0.1'])
+        late = {'X-Request-Start': 't=%.3f' % (time.time() - 5)}
+        self.assert503(self.lookup(late).status_code)
+        self.assertEqual(query.call_count, 0)
+
+        self.assert200(self.lookup().status_code)
+        self.assert200(self.lookup(late).status_code)
+        self.assertEqual(admission.stats()['in_flight'], 0)
+
+    def test_queue_time(self, query):
+        self.assertEqual(queue_time('t=100.5', 101), 0.5)
+        self.assertEqual(queue_time('100', 99), 0)
+        self.assertIsNone(queue_time('t=soon', 101))
+        self.assertIsNone(queue_time(None, 101))
+
+    def test_bucket_delay(self, query):
+        bucket = TokenBucket(2, 1)
+        self.assertEqual(bucket.delay(), 0)
+        bucket.consume()
+        self.assertAlmostEqual(bucket.delay(), 0.5, places=1)
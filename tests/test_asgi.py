@@ -0,0 +1,243 @@
+import asyncio
+import json
+import socket
+import threading
+import time
+
+import dns.message
+import dns.rrset
+from mock import patch
+
+from tests import BaseTest
+
+from resolverapi import admission, answer_cache, resolver_pool
+from resolverapi.asgi import AsyncApp
+from resolverapi.util.metrics import metrics
+from resolverapi.util.remote import MemoryTier
+from tests.test_util import make_answer, TEST_DOMAIN
+
+
+class StubNameserver(object):
+    """Answers every A query on a local UDP port with 10.0.0.1, or drops the
+    queries when drop is set."""
+
+    def __init__(self, drop=False):
+        self.drop = drop
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(4096)
+            except OSError:
+                return
+            if self.drop:
+                continue
+            query = dns.message.from_wire(data)
+            response = dns.message.make_response(query)
+            response.answer.append(dns.rrset.from_text(
+                query.question[0].name, 60, 'IN', 'A', '10.0.0.1'))
+            self.sock.sendto(response.to_wire(), addr)
+
+    def close(self):
+        self.sock.close()
+
+
+class ThreadRecordingTier(MemoryTier):
+    """Records the threads the remote tier is called on"""
+
+    def __init__(self):
+        super(ThreadRecordingTier, self).__init__()
+        self.threads = []
+
+    def get_many(self, keys):
+        self.threads.append(threading.get_ident())
+        return super(ThreadRecordingTier, self).get_many(keys)
+
+    def put(self, key, data, ttl):
+        self.threads.append(threading.get_ident())
+        return super(ThreadRecordingTier, self).put(key, data, ttl)
+
+
+class AsgiAppTests(BaseTest):
+
+    def setUp(self):
+        super(AsgiAppTests, self).setUp()
+        self.asgi_app = AsyncApp(self.app)
+        answer_cache.configure(0)
+
+    def request(self, path, method='GET', body=b'', headers=()):
+        """Returns the body and status, and keeps the headers in
+        self.headers"""
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body}
+
+        async def send(message):
+            messages.append(message)
+
+        path, _, query_string = path.partition('?')
+        scope = {'type': 'http', 'method': method, 'path': path,
+                 'query_string': query_string.encode('latin-1'),
+                 'client': ('127.0.0.1', 1234), 'headers': list(headers)}
+        asyncio.run(self.asgi_app(scope, receive, send))
+        self.headers = dict(messages[0]['headers'])
+        body = b''.join(message['body'] for message in messages[1:])
+        if (b'content-type', b'application/json') in messages[0]['headers']:
+            body = json.loads(body)
+        return body, messages[0]['status']
+
+    def use_stub(self, stub):
+        self.addCleanup(stub.close)
+        self.app.config['RESOLVERS'] = ['127.0.0.1']
+        resolver_pool.configure(lifetime=0.2, port=stub.port)
+
+    def test_lookup(self):
+        self.use_stub(StubNameserver())
+        resp, code = self.request('/A/%s' % TEST_DOMAIN)
+        self.assert200(code)
+        self.assertEqual(resp['Query']['Server'], '127.0.0.1')
+        self.assertEqual(resp['AnswerSection'][0]['Address'], '10.0.0.1')
+
+    def test_remote_tier_is_called_off_the_loop(self):
+        self.use_stub(StubNameserver())
+        remote = ThreadRecordingTier()
+        answer_cache.configure(64 * 1024, remote=remote)
+        resp, code = self.request('/A/%s' % TEST_DOMAIN)
+        self.assert200(code)
+        self.assertEqual(len(remote.threads), 2)
+        self.assertNotIn(threading.get_ident(), remote.threads)
+
+    def test_timeout(self):
+        self.use_stub(StubNameserver(drop=True))
+        resp, code = self.request('/A/%s' % TEST_DOMAIN)
+        self.assert503(code)
+        self.assertDictEqual(resp, {'message': 'All nameservers timed out.'})
+
+    def test_client_timeout(self):
+        self.use_stub(StubNameserver(drop=True))
+        resolver_pool.configure(lifetime=2.0, port=resolver_pool.port)
+        t1 = time.time()
+        resp, code = self.request('/A/%s?timeout=0.1' % TEST_DOMAIN)
+        self.assert503(code)
+        self.assertLess(time.time() - t1, 1.0)
+        resp, code = self.request('/A/%s' % TEST_DOMAIN,
+                                  headers=[(b'x-timeout', b'soon')])
+        self.assert400(code)
+
+    def test_rate_limited(self):
+        admission.configure(client_rate=1, client_burst=1)
+        resp, code = self.request('/')
+        self.assert200(code)
+        resp, code = self.request('/A/%s' % TEST_DOMAIN)
+        self.assertEqual(code, 429)
+        self.assertEqual(self.headers[b'retry-after'], b'1')
+
+    def test_shed_when_overloaded(self):
+        self.use_stub(StubNameserver())
+        self.app.config['SHED_RETRY_AFTER'] = 2
+        admission.configure(max_in_flight=0)
+        resp, code = self.request('/A/%s' % TEST_DOMAIN)
+        self.assert503(code)
+        self.assertEqual(self.headers[b'retry-after'], b'2')
+        self.assertEqual(admission.stats()['shed'], 1)
+
+    def test_cache_headers_match_flask(self):
+        self.use_stub(StubNameserver())
+        resp, code = self.request('/A/%s' % TEST_DOMAIN)
+        r = self.test_client.get('/A/%s' % TEST_DOMAIN)
+        self.assertEqual(self.headers[b'cache-control'],
+                         r.headers['Cache-Control'].encode())
+        self.assertEqual(self.headers[b'etag'], r.headers['ETag'].encode())
+
+        resp, code = self.request(
+            '/A/%s' % TEST_DOMAIN,
+            headers=[(b'if-none-match', self.headers[b'etag'])])
+        self.assertEqual(code, 304)
+        self.assertEqual(resp, b'')
+        self.assertEqual(self.headers[b'cache-control'], b'max-age=60')
+
+    def test_request_metrics(self):
+        self.use_stub(StubNameserver())
+        self.request('/A/%s' % TEST_DOMAIN)
+        self.request('/NA/%s' % TEST_DOMAIN)
+        text = metrics.render()
+        self.assertIn('openresolve_request_duration_seconds_count{'
+                      'rdtype="A",route="/<rdtype>/<domain>"} 1', text)
+        self.assertIn('openresolve_responses_total{cause="validation",'
+                      'route="/<rdtype>/<domain>",status="400"} 1', text)
+        self.assertIn('rdtype="unsupported"', text)
+
+    def test_validation(self):
+        resp, code = self.request('/NA/opendns.com')
+        self.assert400(code)
+        resp, code = self.request('/A/invalid&domain')
+        self.assert400(code)
+        resp, code = self.request('/reverse/256.1.1.1')
+        self.assert400(code)
+
+    def test_root(self):
+        resp, code = self.request('/')
+        self.assert200(code)
+
+    def test_other_routes_are_forwarded(self):
+        resp, code = self.request('/stats')
+        self.assert200(code)
+        self.assertIn('cache', resp)
+        resp, code = self.request('/nameservers')
+        self.assert200(code)
+
+    def test_post_is_forwarded(self):
+        self.use_stub(StubNameserver())
+        resp, code = self.request(
+            '/batch', 'POST', json.dumps([['A', TEST_DOMAIN]]).encode(),
+            [(b'content-type', b'application/json')])
+        self.assert200(code)
+        self.assertEqual(resp[0]['AnswerSection'][0]['Address'], '10.0.0.1')
+
+    def test_unknown_routes(self):
+        resp, code = self.request('/a/b/c')
+        self.assert404(code)
+        resp, code = self.request('/A/%s' % TEST_DOMAIN, 'DELETE')
+        self.assertEqual(code, 405)
+
+    @patch('resolverapi.endpoints.resolver_pool.query')
+    def test_sweep_is_streamed(self, query):
+        # The last address is only answered once the first line has been
+        # sent, which never happens if the response is buffered
+        first_line = threading.Event()
+        streamed = []
+
+        def answer(nameserver, qname, rdtype, lifetime=None):
+            if str(qname).startswith('3.'):
+                streamed.append(first_line.wait(5))
+            return make_answer('PTR', answers=['target.domain.com.'])
+        query.side_effect = answer
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            if message.get('body'):
+                first_line.set()
+            messages.append(message)
+
+        scope = {'type': 'http', 'method': 'GET',
+                 'path': '/reverse/10.0.0.0/30', 'headers': []}
+        asyncio.run(self.asgi_app(scope, receive, send))
+
+        self.assertEqual(streamed, [True])
+        self.assertEqual(messages[0]['status'], 200)
+        chunks = [m for m in messages[1:] if m['body']]
+        self.assertTrue(all(m['more_body'] for m in chunks))
+        self.assertFalse(messages[-1].get('more_body'))
+        lines = b''.join(m['body'] for m in chunks).splitlines()
+        self.assertEqual(sorted(json.loads(line)['IP'] for line in lines),
+                         ['10.0.0.0', '10.0.0.1', '10.0.0.2', '10.0.0.3'])
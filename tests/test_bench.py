@@ -0,0 +1,48 @@
+import dns.message
+import dns.query
+
+from tests import BaseTest
+
+from bench.load import Workload, WsgiTarget, run_threads, make_report, compare
+from bench.stub import StubNameserver
+from resolverapi import resolver_pool
+
+
+class BenchTests(BaseTest):
+
+    def setUp(self):
+        super(BenchTests, self).setUp()
+        self.stub = StubNameserver(answers=3, truncate=1.0)
+        self.addCleanup(self.stub.close)
+
+    def test_stub_truncates_and_answers_over_tcp(self):
+        query = dns.message.make_query('host1.bench.test', 'MX')
+        response = dns.query.udp(query, self.stub.host, 1, self.stub.port)
+        self.assertTrue(response.flags & dns.flags.TC)
+        response = dns.query.tcp(query, self.stub.host, 1, self.stub.port)
+        self.assertEqual(len(response.answer[0]), 3)
+        self.assertDictContainsSubset(
+            {'queries': {'MX': 2}, 'tcp_queries': 1, 'truncated': 1},
+            self.stub.stats())
+
+    def test_run_and_report(self):
+        self.app.config['RESOLVERS'] = [self.stub.host]
+        resolver_pool.configure(lifetime=1, port=self.stub.port)
+        workload = Workload(('A', 'AAAA'), names=5)
+
+        recorder, elapsed = run_threads(WsgiTarget(self.app), workload, 2, 0.3)
+        report = make_report(recorder, elapsed, {}, self.stub.stats())
+
+        self.assertEqual(report['status'], {'200': report['requests']})
+        self.assertGreater(report['qps'], 0)
+        self.assertLessEqual(report['latency_ms']['p50'],
+                             report['latency_ms']['p99'])
+        # Everything after the first lookup of each question is cached
+        self.assertLessEqual(sum(report['upstream']['queries'].values()), 20)
+        self.assertEqual(compare(report, report)['qps'], 0)
+
+    def test_workload_is_reproducible(self):
+        first = Workload(('A', 'MX'), seed=7)
+        second = Workload(('A', 'MX'), seed=7)
+        self.assertEqual([first.next_path() for _ in range(5)],
+                         [second.next_path() for _ in range(5)])
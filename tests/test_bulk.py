@@ -0,0 +1,77 @@
+import csv
+import io
+import json
+import os
+import shutil
+import tempfile
+
+from tests import BaseTest
+
+from bench.stub import StubNameserver
+from resolverapi.bulk import Progress, main, read_names
+
+
+class BulkTests(BaseTest):
+
+    def setUp(self):
+        super(BulkTests, self).setUp()
+        self.stub = StubNameserver(answers=2)
+        self.addCleanup(self.stub.close)
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.input = os.path.join(self.tmp, 'domains.txt')
+        with open(self.input, 'w') as f:
+            f.write('# names to resolve\nhost1.bench.test\n\n'
+                    'host2.bench.test\nnot_a..name\n')
+
+    def run_bulk(self, *args):
+        output = os.path.join(self.tmp, 'results')
+        main([self.input, '-o', output, '--resolvers', self.stub.host,
+              '--port', str(self.stub.port), '--progress', '0'] + list(args))
+        with open(output) as f:
+            return f.read()
+
+    def test_ndjson(self):
+        lines = self.run_bulk('--rdtypes', 'A,MX').splitlines()
+        self.assertEqual(len(lines), 6)
+        results = [json.loads(line) for line in lines]
+        answered = [r for r in results if 'QuestionSection' in r]
+        self.assertEqual(
+            sorted((r['QuestionSection']['Qname'],
+                    r['QuestionSection']['Qtype']) for r in answered),
+            [('host1.bench.test.', 'A'), ('host1.bench.test.', 'MX'),
+             ('host2.bench.test.', 'A'), ('host2.bench.test.', 'MX')])
+        self.assertEqual(len(answered[0]['AnswerSection']), 2)
+        invalid = [r for r in results if 'QuestionSection' not in r]
+        self.assertEqual(invalid[0]['domain'], 'not_a..name')
+        self.assertEqual(invalid[0]['status'], 400)
+
+    def test_csv(self):
+        rows = list(csv.DictReader(io.StringIO(
+            self.run_bulk('--format', 'csv'))))
+        self.assertEqual(len(rows), 3)
+        rows = {row['domain']: row for row in rows}
+        self.assertEqual(rows['host1.bench.test']['status'], '200')
+        self.assertEqual(rows['host1.bench.test']['rcode'], 'NOERROR')
+        self.assertEqual(len(rows['host1.bench.test']['answers'].split('; ')),
+                         2)
+        self.assertEqual(rows['not_a..name']['status'], '400')
+
+    def test_unsupported_rdtype(self):
+        self.assertRaises(SystemExit, self.run_bulk, '--rdtypes', 'HINFO')
+
+    def test_read_names_is_lazy(self):
+        def lines():
+            yield 'a.test\n'
+            raise AssertionError('read too far')
+        self.assertEqual(next(read_names(lines())), 'a.test')
+
+    def test_progress(self):
+        stream = io.StringIO()
+        progress = Progress(interval=0, stream=stream).start()
+        for code in (200, 200, 404, 503, 400):
+            progress.add(code)
+        progress.stop()
+        self.assertIn('5 resolved', stream.getvalue())
+        self.assertIn('2 answered, 1 not found, 1 failed, 1 invalid',
+                      stream.getvalue())
@@ -0,0 +1,213 @@
+import gc
+import time
+import tracemalloc
+
+from tests import BaseTest
+
+import dns.message
+import dns.name
+from mock import patch
+from dns.exception import Timeout
+from dns.resolver import Answer, NXDOMAIN
+
+from resolverapi import answer_cache
+from resolverapi.endpoints import encoded
+from resolverapi.util.cache import AnswerCache, estimate_size
+from tests.test_util import make_answer, TEST_DOMAIN
+
+
+class AnswerCacheTests(BaseTest):
+
+    def test_hit_skips_upstream(self):
+        with patch('resolverapi.endpoints.resolver_pool.query') as query:
+            query.return_value = make_answer('A', answers=['10.0.0.1'])
+            first, code = self.get('A/%s' % TEST_DOMAIN)
+            self.assert200(code)
+            second, code = self.get('a/TestDomain.com')
+            self.assert200(code)
+
+        self.assertEqual(query.call_count, 1)
+        self.assertEqual(first['AnswerSection'], second['AnswerSection'])
+        self.assertDictContainsSubset({'hits': 1, 'misses': 1},
+                                      answer_cache.stats())
+
+    def test_ttl_is_decremented(self):
+        with patch('resolverapi.endpoints.resolver_pool.query') as query:
+            query.return_value = make_answer('A', answers=['10.0.0.1'])
+            self.get('A/%s' % TEST_DOMAIN)
+
+        entry = answer_cache.get(TEST_DOMAIN, 'A')
+        entry.stored -= 25
+        resp, code = self.get('A/%s' % TEST_DOMAIN)
+        self.assert200(code)
+        self.assertEqual(resp['AnswerSection'][0]['TTL'], 35)
+
+    def test_expired_entry_is_a_miss(self):
+        with patch('resolverapi.endpoints.resolver_pool.query') as query:
+            query.return_value = make_answer('A', answers=['10.0.0.1'])
+            self.get('A/%s' % TEST_DOMAIN)
+            answer_cache.get(TEST_DOMAIN, 'A').expires -= 60
+            self.get('A/%s' % TEST_DOMAIN)
+
+        self.assertEqual(query.call_count, 2)
+
+    def test_nxdomain_is_cached_negatively(self):
+        with patch('resolverapi.endpoints.resolver_pool.query') as query:
+            query.side_effect = NXDOMAIN
+            self.get('A/%s' % TEST_DOMAIN)
+            resp, code = self.get('A/%s' % TEST_DOMAIN)
+
+        self.assert404(code)
+        self.assertEqual(query.call_count, 1)
+
+    def test_nodata_uses_soa_minimum(self):
+        soa = ['auth1.{0} hostmaster.{0} 1 2 3 4 30'.format(TEST_DOMAIN)]
+        answer = make_answer('SOA', authorities=soa)
+        answer_cache.put(TEST_DOMAIN, 'MX', answer, '1.1.1.1')
+
+        entry = answer_cache.get(TEST_DOMAIN, 'MX')
+        self.assertEqual(entry.expires - entry.stored, 30)
+
+    def test_memory_cap_evicts_least_recently_used(self):
+        answer = make_answer('A', answers=['10.0.0.1'])
+        max_bytes = estimate_size(answer.response) * 5 // 2
+        cache = AnswerCache(max_bytes=max_bytes)
+        for name in ('a.com', 'b.com', 'c.com'):
+            cache.put(name, 'A', answer, '1.1.1.1')
+            cache.get('a.com', 'A')
+
+        self.assertIsNotNone(cache.get('a.com', 'A'))
+        self.assertIsNone(cache.get('b.com', 'A'))
+        self.assertLessEqual(cache.stats()['bytes'], max_bytes)
+
+    def test_memory_cap_bounds_real_memory(self):
+        max_bytes = 128 * 1024
+        records = {
+            'A': ['10.0.0.%d' % i for i in range(4)],
+            'MX': ['%d mx%d.example.com.' % (i, i) for i in range(8)],
+            'TXT': ['"%s"' % (c * 200) for c in 'abc']
+        }
+        wires = []
+        for rdtype, data in records.items():
+            answer = make_answer(rdtype, answers=data)
+            answer.response.question = [answer.response.answer[0]]
+            wires.append((answer.rdtype, answer.response.to_wire()))
+        qname = dns.name.from_text(TEST_DOMAIN)
+
+        gc.collect()
+        tracemalloc.start()
+        try:
+            cache = AnswerCache(max_bytes=max_bytes)
+            for i in range(300):
+                rdtype, wire = wires[i % len(wires)]
+                answer = Answer(qname, rdtype, 1, dns.message.from_wire(wire),
+                                raise_on_no_answer=False)
+                cache.put('host%d.example.com.' % i, rdtype, answer, '')
+                del answer
+            gc.collect()
+            used = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        self.assertLessEqual(cache.stats()['bytes'], max_bytes)
+        self.assertLessEqual(used, max_bytes)
+        # The estimate is not so far off that the cap wastes most of itself
+        self.assertGreater(used, max_bytes // 3)
+
+    def test_encoded_body_is_counted(self):
+        answer = make_answer('A', answers=['10.0.0.1'])
+        answer_cache.put(TEST_DOMAIN, 'A', answer, '1.1.1.1')
+        before = answer_cache.stats()['bytes']
+        entry = answer_cache.get(TEST_DOMAIN, 'A')
+        body = encoded(entry)
+        self.assertIs(encoded(entry), body)
+        self.assertEqual(answer_cache.stats()['bytes'], before + body.size())
+        self.assertEqual(entry.size, before + body.size())
+
+    def test_disabled(self):
+        cache = AnswerCache(max_bytes=0)
+        cache.put('a.com', 'A', make_answer('A', answers=['10.0.0.1']), '')
+        self.assertIsNone(cache.get('a.com', 'A'))
+
+
+@patch('resolverapi.endpoints.resolver_pool.query')
+class ServeStaleTests(BaseTest):
+
+    def expire(self, seconds=120):
+        entry = answer_cache.get_stale(TEST_DOMAIN, 'A') or \
+            answer_cache.get(TEST_DOMAIN, 'A')
+        entry.stored -= seconds
+        entry.expires -= seconds
+
+    def test_stale_answer_on_timeout(self, query):
+        query.return_value = make_answer('A', answers=['10.0.0.1'])
+        self.get('A/%s' % TEST_DOMAIN)
+        self.expire()
+
+        query.side_effect = Timeout
+        resp, code = self.get('A/%s' % TEST_DOMAIN)
+        self.assert200(code)
+        self.assertTrue(resp['Stale'])
+        self.assertEqual(resp['AnswerSection'][0]['TTL'], 30)
+        calls = query.call_count
+
+        # Upstream just failed, so the next request does not wait on it
+        resp, code = self.get('A/%s' % TEST_DOMAIN)
+        self.assertTrue(resp['Stale'])
+        self.assertEqual(query.call_count, calls)
+
+    def test_stale_answer_on_slow_upstream(self, query):
+        self.app.config['STALE_CLIENT_TIMEOUT'] = 0.05
+        query.return_value = make_answer('A', answers=['10.0.0.1'])
+        self.get('A/%s' % TEST_DOMAIN)
+        self.expire()
+
+        def slow(*args):
+            time.sleep(0.3)
+            return make_answer('A', answers=['10.0.0.2'])
+        query.side_effect = slow
+        resp, code = self.get('A/%s' % TEST_DOMAIN)
+        self.assert200(code)
+        self.assertTrue(resp['Stale'])
+
+        # The upstream query completes in the background and refreshes
+        time.sleep(0.5)
+        resp, code = self.get('A/%s' % TEST_DOMAIN)
+        self.assertFalse('Stale' in resp)
+        self.assertEqual(resp['AnswerSection'][0]['Address'], '10.0.0.2')
+
+    def test_hanging_upstream_is_left_alone(self, query):
+        self.app.config['STALE_CLIENT_TIMEOUT'] = 0.05
+        query.return_value = make_answer('A', answers=['10.0.0.1'])
+        self.get('A/%s' % TEST_DOMAIN)
+        self.expire()
+
+        def hang(*args, **kwargs):
+            time.sleep(0.2)
+            raise Timeout
+        query.side_effect = hang
+        resp, code = self.get('A/%s' % TEST_DOMAIN)
+        self.assertTrue(resp['Stale'])
+
+        # The background query failed after the request stopped waiting
+        time.sleep(0.4)
+        calls = query.call_count
+        started = time.time()
+        resp, code = self.get('A/%s' % TEST_DOMAIN)
+        self.assert200(code)
+        self.assertTrue(resp['Stale'])
+        self.assertEqual(query.call_count, calls)
+        self.assertLess(time.time() - started, 0.05)
+
+    def test_fresh_answer_is_not_flagged(self, query):
+        query.return_value = make_answer('A', answers=['10.0.0.1'])
+        resp, code = self.get('A/%s' % TEST_DOMAIN)
+        self.assertFalse('Stale' in resp)
+
+    def test_beyond_stale_window(self, query):
+        query.return_value = make_answer('A', answers=['10.0.0.1'])
+        self.get('A/%s' % TEST_DOMAIN)
+        self.expire(self.app.config['STALE_WINDOW'] + 120)
+
+        query.side_effect = Timeout
+        resp, code = self.get('A/%s' % TEST_DOMAIN)
+        self.assert503(code)
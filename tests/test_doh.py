@@ -0,0 +1,90 @@
+import base64
+
+import dns.message
+import dns.rrset
+
+from tests import BaseTest
+
+from resolverapi import resolver_pool
+from resolverapi.util.wire import FormError, check_query, min_ttl
+from tests.test_asgi import StubNameserver
+from tests.test_util import TEST_DOMAIN
+
+
+def make_query(rdtype='A'):
+    query = dns.message.make_query(TEST_DOMAIN, rdtype)
+    query.id = 0
+    return query.to_wire()
+
+
+class DnsQueryTests(BaseTest):
+
+    def use_stub(self, stub):
+        self.addCleanup(stub.close)
+        self.app.config['RESOLVERS'] = ['127.0.0.1']
+        resolver_pool.configure(lifetime=0.2, port=stub.port)
+
+    def doh_get(self, wire):
+        encoded = base64.urlsafe_b64encode(wire).rstrip(b'=').decode('ascii')
+        return self.test_client.get('/dns-query?dns=%s' % encoded)
+
+    def test_get(self):
+        self.use_stub(StubNameserver())
+        r = self.doh_get(make_query())
+        self.assert200(r.status_code)
+        self.assertEqual(r.mimetype, 'application/dns-message')
+        self.assertEqual(r.headers['Cache-Control'], 'max-age=60')
+        response = dns.message.from_wire(r.get_data())
+        self.assertEqual(response.id, 0)
+        self.assertEqual(response.answer[0][0].address, '10.0.0.1')
+
+    def test_post(self):
+        self.use_stub(StubNameserver())
+        query = dns.message.make_query(TEST_DOMAIN, 'A')
+        r = self.test_client.post('/dns-query', data=query.to_wire(),
+                                  content_type='application/dns-message')
+        self.assert200(r.status_code)
+        self.assertEqual(dns.message.from_wire(r.get_data()).id, query.id)
+
+    def test_timeout(self):
+        self.use_stub(StubNameserver(drop=True))
+        r = self.doh_get(make_query())
+        self.assert503(r.status_code)
+
+    def test_validation(self):
+        r = self.test_client.get('/dns-query')
+        self.assert400(r.status_code)
+        r = self.test_client.get('/dns-query?dns=not*base64')
+        self.assert400(r.status_code)
+        r = self.doh_get(b'\x00\x01')
+        self.assert400(r.status_code)
+        r = self.test_client.post('/dns-query', data=make_query(),
+                                  content_type='text/plain')
+        self.assertEqual(r.status_code, 415)
+
+
+class WireTests(BaseTest):
+
+    def test_check_query(self):
+        check_query(make_query())
+        response = dns.message.make_response(dns.message.from_wire(
+            make_query()))
+        self.assertRaises(FormError, check_query, response.to_wire())
+        self.assertRaises(FormError, check_query, make_query()[:-3])
+
+    def test_min_ttl(self):
+        query = dns.message.from_wire(make_query())
+        response = dns.message.make_response(query)
+        self.assertIsNone(min_ttl(response.to_wire()))
+
+        response.authority.append(dns.rrset.from_text(
+            TEST_DOMAIN, 300, 'IN', 'SOA',
+            'ns.{0} hostmaster.{0} 1 2 3 4 30'.format(TEST_DOMAIN)))
+        self.assertEqual(min_ttl(response.to_wire()), 30)
+
+        response.answer.append(dns.rrset.from_text(
+            TEST_DOMAIN, 120, 'IN', 'A', '10.0.0.1'))
+        response.answer.append(dns.rrset.from_text(
+            'www.' + TEST_DOMAIN, 90, 'IN', 'A', '10.0.0.2'))
+        self.assertEqual(min_ttl(response.to_wire()), 90)
+        self.assertRaises(FormError, min_ttl, response.to_wire()[:-2])
@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import json
+import time
+
 from tests import BaseTest
 
 from mock import patch
 from dns.resolver import NXDOMAIN, NoNameservers
 from dns.exception import Timeout
 
-from tests.test_util import make_answer
+from resolverapi import answer_cache
+from tests.test_util import make_answer, TEST_DOMAIN
 
 
 class LookupRecordTests(BaseTest):
@@ -14,7 +18,7 @@ class LookupRecordTests(BaseTest):
     def setUp(self):
         super(LookupRecordTests, self).setUp()
 
-    @patch('resolverapi.endpoints.dns_resolver.query')
+    @patch('resolverapi.endpoints.resolver_pool.query')
     def test_no_nameservers(self, query):
         def raises_no_nameservers(*args, **kwargs):
             raise NoNameservers
@@ -43,7 +47,7 @@ class LookupRecordTests(BaseTest):
         # Do not have unsanitized user value reflected in response
         self.assertFalse(domain in resp.get("message"))
 
-    @patch('resolverapi.endpoints.dns_resolver.query')
+    @patch('resolverapi.endpoints.resolver_pool.query')
     def test_timeout(self, query):
         resolvers = ['1.1.1.1', '2.2.2.2']
         self.app.config['RESOLVERS'] = resolvers
@@ -62,7 +66,7 @@ class LookupRecordTests(BaseTest):
         resp, code = self.get('')
         self.assert200(code)
 
-    @patch('resolverapi.endpoints.dns_resolver.query')
+    @patch('resolverapi.endpoints.resolver_pool.query')
     def test_idn_domain(self, query):
         query.return_value = make_answer('A', answers=['1.1.1.1'])
 
@@ -78,7 +82,7 @@ class LookupRecordTests(BaseTest):
         # Do not have unsanitized user value reflected in response
         self.assertFalse(domain in resp.get("message"))
 
-    @patch('resolverapi.endpoints.dns_resolver.query')
+    @patch('resolverapi.endpoints.resolver_pool.query')
     def test_nonexistent_idn_domain(self, query):
         def raises_no_nameservers(*args, **kwargs):
             raise NoNameservers
@@ -98,7 +102,7 @@ class ReverseLookupTests(BaseTest):
         super(ReverseLookupTests, self).setUp()
         self.path = 'reverse/%s'
 
-    @patch('resolverapi.endpoints.dns_resolver.query')
+    @patch('resolverapi.endpoints.resolver_pool.query')
     def test_ipv4(self, query):
         query.return_value = make_answer('PTR', answers=['target.domain.com.'])
 
@@ -106,7 +110,7 @@ class ReverseLookupTests(BaseTest):
         resp, code = self.get(self.path % ipv4_addr)
         self.assert200(code)
 
-    @patch('resolverapi.endpoints.dns_resolver.query')
+    @patch('resolverapi.endpoints.resolver_pool.query')
     def test_ipv6(self, query):
         query.return_value = make_answer('PTR', answers=['target.domain.com.'])
 
@@ -127,7 +131,7 @@ class ReverseLookupTests(BaseTest):
         resp, code = self.get(self.path % ipv4_addr)
         self.assert400(code)
 
-    @patch('resolverapi.endpoints.dns_resolver.query')
+    @patch('resolverapi.endpoints.resolver_pool.query')
     def test_nxdomain(self, query):
         def raises_nxdomain(*args, **kwargs):
             raise NXDOMAIN
@@ -136,3 +140,205 @@ class ReverseLookupTests(BaseTest):
         ipv4_addr = '1.1.1.1'
         resp, code = self.get(self.path % ipv4_addr)
         self.assert404(code)
+
+
+class BatchLookupTests(BaseTest):
+
+    @patch('resolverapi.endpoints.resolver_pool.query')
+    def test_batch(self, query):
+        def answer(nameserver, domain, rdtype, lifetime=None):
+            if domain == 'missing.com':
+                raise NXDOMAIN
+            return make_answer(rdtype, answers=['10.0.0.1'])
+        query.side_effect = answer
+
+        resp, code = self.post('/batch', [
+            {'rdtype': 'a', 'domain': 'opendns.com'},
+            ['A', 'missing.com'],
+            {'rdtype': 'NA', 'domain': 'opendns.com'},
+            {'rdtype': 'A', 'domain': 'invalid&domain'},
+            'junk'
+        ])
+        self.assert200(code)
+        self.assertEqual(len(resp), 5)
+        self.assertEqual(resp[0]['AnswerSection'][0]['Address'], '10.0.0.1')
+        self.assertEqual(resp[1]['status'], 404)
+        self.assertEqual(resp[2]['status'], 400)
+        self.assertEqual(resp[3]['status'], 400)
+        self.assertEqual(resp[4]['status'], 400)
+        self.assertEqual(query.call_count, 2)
+
+    def test_not_a_list(self):
+        resp, code = self.post('/batch', {'rdtype': 'A'})
+        self.assert400(code)
+        self.assertTrue("message" in resp)
+
+    def test_too_many_queries(self):
+        self.app.config['BATCH_MAX_SIZE'] = 2
+        resp, code = self.post('/batch', [['A', 'opendns.com']] * 3)
+        self.assert400(code)
+
+
+class ReverseSweepTests(BaseTest):
+
+    def setUp(self):
+        super(ReverseSweepTests, self).setUp()
+        self.path = '/reverse/%s'
+
+    def sweep(self, cidr):
+        r = self.test_client.get(self.path % cidr)
+        lines = r.get_data(as_text=True).splitlines()
+        return [json.loads(line) for line in lines], r.status_code
+
+    @patch('resolverapi.endpoints.resolver_pool.query')
+    def test_ipv4_sweep(self, query):
+        def answer(nameserver, qname, rdtype, lifetime=None):
+            if str(qname).startswith('3.'):
+                raise NXDOMAIN
+            return make_answer('PTR', answers=['target.domain.com.'])
+        query.side_effect = answer
+
+        results, code = self.sweep('10.0.0.0/30')
+        self.assert200(code)
+        self.assertEqual(sorted(r['IP'] for r in results),
+                         ['10.0.0.0', '10.0.0.1', '10.0.0.2', '10.0.0.3'])
+        missing = [r for r in results if r['IP'] == '10.0.0.3'][0]
+        self.assertEqual(missing['status'], 404)
+
+    @patch('resolverapi.endpoints.resolver_pool.query')
+    def test_ipv6_sweep(self, query):
+        query.return_value = make_answer('PTR', answers=['target.domain.com.'])
+
+        results, code = self.sweep('2001:db8::/126')
+        self.assert200(code)
+        self.assertEqual(len(results), 4)
+
+    def test_range_too_large(self):
+        resp, code = self.get('reverse/2001:db8::/64')
+        self.assert400(code)
+
+    def test_invalid_prefix(self):
+        resp, code = self.get('reverse/10.0.0.0/33')
+        self.assert400(code)
+
+
+class HttpCachingTests(BaseTest):
+
+    def setUp(self):
+        super(HttpCachingTests, self).setUp()
+        answer_cache.configure(0, default_negative_ttl=42)
+
+    @patch('resolverapi.endpoints.resolver_pool.query')
+    def test_max_age_is_smallest_ttl(self, query):
+        answer = make_answer('A', answers=['10.0.0.1', '10.0.0.2'])
+        answer.response.answer[0].ttl = 45
+        query.return_value = answer
+
+        r = self.test_client.get('/A/%s' % TEST_DOMAIN)
+        self.assert200(r.status_code)
+        self.assertEqual(r.headers['Cache-Control'], 'max-age=45')
+
+    @patch('resolverapi.endpoints.resolver_pool.query')
+    def test_etag_ignores_record_order(self, query):
+        query.side_effect = [
+            make_answer('A', answers=['10.0.0.1', '10.0.0.2']),
+            make_answer('A', answers=['10.0.0.2', '10.0.0.1']),
+            make_answer('A', answers=['10.0.0.3'])]
+
+        first = self.test_client.get('/A/%s' % TEST_DOMAIN)
+        etag = first.headers['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+
+        r = self.test_client.get('/A/%s' % TEST_DOMAIN,
+                                 headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.get_data(), b'')
+        self.assertEqual(r.headers['Cache-Control'], 'max-age=60')
+
+        r = self.test_client.get('/A/%s' % TEST_DOMAIN,
+                                 headers={'If-None-Match': etag})
+        self.assert200(r.status_code)
+        self.assertNotEqual(r.headers['ETag'], etag)
+
+    @patch('resolverapi.endpoints.resolver_pool.query')
+    def test_cached_answer_counts_down(self, query):
+        answer_cache.configure(1 << 20)
+        query.return_value = make_answer('A', answers=['10.0.0.1'])
+        self.test_client.get('/A/%s' % TEST_DOMAIN)
+
+        with patch('resolverapi.util.cache.time.time',
+                   return_value=time.time() + 20):
+            r = self.test_client.get('/A/%s' % TEST_DOMAIN)
+        self.assertEqual(query.call_count, 1)
+        self.assertIn(r.headers['Cache-Control'], ('max-age=39', 'max-age=40'))
+
+    @patch('resolverapi.endpoints.resolver_pool.query')
+    def test_nxdomain_uses_negative_ttl(self, query):
+        query.side_effect = NXDOMAIN
+
+        r = self.test_client.get('/reverse/1.1.1.1')
+        self.assert404(r.status_code)
+        self.assertEqual(r.headers['Cache-Control'], 'max-age=42')
+        self.assertNotIn('ETag', r.headers)
+
+    @patch('resolverapi.endpoints.resolver_pool.query')
+    def test_errors_are_not_cached(self, query):
+        query.side_effect = Timeout
+
+        r = self.test_client.get('/A/%s' % TEST_DOMAIN)
+        self.assert503(r.status_code)
+        self.assertEqual(r.headers['Cache-Control'], 'no-cache')
+
+
+class AllRecordsTests(BaseTest):
+
+    def setUp(self):
+        super(AllRecordsTests, self).setUp()
+        answer_cache.configure(1 << 20)
+
+    def answer(self, nameserver, qname, rdtype, lifetime=None):
+        if rdtype == 'A':
+            return make_answer('A', answers=['10.0.0.1'])
+        if rdtype == 'LOC':
+            time.sleep(0.5)
+        return make_answer(rdtype)
+
+    @patch('resolverapi.endpoints.resolver_pool.query')
+    def test_all_types(self, query):
+        query.side_effect = self.answer
+        resp, code = self.get('all/%s' % TEST_DOMAIN)
+        self.assert200(code)
+        self.assertEqual(sorted(resp),
+                         sorted(self.app.config['SUPPORTED_RDTYPES']))
+        self.assertEqual(resp['A']['AnswerSection'][0]['Address'], '10.0.0.1')
+        self.assertEqual(resp['MX']['AnswerSection'], [])
+
+    @patch('resolverapi.endpoints.resolver_pool.query')
+    def test_slow_type_times_out_alone(self, query):
+        self.app.config['ALL_RECORDS_TIMEOUTS'] = {'LOC': 0.05}
+        query.side_effect = self.answer
+
+        t1 = time.time()
+        r = self.test_client.get('/all/%s' % TEST_DOMAIN)
+        self.assertLess(time.time() - t1, 0.4)
+        resp = json.loads(r.get_data(as_text=True))
+        self.assertEqual(resp['LOC']['status'], 503)
+        self.assertNotIn('status', resp['A'])
+        self.assertEqual(r.headers['Cache-Control'], 'no-cache')
+
+    @patch('resolverapi.endpoints.resolver_pool.query')
+    def test_reuses_cached_answers(self, query):
+        self.app.config['SUPPORTED_RDTYPES'] = ('A', 'MX')
+        query.side_effect = self.answer
+        self.get('A/%s' % TEST_DOMAIN)
+
+        r = self.test_client.get('/all/%s' % TEST_DOMAIN)
+        self.assert200(r.status_code)
+        self.assertEqual(sorted(call[0][2] for call in query.call_args_list),
+                         ['A', 'MX'])
+        self.assertIn(r.headers['Cache-Control'],
+                      ('max-age=59', 'max-age=60'))
+
+    def test_invalid_domain(self):
+        resp, code = self.get('all/invalid&domain')
+        self.assert400(code)
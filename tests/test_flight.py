@@ -0,0 +1,185 @@
+import fcntl
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from tests import BaseTest
+
+from mock import patch
+from dns.exception import Timeout
+from dns.resolver import NXDOMAIN
+
+from resolverapi import answer_cache
+from resolverapi.util.cache import make_key
+from resolverapi.util.flight import SingleFlight, HostFlight
+from tests.test_util import make_answer, TEST_DOMAIN
+
+
+def run_concurrently(fn, count):
+    results = [None] * count
+
+    def run(i):
+        try:
+            results[i] = fn(i)
+        except Exception as e:
+            results[i] = e
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class SingleFlightTests(BaseTest):
+
+    def slow_answer(self, calls, delay=0.1):
+        def resolve():
+            calls.append(1)
+            time.sleep(delay)
+            return make_answer('A', answers=['10.0.0.1']), '1.1.1.1'
+        return resolve
+
+    def test_coalesces_concurrent_calls(self):
+        flight = SingleFlight()
+        calls = []
+        key = make_key(TEST_DOMAIN, 'A')
+        results = run_concurrently(
+            lambda i: flight.do(key, self.slow_answer(calls)), 5)
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(r is results[0] for r in results))
+        self.assertEqual(flight.stats(), {'leaders': 1, 'coalesced': 4})
+
+    def test_errors_are_shared(self):
+        flight = SingleFlight()
+
+        def fail():
+            time.sleep(0.1)
+            raise NXDOMAIN
+        results = run_concurrently(lambda i: flight.do('key', fail), 3)
+        self.assertTrue(all(isinstance(r, NXDOMAIN) for r in results))
+        self.assertEqual(flight.calls, {})
+
+    def test_callers_wait_until_their_own_deadline(self):
+        flight = SingleFlight()
+        calls = []
+        key = make_key(TEST_DOMAIN, 'A')
+        deadlines = [time.time() + 0.02, None, time.time() + 0.02]
+
+        def call(i):
+            # The impatient leader goes first
+            time.sleep(0.01 * bool(i))
+            return flight.do(key, self.slow_answer(calls),
+                             deadline=deadlines[i])
+        results = run_concurrently(call, 3)
+        self.assertEqual(len(calls), 1)
+        self.assertIsInstance(results[0], Timeout)
+        self.assertEqual(results[1][1], '1.1.1.1')
+        self.assertIsInstance(results[2], Timeout)
+        self.assertEqual(flight.calls, {})
+
+    @patch('resolverapi.endpoints.resolver_pool.query')
+    def test_client_timeout_is_not_shared(self, query):
+        answer_cache.configure(0)
+
+        def slow(*args):
+            time.sleep(0.2)
+            return make_answer('A', answers=['10.0.0.1'])
+        query.side_effect = slow
+
+        def request(i):
+            time.sleep(0.05 * i)
+            client = self.app.test_client()
+            return client.get('/A/%s%s' % (TEST_DOMAIN,
+                                           ('?timeout=0.05', '')[i]))
+        impatient, patient = run_concurrently(request, 2)
+        self.assert503(impatient.status_code)
+        self.assert200(patient.status_code)
+        self.assertEqual(query.call_count, 1)
+
+    def test_coalesces_across_processes(self):
+        """Two SingleFlights stand in for two worker processes"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        workers = [SingleFlight(), SingleFlight()]
+        for worker in workers:
+            worker.configure(shared=HostFlight(directory))
+        calls = []
+        key = make_key(TEST_DOMAIN, 'A')
+
+        results = run_concurrently(
+            lambda i: workers[i].do(key, self.slow_answer(calls)), 2)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(workers[0].stats()['shared'] +
+                         workers[1].stats()['shared'], 1)
+        for answer, nameserver in results:
+            self.assertEqual(nameserver, '1.1.1.1')
+            self.assertEqual(answer.response.answer[0][0].address, '10.0.0.1')
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_late_waiter_keeps_answer(self):
+        """Four workers, one of which only tries the lock once the holder
+        has answered while the others are still reading the answer"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        workers = [HostFlight(directory) for _ in range(4)]
+        calls = []
+        key = make_key(TEST_DOMAIN, 'A')
+        flock, read = fcntl.flock, HostFlight.read
+
+        def late_flock(fd, operation):
+            if (operation & fcntl.LOCK_NB and
+                    threading.current_thread().name == 'late'):
+                time.sleep(0.15)
+            return flock(fd, operation)
+
+        def slow_read(flight, fd):
+            time.sleep(0.1)
+            return read(flight, fd)
+
+        def run(i):
+            time.sleep(0.02 * bool(i))
+            workers[i].do(key, self.slow_answer(calls))
+        threads = [threading.Thread(target=run, args=(i,),
+                                    name='late' if i == 3 else None)
+                   for i in range(4)]
+        t1 = time.time()
+        with patch('resolverapi.util.flight.fcntl.flock', late_flock), \
+                patch.object(HostFlight, 'read', slow_read):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sum(worker.hits for worker in workers), 3)
+        # The waiters read side by side, not one after another
+        self.assertLess(time.time() - t1, 0.35)
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_uncontended_lookup_writes_no_answer(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        flight = HostFlight(directory)
+        calls = []
+        with patch.object(HostFlight, 'encode') as encode:
+            for name in ('a.com', 'b.com'):
+                flight.do(make_key(name, 'A'), self.slow_answer(calls, 0))
+        self.assertEqual(len(calls), 2)
+        self.assertFalse(encode.called)
+        self.assertEqual(os.listdir(directory), [])
+
+    @patch('resolverapi.endpoints.resolver_pool.query')
+    def test_batch_of_identical_queries(self, query):
+        answer_cache.configure(0)
+
+        def slow(*args):
+            time.sleep(0.1)
+            return make_answer('A', answers=['10.0.0.1'])
+        query.side_effect = slow
+
+        resp, code = self.post('/batch', [['A', TEST_DOMAIN]] * 10)
+        self.assert200(code)
+        self.assertEqual(query.call_count, 1)
+        self.assertEqual(len(resp), 10)
@@ -0,0 +1,111 @@
+import threading
+import time
+
+from tests import BaseTest
+
+from mock import patch
+from dns.exception import Timeout
+
+from resolverapi import answer_cache, health_tracker
+from resolverapi.util.health import HealthTracker
+from tests.test_util import make_answer, TEST_DOMAIN
+
+
+class HealthTrackerTests(BaseTest):
+
+    def setUp(self):
+        super(HealthTrackerTests, self).setUp()
+        self.tracker = HealthTracker()
+        self.tracker.configure(failure_threshold=2, backoff=5.0)
+
+    def test_orders_by_rtt(self):
+        self.tracker.record_success('1.1.1.1', 0.300)
+        self.tracker.record_success('2.2.2.2', 0.020)
+        self.assertEqual(self.tracker.order(['1.1.1.1', '2.2.2.2']),
+                         ['2.2.2.2', '1.1.1.1'])
+
+    def test_timeouts_push_server_back(self):
+        self.tracker.record_success('1.1.1.1', 0.020)
+        self.tracker.record_success('2.2.2.2', 0.100)
+        self.tracker.record_timeout('1.1.1.1')
+        self.assertEqual(self.tracker.order(['1.1.1.1', '2.2.2.2']),
+                         ['2.2.2.2', '1.1.1.1'])
+
+    def test_circuit_opens_and_probes(self):
+        servers = ['1.1.1.1', '2.2.2.2']
+        self.tracker.record_timeout('1.1.1.1')
+        self.tracker.record_timeout('1.1.1.1')
+        self.assertEqual(self.tracker.order(servers), ['2.2.2.2'])
+
+        # Once the backoff expires one request probes the broken server,
+        # after the healthy one
+        self.tracker.servers['1.1.1.1'].open_until -= 10
+        probes = []
+        self.assertEqual(self.tracker.order(servers, probes),
+                         ['2.2.2.2', '1.1.1.1'])
+        self.assertEqual(probes, ['1.1.1.1'])
+        self.assertEqual(self.tracker.order(servers), ['2.2.2.2'])
+
+        # A failed probe doubles the backoff, a good one closes the circuit
+        self.tracker.record_timeout('1.1.1.1')
+        self.assertEqual(self.tracker.servers['1.1.1.1'].backoff, 10.0)
+        self.tracker.record_success('1.1.1.1', 0.020)
+        self.assertFalse(self.tracker.stats()['1.1.1.1']['CircuitOpen'])
+
+    @patch('resolverapi.endpoints.resolver_pool.query')
+    def test_probe_runs_in_the_background(self, query):
+        self.app.config['RESOLVERS'] = ['1.1.1.1', '2.2.2.2']
+        answer_cache.configure(0)
+        probed = threading.Event()
+
+        def primary_down(nameserver, qname, rdtype, lifetime=None):
+            if nameserver == '1.1.1.1':
+                time.sleep(0.5)
+                probed.set()
+                raise Timeout
+            return make_answer('A', answers=['10.0.0.1'])
+        query.side_effect = primary_down
+        tracker = health_tracker
+        tracker.record_success('2.2.2.2', 0.020)
+        for _ in range(tracker.failure_threshold):
+            tracker.record_timeout('1.1.1.1')
+        tracker.servers['1.1.1.1'].open_until = time.time()
+
+        t1 = time.time()
+        resp, code = self.get('A/%s' % TEST_DOMAIN)
+        self.assert200(code)
+        self.assertEqual(resp['Query']['Server'], '2.2.2.2')
+        self.assertLess(time.time() - t1, 0.4)
+        self.assertTrue(probed.wait(5))
+
+    def test_all_circuits_open(self):
+        for nameserver in ('1.1.1.1', '2.2.2.2'):
+            self.tracker.record_timeout(nameserver)
+            self.tracker.record_timeout(nameserver)
+        self.assertEqual(len(self.tracker.order(['1.1.1.1', '2.2.2.2'])), 2)
+
+    @patch('resolverapi.endpoints.resolver_pool.query')
+    def test_failing_server_is_skipped(self, query):
+        self.app.config['RESOLVERS'] = ['1.1.1.1', '2.2.2.2']
+        answer_cache.configure(0)
+        tried = []
+
+        def primary_down(nameserver, qname, rdtype, lifetime=None):
+            tried.append(nameserver)
+            if nameserver == '1.1.1.1':
+                raise Timeout
+            return make_answer('A', answers=['10.0.0.1'])
+        query.side_effect = primary_down
+
+        for _ in range(4):
+            resp, code = self.get('A/%s' % TEST_DOMAIN)
+            self.assert200(code)
+            self.assertEqual(resp['Query']['Server'], '2.2.2.2')
+        self.assertEqual(tried.count('1.1.1.1'), 1)
+
+        resp, code = self.get('nameservers')
+        self.assert200(code)
+        self.assertEqual(resp['1.1.1.1']['Timeouts'], 1)
+        self.assertEqual(resp['2.2.2.2']['Queries'], 4)
+        self.assertEqual(resp['2.2.2.2']['Edns']['Payload'], 1232)
+        self.assertIn('RetransmitTimeout', resp['2.2.2.2'])
@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+
+from tests import BaseTest
+
+from mock import patch
+from dns.resolver import NXDOMAIN
+
+from resolverapi.util.metrics import metrics, Metrics, ValueFile, read_file
+from tests.test_util import make_answer, TEST_DOMAIN
+
+
+class MetricsEndpointTests(BaseTest):
+
+    def scrape(self):
+        r = self.test_client.get('/metrics')
+        self.assert200(r.status_code)
+        return r.get_data(as_text=True)
+
+    def test_lookup_series(self):
+        with patch('resolverapi.endpoints.resolver_pool.query') as query:
+            query.return_value = make_answer('A', answers=['10.0.0.1'])
+            self.get('A/%s' % TEST_DOMAIN)
+            self.get('A/%s' % TEST_DOMAIN)
+
+        text = self.scrape()
+        self.assertIn('# TYPE openresolve_request_duration_seconds histogram',
+                      text)
+        self.assertIn('openresolve_request_duration_seconds_count{'
+                      'rdtype="A",route="/<rdtype>/<domain>"} 2', text)
+        self.assertIn('openresolve_upstream_queries_total{'
+                      'nameserver="208.67.222.222",outcome="success"} 1', text)
+        self.assertIn('openresolve_upstream_rtt_seconds_bucket{'
+                      'le="+Inf",nameserver="208.67.222.222"} 1', text)
+        self.assertIn('openresolve_cache_lookups_total{result="hit"} 1', text)
+        self.assertIn('openresolve_cache_lookups_total{result="miss"} 1', text)
+
+    def test_error_causes(self):
+        with patch('resolverapi.endpoints.resolver_pool.query') as query:
+            query.side_effect = NXDOMAIN
+            self.get('A/%s' % TEST_DOMAIN)
+        self.get('NA/%s' % TEST_DOMAIN)
+
+        text = self.scrape()
+        self.assertIn('openresolve_responses_total{cause="nxdomain",'
+                      'route="/<rdtype>/<domain>",status="404"} 1', text)
+        self.assertIn('openresolve_responses_total{cause="validation",'
+                      'route="/<rdtype>/<domain>",status="400"} 1', text)
+        self.assertIn('rdtype="unsupported"', text)
+
+    def test_histogram_buckets_are_cumulative(self):
+        registry = Metrics()
+        for value in (0.003, 0.02, 0.02, 7):
+            registry.observe('openresolve_upstream_rtt_seconds', value)
+        lines = registry.render().splitlines()
+        self.assertIn('openresolve_upstream_rtt_seconds_bucket{le="0.005"} 1',
+                      lines)
+        self.assertIn('openresolve_upstream_rtt_seconds_bucket{le="0.025"} 3',
+                      lines)
+        self.assertIn('openresolve_upstream_rtt_seconds_bucket{le="+Inf"} 4',
+                      lines)
+        self.assertIn('openresolve_upstream_rtt_seconds_count 4', lines)
+        buckets = [l for l in lines if '_bucket' in l]
+        self.assertTrue(buckets[-1].startswith(
+            'openresolve_upstream_rtt_seconds_bucket{le="+Inf"}'))
+
+
+class WorkerAggregationTests(BaseTest):
+
+    def setUp(self):
+        super(WorkerAggregationTests, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        metrics.configure(self.directory)
+        self.addCleanup(metrics.configure)
+
+    def test_workers_are_summed(self):
+        metrics.inc('openresolve_cache_lookups_total', {'result': 'hit'})
+        pid = os.fork()
+        if pid == 0:
+            metrics.inc('openresolve_cache_lookups_total', {'result': 'hit'},
+                        2)
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+        self.assertIn('openresolve_cache_lookups_total{result="hit"} 3',
+                      metrics.render())
+
+    def test_value_file_grows_and_reopens(self):
+        path = os.path.join(self.directory, 'metrics_1.db')
+        values = ValueFile(path, size=64)
+        for i in range(100):
+            values.add('key%d' % i, i)
+        values.add('key5', 1)
+        values.close()
+
+        reopened = ValueFile(path)
+        reopened.add('key5', 1)
+        reopened.close()
+        stored = read_file(path)
+        self.assertEqual(len(stored), 100)
+        self.assertEqual(stored['key5'], 7)
+        self.assertEqual(stored['key99'], 99)
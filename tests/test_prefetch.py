@@ -0,0 +1,98 @@
+import time
+
+from tests import BaseTest
+
+from mock import patch
+
+from resolverapi import answer_cache, prefetcher
+from resolverapi.util.prefetch import Prefetcher
+from resolverapi.util.ratelimit import TokenBucket
+from tests.test_util import make_answer, TEST_DOMAIN
+
+
+@patch('resolverapi.endpoints.resolver_pool.query')
+class PrefetchTests(BaseTest):
+
+    def lookup(self):
+        return self.get('A/%s' % TEST_DOMAIN)
+
+    def wait_for_prefetch(self):
+        deadline = time.time() + 2
+        while prefetcher.in_progress and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_hot_name_is_refreshed(self, query):
+        query.return_value = make_answer('A', answers=['10.0.0.1'])
+        self.lookup()
+        for _ in range(3):
+            self.lookup()
+        self.assertEqual(query.call_count, 1)
+
+        # Age the entry so that less than 10% of its TTL remains
+        entry = answer_cache.get(TEST_DOMAIN, 'A')
+        entry.stored -= 55
+        entry.expires -= 55
+        query.return_value = make_answer('A', answers=['10.0.0.2'])
+        resp, code = self.lookup()
+        self.assert200(code)
+        self.assertEqual(resp['AnswerSection'][0]['Address'], '10.0.0.1')
+        self.wait_for_prefetch()
+
+        self.assertEqual(query.call_count, 2)
+        entry = answer_cache.get(TEST_DOMAIN, 'A')
+        self.assertEqual(entry.answer.response.answer[0][0].address,
+                         '10.0.0.2')
+        self.assertDictContainsSubset({'demand': 1, 'prefetch': 1},
+                                      prefetcher.stats())
+
+    def test_cold_name_is_not_refreshed(self, query):
+        query.return_value = make_answer('A', answers=['10.0.0.1'])
+        self.lookup()
+        entry = answer_cache.get(TEST_DOMAIN, 'A')
+        entry.stored -= 55
+        entry.expires -= 55
+        self.lookup()
+        self.wait_for_prefetch()
+        self.assertEqual(query.call_count, 1)
+
+
+class PrefetchRateTests(BaseTest):
+
+    def test_hit_rate_decides(self):
+        fetcher = Prefetcher()
+        fetcher.configure(fraction=0.1, min_rate=0.05)
+        answer_cache.put('a.com', 'A', make_answer('A', answers=['10.0.0.1']),
+                         '1.1.1.1')
+        entry = answer_cache.get('a.com', 'A')
+        entry.expires = entry.stored + 300
+        now = entry.stored + 280
+        # A burst of hits right after the entry was stored, then quiet
+        entry.hits = 10
+        self.assertFalse(fetcher.due(entry, now))
+        entry.hits = 14
+        self.assertTrue(fetcher.due(entry, now))
+        # Not before the end of the TTL however hot
+        entry.hits = 1000
+        self.assertFalse(fetcher.due(entry, entry.stored + 200))
+
+
+class PrefetchBudgetTests(BaseTest):
+
+    def test_budget_caps_prefetches(self):
+        fetcher = Prefetcher()
+        fetcher.configure(min_rate=0, max_qps=2)
+        answer_cache.put('a.com', 'A', make_answer('A', answers=['10.0.0.1']),
+                         '1.1.1.1')
+        entry = answer_cache.get('a.com', 'A')
+        entry.expires = entry.stored + 1
+        scheduled = [fetcher.maybe_prefetch(i, entry, lambda: None)
+                     for i in range(5)]
+        self.assertEqual(scheduled.count(True), 2)
+        self.assertEqual(fetcher.stats()['dropped'], 3)
+
+    def test_token_bucket_refills(self):
+        bucket = TokenBucket(rate=100, burst=1)
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+        bucket.updated -= 0.02
+        self.assertTrue(bucket.consume())
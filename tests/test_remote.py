@@ -0,0 +1,136 @@
+import socket
+import threading
+import time
+
+from tests import BaseTest
+
+from mock import patch
+
+from resolverapi import answer_cache
+from resolverapi.util.cache import AnswerCache, make_key
+from resolverapi.util.remote import MemoryTier, RedisTier
+from tests.test_util import make_answer, TEST_DOMAIN
+
+
+class StubRedis(object):
+    """Serves GET and SET from a dict on a local TCP port, or accepts
+    connections and never replies when slow is set."""
+
+    def __init__(self, slow=False):
+        self.slow = slow
+        self.values = {}
+        self.connections = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(8)
+        self.port = self.sock.getsockname()[1]
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        reader = conn.makefile('rb')
+        while True:
+            line = reader.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(reader.readline()[1:])
+                args.append(reader.read(length + 2)[:-2])
+            if self.slow:
+                continue
+            if args[0] == b'GET':
+                value = self.values.get(args[1])
+                if value is None:
+                    conn.sendall(b'$-1\r\n')
+                else:
+                    conn.sendall(b'$%d\r\n%s\r\n' % (len(value), value))
+            elif args[0] == b'SET':
+                self.values[args[1]] = args[2]
+                conn.sendall(b'+OK\r\n')
+            else:
+                conn.sendall(b'-ERR unknown command\r\n')
+
+    def close(self):
+        self.sock.close()
+
+
+class RemoteTierTests(BaseTest):
+
+    def make_cache(self, remote):
+        cache = AnswerCache()
+        cache.configure(64 * 1024, remote=remote)
+        return cache
+
+    def test_nodes_share_answers(self):
+        remote = MemoryTier()
+        node1, node2 = self.make_cache(remote), self.make_cache(remote)
+        node1.put(TEST_DOMAIN, 'A', make_answer('A', answers=['10.0.0.1']),
+                  '127.0.0.1')
+        node1.put_nxdomain('missing.com', 'A')
+
+        entry = node2.get(TEST_DOMAIN, 'A')
+        self.assertEqual(entry.answer.rrset[0].address, '10.0.0.1')
+        self.assertTrue(node2.get('missing.com', 'A').nxdomain)
+        # Now held locally, so the remote tier is not asked again
+        node2.get(TEST_DOMAIN, 'A')
+        self.assertEqual(node2.stats()['remote_hits'], 2)
+        self.assertEqual(remote.stats()['hits'], 2)
+
+    def test_redis_round_trip(self):
+        stub = StubRedis()
+        self.addCleanup(stub.close)
+        remote = RedisTier(port=stub.port, timeout=1)
+        self.addCleanup(remote.disconnect)
+        node1, node2 = self.make_cache(remote), self.make_cache(remote)
+        for i in range(3):
+            node1.put('host%d.com' % i, 'A',
+                      make_answer('A', answers=['10.0.0.%d' % i]), '127.0.0.1')
+
+        node2.warm([('host%d.com' % i, 'A') for i in range(4)])
+        self.assertEqual(node2.stats()['entries'], 3)
+        self.assertDictContainsSubset({'hits': 3, 'misses': 1, 'errors': 0},
+                                      remote.stats())
+        self.assertEqual(stub.connections, 1)
+        self.assertIn(b'openresolve:host2.com.|1|1', stub.values)
+
+    def test_slow_server_is_skipped(self):
+        stub = StubRedis(slow=True)
+        self.addCleanup(stub.close)
+        remote = RedisTier(port=stub.port, timeout=0.05, backoff=60)
+        self.addCleanup(remote.disconnect)
+        cache = self.make_cache(remote)
+
+        t1 = time.time()
+        self.assertIsNone(cache.get(TEST_DOMAIN, 'A'))
+        self.assertIsNone(cache.get(TEST_DOMAIN, 'A'))
+        self.assertLess(time.time() - t1, 0.5)
+        self.assertDictContainsSubset({'errors': 1, 'available': False},
+                                      remote.stats())
+
+    def test_batch_uses_remote_answers(self):
+        remote = MemoryTier()
+        peer = self.make_cache(remote)
+        peer.put(TEST_DOMAIN, 'A', make_answer('A', answers=['10.0.0.1']),
+                 '127.0.0.1')
+        answer_cache.configure(64 * 1024, remote=remote)
+
+        with patch('resolverapi.endpoints.resolver_pool.query') as query:
+            resp, code = self.post('/batch', [['A', TEST_DOMAIN]])
+
+        self.assert200(code)
+        self.assertEqual(query.call_count, 0)
+        self.assertEqual(resp[0]['AnswerSection'][0]['Address'], '10.0.0.1')
+        self.assertIsNotNone(answer_cache.store.get(make_key(TEST_DOMAIN, 'A')))
@@ -0,0 +1,203 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from tests import BaseTest
+
+from mock import patch
+
+from resolverapi import answer_cache
+from resolverapi.util.cache import AnswerCache, key_bytes, make_key
+from resolverapi.util.shmcache import SharedStore, STRIPES, key_hash
+from tests.test_util import make_answer, TEST_DOMAIN
+
+
+class SharedStoreTests(BaseTest):
+
+    def setUp(self):
+        super(SharedStoreTests, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'cache')
+
+    def make_cache(self, max_bytes=64 * 1024, slot_size=1024):
+        store = SharedStore(self.path, max_bytes, slot_size)
+        self.addCleanup(store.close)
+        cache = AnswerCache()
+        cache.configure(max_bytes, store=store)
+        return cache
+
+    def test_workers_share_entries(self):
+        worker1, worker2 = self.make_cache(), self.make_cache()
+        mx = ['10 mail.%s' % TEST_DOMAIN]
+        worker1.put(TEST_DOMAIN, 'MX', make_answer('MX', answers=mx),
+                    '127.0.0.1')
+
+        entry = worker2.get(TEST_DOMAIN, 'MX')
+        self.assertEqual(entry.nameserver, '127.0.0.1')
+        self.assertEqual(entry.answer.rrset[0].preference, 10)
+        self.assertEqual(worker2.stats()['entries'], 1)
+
+    def test_forked_worker_shares_entries(self):
+        cache = self.make_cache()
+        pid = os.fork()
+        if pid == 0:
+            cache.put(TEST_DOMAIN, 'A', make_answer('A', answers=['10.0.0.1']),
+                      '127.0.0.1')
+            os._exit(0)
+        os.waitpid(pid, 0)
+        entry = cache.get(TEST_DOMAIN, 'A')
+        self.assertEqual(entry.answer.rrset[0].address, '10.0.0.1')
+
+    def test_remove_and_expiry(self):
+        worker1, worker2 = self.make_cache(), self.make_cache()
+        worker1.put(TEST_DOMAIN, 'A', make_answer('A', answers=['10.0.0.1']),
+                    '127.0.0.1')
+        worker2.put_nxdomain('missing.com', 'A')
+
+        key = make_key(TEST_DOMAIN, 'A')
+        entry = worker1.store.get(key)
+        entry.expires = time.time() - 1
+        worker1.store.put(key, entry)
+        self.assertIsNone(worker2.get(TEST_DOMAIN, 'A'))
+        self.assertTrue(worker1.get('missing.com', 'A').nxdomain)
+        self.assertEqual(worker1.stats()['entries'], 1)
+
+    def test_hits_and_retry_after_are_shared(self):
+        worker1, worker2 = self.make_cache(), self.make_cache()
+        worker1.put(TEST_DOMAIN, 'A', make_answer('A', answers=['10.0.0.1']),
+                    '127.0.0.1')
+        worker1.get(TEST_DOMAIN, 'A')
+        worker1.get(TEST_DOMAIN, 'A')
+        worker1.retry_later(TEST_DOMAIN, 'A', 1234.0)
+
+        # The two hits from worker1 plus this one
+        entry = worker2.get(TEST_DOMAIN, 'A')
+        self.assertEqual(entry.hits, 3)
+        self.assertEqual(entry.retry_after, 1234.0)
+
+    def test_oversized_entry_is_not_cached(self):
+        cache = self.make_cache(slot_size=128)
+        cache.put(TEST_DOMAIN, 'A', make_answer('A', answers=['10.0.0.1']),
+                  '127.0.0.1')
+        self.assertIsNone(cache.get(TEST_DOMAIN, 'A'))
+
+    def test_full_table_evicts_soonest_to_expire(self):
+        cache = self.make_cache(max_bytes=4 * 1024)
+        for i in range(6):
+            cache.put('host%d.com' % i, 'A',
+                      make_answer('A', answers=['10.0.0.1']), '127.0.0.1')
+        self.assertEqual(cache.stats()['entries'], 4)
+
+    def test_geometry_change_uses_its_own_file(self):
+        cache = self.make_cache()
+        cache.put(TEST_DOMAIN, 'A', make_answer('A', answers=['10.0.0.1']),
+                  '127.0.0.1')
+        resized = self.make_cache(slot_size=512)
+        self.assertNotEqual(resized.store.path, cache.store.path)
+        self.assertIsNone(resized.get(TEST_DOMAIN, 'A'))
+        # The first file is left alone for the workers that have it mapped
+        self.assertEqual(cache.get(TEST_DOMAIN, 'A').nameserver, '127.0.0.1')
+
+    def count_slots(self, store, key):
+        slot_hash = key_hash(key_bytes(key))
+        return sum(1 for index in range(store.slot_count)
+                   if store.read(index)[0][1] == slot_hash)
+
+    def same_home_other_stripe(self, store, slot_hash, name):
+        other_hash = key_hash(key_bytes(make_key(name, 'A')))
+        return (other_hash % store.slot_count ==
+                slot_hash % store.slot_count and
+                other_hash % STRIPES != slot_hash % STRIPES)
+
+    def test_key_is_stored_once(self):
+        cache = self.make_cache()
+        store = cache.store
+        home = key_hash(key_bytes(make_key(TEST_DOMAIN, 'A'))) % \
+            store.slot_count
+        # A name whose key probes from the same slot
+        other = next('host%d.com' % i for i in range(10000)
+                     if key_hash(key_bytes(make_key('host%d.com' % i, 'A')))
+                     % store.slot_count == home)
+        answer = make_answer('A', answers=['10.0.0.1'])
+        cache.put(other, 'A', answer, '127.0.0.1')
+        cache.put(TEST_DOMAIN, 'A', answer, '127.0.0.1')
+        store.remove(make_key(other, 'A'))
+        cache.put(TEST_DOMAIN, 'A', answer, '127.0.0.1')
+        self.assertEqual(self.count_slots(store, make_key(TEST_DOMAIN, 'A')),
+                         1)
+
+    def test_remove_leaves_a_key_that_took_the_slot(self):
+        # 63 slots, so a key can share a home slot without sharing the key
+        # lock stripe
+        cache = self.make_cache(max_bytes=63 * 1024)
+        store = cache.store
+        slot_hash = key_hash(key_bytes(make_key(TEST_DOMAIN, 'A')))
+        home = slot_hash % store.slot_count
+        other = next('host%d.com' % i for i in range(10000)
+                     if self.same_home_other_stripe(
+                         store, slot_hash, 'host%d.com' % i))
+        answer = make_answer('A', answers=['10.0.0.1'])
+        cache.put(TEST_DOMAIN, 'A', answer, '127.0.0.1')
+        find = store.find
+
+        def replaced_after_find(key):
+            # Another worker clears the cache and stores a different key
+            # in the slot between the lookup and the lock
+            found = find(key)
+            store.clear()
+            cache.put(other, 'A', answer, '127.0.0.1')
+            return found
+
+        with patch.object(store, 'find', side_effect=replaced_after_find):
+            store.remove(make_key(TEST_DOMAIN, 'A'))
+        self.assertEqual(store.read(home)[0][1],
+                         key_hash(key_bytes(make_key(other, 'A'))))
+        self.assertIsNotNone(cache.get(other, 'A'))
+
+    def test_clear_waits_for_writers_in_this_process(self):
+        store = self.make_cache().store
+        clearing = threading.Thread(target=store.clear)
+        with store.locked(5):
+            clearing.start()
+            clearing.join(0.2)
+            self.assertTrue(clearing.is_alive())
+        clearing.join(5)
+        self.assertFalse(clearing.is_alive())
+
+    def test_concurrent_puts_are_stored_once(self):
+        cache = self.make_cache()
+        names = ['host%d.com' % i for i in range(16)]
+        answer = make_answer('A', answers=['10.0.0.1'])
+        pids = []
+        for _ in range(4):
+            pid = os.fork()
+            if pid == 0:
+                for _ in range(20):
+                    for name in names:
+                        cache.put(name, 'A', answer, '127.0.0.1')
+                    for name in names[::2]:
+                        cache.store.remove(make_key(name, 'A'))
+                os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        for name in names:
+            self.assertLessEqual(
+                self.count_slots(cache.store, make_key(name, 'A')), 1)
+
+    def test_lookup_through_shared_backend(self):
+        self.make_cache()
+        answer_cache.configure(64 * 1024, store=SharedStore(self.path,
+                                                            64 * 1024, 1024))
+        self.addCleanup(answer_cache.store.close)
+        with patch('resolverapi.endpoints.resolver_pool.query') as query:
+            query.return_value = make_answer('A', answers=['10.0.0.1'])
+            self.get('A/%s' % TEST_DOMAIN)
+            resp, code = self.get('A/%s' % TEST_DOMAIN)
+
+        self.assert200(code)
+        self.assertEqual(query.call_count, 1)
+        self.assertEqual(resp['AnswerSection'][0]['Address'], '10.0.0.1')
@@ -0,0 +1,143 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from tests import BaseTest
+
+from mock import patch
+from dns.exception import Timeout
+
+from resolverapi import create_app, answer_cache, snapshotter
+from resolverapi.util.cache import (AnswerCache, CacheEntry, key_bytes,
+                                   make_key, pack_entry)
+from resolverapi.util.shmcache import SharedStore
+from resolverapi.util.snapshot import (Snapshotter, open_snapshot,
+                                      write_snapshot)
+from tests.test_util import make_answer, TEST_DOMAIN
+
+
+class SnapshotTests(BaseTest):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'cache.snapshot')
+        with patch.dict(os.environ, {'SNAPSHOT_PATH': self.path}):
+            super(SnapshotTests, self).setUp()
+        self.addCleanup(snapshotter.configure)
+
+    def restart(self):
+        with patch.dict(os.environ, {'SNAPSHOT_PATH': self.path}):
+            self.app = create_app('test')
+        self.test_client = self.app.test_client()
+
+    @patch('resolverapi.endpoints.resolver_pool.query')
+    def test_restart_is_warm(self, query):
+        query.return_value = make_answer('A', answers=['10.0.0.1'])
+        self.get('A/%s' % TEST_DOMAIN)
+        self.assertEqual(snapshotter.save(), 1)
+
+        self.restart()
+        self.assertEqual(answer_cache.stats()['entries'], 0)
+        with patch('resolverapi.util.cache.time.time',
+                   return_value=time.time() + 20):
+            resp, code = self.get('A/%s' % TEST_DOMAIN)
+        self.assert200(code)
+        self.assertEqual(query.call_count, 1)
+        self.assertIn(resp['AnswerSection'][0]['TTL'], (39, 40))
+        self.assertEqual(answer_cache.stats()['snapshot_hits'], 1)
+
+    @patch('resolverapi.endpoints.resolver_pool.query')
+    def test_stale_entries_survive(self, query):
+        query.return_value = make_answer('A', answers=['10.0.0.1'])
+        self.get('A/%s' % TEST_DOMAIN)
+        entry = answer_cache.get(TEST_DOMAIN, 'A')
+        entry.stored -= 120
+        entry.expires -= 120
+        query.return_value = make_answer(
+            'MX', answers=['10 mail.%s' % TEST_DOMAIN])
+        self.get('MX/%s' % TEST_DOMAIN)
+        entry = answer_cache.get(TEST_DOMAIN, 'MX')
+        entry.expires -= 7200
+        self.assertEqual(snapshotter.save(), 1)
+
+        self.restart()
+        query.side_effect = Timeout
+        resp, code = self.get('A/%s' % TEST_DOMAIN)
+        self.assert200(code)
+        self.assertTrue(resp['Stale'])
+
+    def test_saves_keep_other_workers_entries(self):
+        now = time.time()
+        other = make_key('other.example.', 'A')
+        expired = make_key('expired.example.', 'A')
+        write_snapshot(self.path, [
+            (key_bytes(other), pack_entry(
+                CacheEntry(None, None, True, now, now + 60, 0))),
+            (key_bytes(expired), pack_entry(
+                CacheEntry(None, None, True, now - 9000, now - 8000, 0)))])
+        answer_cache.put_nxdomain(TEST_DOMAIN, 'A')
+
+        self.assertEqual(snapshotter.save(), 2)
+        snapshot = open_snapshot(self.path)
+        self.addCleanup(snapshot.close)
+        self.assertTrue(snapshot.get(other).nxdomain)
+        self.assertTrue(snapshot.get(make_key(TEST_DOMAIN, 'A')).nxdomain)
+        self.assertIsNone(snapshot.get(expired))
+
+    def test_concurrent_saves_keep_both_workers_entries(self):
+        workers = []
+        for name in ('one.example.', 'two.example.'):
+            cache = AnswerCache(max_bytes=1024 * 1024)
+            cache.put_nxdomain(name, 'A')
+            worker = Snapshotter()
+            worker.configure(cache, self.path)
+            workers.append(worker)
+
+        def slow_write(*args):
+            time.sleep(0.1)
+            write_snapshot(*args)
+        with patch('resolverapi.util.snapshot.write_snapshot',
+                   side_effect=slow_write):
+            threads = [threading.Thread(target=worker.save)
+                       for worker in workers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        snapshot = open_snapshot(self.path)
+        self.addCleanup(snapshot.close)
+        self.assertEqual(len(snapshot), 2)
+        self.assertTrue(snapshot.get(make_key('one.example.', 'A')).nxdomain)
+        self.assertTrue(snapshot.get(make_key('two.example.', 'A')).nxdomain)
+
+    def test_saved_periodically_once_serving(self):
+        snapshotter.configure(answer_cache, self.path, 0.01)
+        answer_cache.put_nxdomain(TEST_DOMAIN, 'A')
+        self.assertFalse(os.path.exists(self.path))
+        self.get('')
+        deadline = time.time() + 2
+        while not os.path.exists(self.path) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(open_snapshot(self.path)), 1)
+
+    def test_unusable_file(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a snapshot')
+        self.assertIsNone(open_snapshot(self.path))
+        self.assertIsNone(open_snapshot(self.path + '.missing'))
+        self.restart()
+        self.assert200(self.get('')[1])
+
+    def test_shared_store_dump(self):
+        store = SharedStore(os.path.join(self.directory, 'shm'), 1 << 16)
+        self.addCleanup(store.close)
+        key = make_key(TEST_DOMAIN, 'A')
+        now = time.time()
+        store.put(key, CacheEntry(None, None, True, now, now + 60, 0))
+        (data, expires, entry_data), = list(store.dump())
+        self.assertEqual(data, key_bytes(key))
+        self.assertEqual(expires, now + 60)
@@ -0,0 +1,93 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import dns.message
+
+from tests import BaseTest
+
+from mock import patch
+
+from bench.stub import StubNameserver
+from resolverapi import resolver_pool
+from resolverapi.util.tcp import Connection, TcpPool
+from resolverapi.util.wire import forward
+
+
+class TcpPoolTests(BaseTest):
+
+    def setUp(self):
+        super(TcpPoolTests, self).setUp()
+        self.stub = StubNameserver(answers=2, truncate=1.0)
+        self.addCleanup(self.stub.close)
+        self.pool = TcpPool()
+        self.pool.configure(size=1, idle_timeout=10.0)
+        self.addCleanup(self.pool.close)
+
+    def exchange(self, name):
+        query = dns.message.make_query(name, 'TXT')
+        wire = self.pool.exchange(query.to_wire(), self.stub.host,
+                                  self.stub.port, 1.0)
+        response = dns.message.from_wire(wire)
+        self.assertTrue(query.is_response(response))
+        return response
+
+    def test_pipelined_queries_share_a_connection(self):
+        names = ['host%d.example.' % i for i in range(20)]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            responses = list(executor.map(self.exchange, names))
+        self.assertEqual([r.question[0].name.to_text() for r in responses],
+                         names)
+        self.assertEqual(self.stub.stats()['tcp_connections'], 1)
+        self.assertEqual(self.pool.stats()['opened'], 1)
+
+    def test_pipeline_limit_is_enforced(self):
+        self.pool.configure(size=1, idle_timeout=10.0, max_pipeline=2)
+        self.stub.latency = 0.02
+        in_flight = []
+        dispatch = Connection.dispatch
+
+        def record(connection, response):
+            in_flight.append(connection.in_flight)
+            dispatch(connection, response)
+
+        names = ['host%d.example.' % i for i in range(8)]
+        with patch.object(Connection, 'dispatch', autospec=True,
+                          side_effect=record):
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                responses = list(executor.map(self.exchange, names))
+        self.assertEqual(len(responses), 8)
+        self.assertEqual(self.pool.stats()['opened'], 1)
+        self.assertLessEqual(max(in_flight), 2)
+
+    def test_idle_connections_are_closed(self):
+        self.pool.configure(size=1, idle_timeout=0.05)
+        self.exchange('first.example.')
+        time.sleep(0.2)
+        key = '%s:%d' % (self.stub.host, self.stub.port)
+        self.assertEqual(self.pool.stats()['connections'][key], 0)
+        self.exchange('second.example.')
+        self.assertEqual(self.stub.stats()['tcp_connections'], 2)
+
+    def test_truncated_doh_responses_use_the_pool(self):
+        query = dns.message.make_query('example.com.', 'TXT')
+        query.id = 0
+        for _ in range(3):
+            response, nameserver = forward(
+                query.to_wire(), [self.stub.host], self.stub.port, 1.0,
+                tcp_pool=self.pool)
+            response = dns.message.from_wire(response)
+            self.assertEqual(response.id, 0)
+            self.assertEqual(len(response.answer[0]), 2)
+        self.assertDictContainsSubset(
+            {'truncated': 3, 'tcp_queries': 3, 'tcp_connections': 1},
+            self.stub.stats())
+
+    def test_large_rdtypes_skip_udp(self):
+        resolver_pool.configure(lifetime=1, port=self.stub.port,
+                                tcp_pool=self.pool, tcp_rdtypes=('TXT',))
+        answer = resolver_pool.query(self.stub.host, 'example.com', 'TXT')
+        self.assertEqual(len(answer.rrset), 2)
+        resolver_pool.query(self.stub.host, 'example.com', 'TXT')
+        self.assertDictContainsSubset(
+            {'truncated': 0, 'tcp_queries': 2, 'tcp_connections': 1},
+            self.stub.stats())
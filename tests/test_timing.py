@@ -0,0 +1,65 @@
+import json
+import time
+
+from tests import BaseTest
+
+from mock import patch
+from dns.exception import Timeout
+
+from resolverapi import answer_cache
+from tests.test_util import make_answer, TEST_DOMAIN
+
+
+class ServerTimingTests(BaseTest):
+
+    def setUp(self):
+        super(ServerTimingTests, self).setUp()
+        answer_cache.configure(0)
+
+    def phases(self, response):
+        header = response.headers['Server-Timing']
+        return [entry.split(';')[0] for entry in header.split(', ')]
+
+    def test_lookup_phases(self):
+        with patch('resolverapi.endpoints.resolver_pool.query') as query:
+            query.side_effect = [Timeout(), make_answer('A', answers=['10.0.0.1'])]
+            r = self.test_client.get('/A/%s' % TEST_DOMAIN)
+
+        self.assert200(r.status_code)
+        self.assertEqual(self.phases(r), [
+            'validate', 'cache', 'cache', 'upstream', 'upstream', 'serialize',
+            'encode', 'total'])
+        self.assertIn('upstream;dur=', r.headers['Server-Timing'])
+        self.assertIn(';desc="208.67.220.220"', r.headers['Server-Timing'])
+
+    def test_validation_failure_is_timed(self):
+        r = self.test_client.get('/NA/%s' % TEST_DOMAIN)
+        self.assert400(r.status_code)
+        self.assertEqual(self.phases(r), ['validate', 'total'])
+
+    def test_disabled(self):
+        self.app.config['SERVER_TIMING'] = False
+        r = self.test_client.get('/')
+        self.assertNotIn('Server-Timing', r.headers)
+
+    def test_slow_request_logs_hot_stacks(self):
+        self.app.config['PROFILE_SAMPLE_RATE'] = 1.0
+        self.app.config['PROFILE_INTERVAL'] = 0.001
+        self.app.config['PROFILE_SLOW_THRESHOLD'] = 0.05
+
+        def slow_query(nameserver, qname, rdtype, lifetime=None):
+            time.sleep(0.1)
+            return make_answer('A', answers=['10.0.0.1'])
+
+        with patch('resolverapi.endpoints.resolver_pool.query') as query, \
+                patch.object(self.app.logger, 'info') as info:
+            query.side_effect = slow_query
+            self.test_client.get('/A/%s' % TEST_DOMAIN)
+
+        logs = [json.loads(call[0][1]) for call in info.call_args_list
+                if call[0][0] == 'timing %s']
+        self.assertEqual(len(logs), 1)
+        self.assertEqual(logs[0]['status'], 200)
+        self.assertGreater(logs[0]['samples'], 10)
+        self.assertTrue(any('slow_query' in frame
+                            for frame in logs[0]['hot_stacks'][0]['stack']))
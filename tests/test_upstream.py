@@ -0,0 +1,292 @@
+import time
+
+from tests import BaseTest
+
+import dns.query
+from mock import patch
+from dns.exception import Timeout
+from dns.resolver import NoNameservers
+
+from bench.stub import StubNameserver
+from resolverapi import answer_cache, single_flight
+from resolverapi.util.upstream import LatencyWindow, ResolverPool, executor
+from tests.test_util import make_answer, TEST_DOMAIN
+
+
+def fake_query(delays):
+    """Stand-in for ResolverPool.query that answers after a per-nameserver
+    delay, or raises Timeout when the delay is None."""
+    def query(pool, nameserver, *args, **kwargs):
+        delay = delays[nameserver]
+        if delay is None:
+            raise Timeout
+        time.sleep(delay)
+        return make_answer('A', answers=['10.0.0.1'])
+    return query
+
+
+@patch('resolverapi.util.upstream.ResolverPool.query', autospec=True)
+class HedgedQueryTests(BaseTest):
+
+    def setUp(self):
+        super(HedgedQueryTests, self).setUp()
+        self.app.config['RESOLVERS'] = ['1.1.1.1', '2.2.2.2']
+        self.app.config['HEDGE_DELAY'] = 0.05
+        answer_cache.configure(0)
+
+    def test_slow_primary_is_hedged(self, query):
+        query.side_effect = fake_query({'1.1.1.1': 1.0, '2.2.2.2': 0})
+
+        t1 = time.time()
+        resp, code = self.get('A/%s' % TEST_DOMAIN)
+        self.assert200(code)
+        self.assertLess(time.time() - t1, 1.0)
+        self.assertEqual(resp['Query']['Server'], '2.2.2.2')
+
+    def test_fast_primary_is_not_hedged(self, query):
+        query.side_effect = fake_query({'1.1.1.1': 0, '2.2.2.2': 0})
+
+        resp, code = self.get('A/%s' % TEST_DOMAIN)
+        self.assert200(code)
+        self.assertEqual(resp['Query']['Server'], '1.1.1.1')
+        self.assertEqual(query.call_count, 1)
+
+    def test_timeout_moves_on_immediately(self, query):
+        self.app.config['HEDGE_DELAY'] = 5
+        query.side_effect = fake_query({'1.1.1.1': None, '2.2.2.2': 0})
+
+        t1 = time.time()
+        resp, code = self.get('A/%s' % TEST_DOMAIN)
+        self.assert200(code)
+        self.assertLess(time.time() - t1, 5)
+        self.assertEqual(resp['Query']['Server'], '2.2.2.2')
+
+    def test_all_timed_out(self, query):
+        query.side_effect = fake_query({'1.1.1.1': None, '2.2.2.2': None})
+
+        resp, code = self.get('A/%s' % TEST_DOMAIN)
+        self.assert503(code)
+        self.assertEqual(query.call_count, 2)
+
+
+class LatencyWindowTests(BaseTest):
+
+    def test_percentile(self):
+        window = LatencyWindow(size=100)
+        self.assertIsNone(window.percentile(95))
+        for i in range(200):
+            window.add(i / 1000.0)
+        self.assertEqual(len(window), 100)
+        self.assertAlmostEqual(window.percentile(95), 0.195)
+
+
+class ResolverPoolTests(BaseTest):
+
+    def test_one_resolver_per_nameserver(self):
+        pool = ResolverPool()
+        pool.configure(lifetime=1.5, port=5353)
+        first, second = pool.get('1.1.1.1'), pool.get('2.2.2.2')
+        self.assertIs(pool.get('1.1.1.1'), first)
+        self.assertEqual(first.nameservers, ['1.1.1.1'])
+        self.assertEqual(second.nameservers, ['2.2.2.2'])
+        self.assertEqual(first.lifetime, 1.5)
+        self.assertEqual(first.port, 5353)
+
+    @patch('dns.resolver.Resolver.query', autospec=True)
+    def test_concurrent_lookups_keep_their_nameserver(self, query):
+        def answer(resolver, qname, *args, **kwargs):
+            time.sleep(0.01)
+            return resolver.nameservers[0], str(qname)
+        query.side_effect = answer
+
+        pool = ResolverPool()
+        nameservers = ['%d.%d.%d.%d' % ((i,) * 4) for i in range(1, 9)]
+        results = list(executor.map(
+            lambda ns: (ns, pool.query(ns, ns + '.example.', 'A')),
+            nameservers))
+        for nameserver, (answered_by, qname) in results:
+            self.assertEqual(answered_by, nameserver)
+            self.assertEqual(qname, nameserver + '.example.')
+
+
+class AdaptiveTimeoutTests(BaseTest):
+
+    def test_timeout_follows_round_trip_times(self):
+        pool = ResolverPool()
+        pool.configure(timeout=2.0, adaptive=True, min_timeout=0.05)
+        self.assertEqual(pool.get('1.1.1.1').timeout, 2.0)
+
+        for _ in range(20):
+            pool.record_rtt('1.1.1.1', 0.1)
+        self.assertAlmostEqual(pool.timeout_for('1.1.1.1'), 0.2)
+        self.assertAlmostEqual(pool.get('1.1.1.1').timeout, 0.2)
+        self.assertEqual(pool.timeout_for('2.2.2.2'), 2.0)
+
+        for _ in range(200):
+            pool.record_rtt('1.1.1.1', 0.001)
+        self.assertEqual(pool.timeout_for('1.1.1.1'), 0.05)
+        for _ in range(200):
+            pool.record_rtt('1.1.1.1', 5)
+        self.assertEqual(pool.timeout_for('1.1.1.1'), 2.0)
+
+    def test_fixed_timeout(self):
+        pool = ResolverPool()
+        pool.configure(timeout=2.0)
+        for _ in range(20):
+            pool.record_rtt('1.1.1.1', 0.1)
+        self.assertEqual(pool.timeout_for('1.1.1.1'), 2.0)
+
+
+class EdnsTests(BaseTest):
+
+    def setUp(self):
+        super(EdnsTests, self).setUp()
+        self.stub = StubNameserver()
+        self.addCleanup(self.stub.close)
+        self.pool = ResolverPool()
+
+    def configure(self, lifetime=0.05, **kwargs):
+        self.pool.configure(lifetime=lifetime, timeout=0.05,
+                            port=self.stub.port, **kwargs)
+
+    def query(self, rdtype='A'):
+        return self.pool.query(self.stub.host, TEST_DOMAIN, rdtype)
+
+    def time_out(self, times):
+        self.stub.loss = 1.0
+        for _ in range(times):
+            self.assertRaises(Timeout, self.query)
+        self.stub.loss = 0.0
+
+    def test_payload_is_advertised(self):
+        self.configure(edns_payload=1232)
+        with patch('dns.query.udp', wraps=dns.query.udp) as udp:
+            self.query()
+        self.assertEqual(udp.call_args[0][0].edns, 0)
+        self.assertEqual(udp.call_args[0][0].payload, 1232)
+        self.configure(edns_payload=0)
+        self.assertEqual(self.pool.get(self.stub.host).edns, -1)
+
+    def test_repeated_timeouts_fall_back(self):
+        self.configure(edns_payload=4096)
+        self.query()
+        for payload in (4096, 4096, 1232):
+            self.time_out(1)
+            self.assertEqual(self.pool.payload_for(self.stub.host), payload)
+        self.time_out(3)
+        self.assertEqual(self.pool.payload_for(self.stub.host), 512)
+        self.time_out(3)
+        self.assertEqual(self.pool.payload_for(self.stub.host), 512)
+        stats = self.pool.edns_stats(self.stub.host)
+        self.assertEqual(stats['Queries'], 10)
+        self.assertEqual(stats['Fallbacks'], 2)
+        self.assertEqual(stats['FallbackRate'], 0.2)
+
+    def test_large_answer_resets_timeouts(self):
+        self.configure(edns_payload=4096)
+        self.stub.answers, self.stub.txt_size = 8, 255
+        self.query()
+        self.time_out(2)
+        self.query('TXT')
+        self.time_out(2)
+        self.assertEqual(self.pool.payload_for(self.stub.host), 4096)
+
+    def test_small_answers_keep_timeouts(self):
+        # Large responses are lost while small ones get through
+        self.stub.fragment_limit = 1300
+        self.stub.answers, self.stub.txt_size = 8, 255
+        self.configure(lifetime=0.3, edns_payload=4096)
+        for _ in range(3):
+            self.assertEqual(len(self.query().rrset), 8)
+            # Answered by the retransmit advertising 1232, over TCP
+            self.assertEqual(len(self.query('TXT').rrset), 8)
+        self.assertEqual(self.pool.payload_for(self.stub.host), 1232)
+        self.assertEqual(self.stub.tcp_queries, 3)
+        stats = self.pool.edns_stats(self.stub.host)
+        self.assertEqual(stats['Fallbacks'], 1)
+        self.assertEqual(stats['Truncated'], 3)
+
+    def test_unreachable_nameserver_keeps_payload(self):
+        self.configure(edns_payload=1232)
+        self.time_out(5)
+        self.assertEqual(self.pool.payload_for(self.stub.host), 1232)
+        self.assertEqual(self.pool.edns_stats(self.stub.host)['Fallbacks'],
+                         0)
+
+    def test_full_payload_is_retried(self):
+        self.configure(edns_payload=1232, edns_retry=60)
+        self.pool.payloads[self.stub.host] = (512, time.time())
+        self.assertEqual(self.pool.payload_for(self.stub.host), 512)
+        self.pool.payloads[self.stub.host] = (512, time.time() - 60)
+        self.assertEqual(self.pool.payload_for(self.stub.host), 1232)
+
+    def test_truncated_answers_are_counted(self):
+        self.configure(edns_payload=512)
+        self.stub.truncate = 1.0
+        answer = self.query('TXT')
+        self.assertEqual(len(answer.rrset), 1)
+        self.assertEqual(self.stub.tcp_queries, 1)
+        self.stub.truncate = 0.0
+        self.query()
+        stats = self.pool.edns_stats(self.stub.host)
+        self.assertEqual(stats['Truncated'], 1)
+        self.assertEqual(stats['TruncationRate'], 0.5)
+
+    def test_error_response(self):
+        self.configure(edns_payload=1232)
+        with patch('dns.query.udp', side_effect=ConnectionRefusedError):
+            self.assertRaises(NoNameservers, self.query)
+
+
+@patch('resolverapi.endpoints.resolver_pool.query')
+class ClientTimeoutTests(BaseTest):
+
+    def setUp(self):
+        super(ClientTimeoutTests, self).setUp()
+        self.app.config['RESOLVERS'] = ['1.1.1.1', '2.2.2.2']
+        self.app.config['HEALTH_TRACKING'] = False
+        answer_cache.configure(0)
+
+    def test_timeout_is_shared_between_nameservers(self, query):
+        # Only a query that is not shared with other clients stops at the
+        # client's deadline
+        single_flight.configure(False)
+        lifetimes = []
+
+        def primary_down(nameserver, qname, rdtype, lifetime=None):
+            lifetimes.append(lifetime)
+            if nameserver == '1.1.1.1':
+                time.sleep(lifetime)
+                raise Timeout
+            return make_answer('A', answers=['10.0.0.1'])
+        query.side_effect = primary_down
+
+        resp, code = self.get('A/%s' % TEST_DOMAIN, '?timeout=0.4')
+        self.assert200(code)
+        self.assertTrue(0.15 < lifetimes[0] <= 0.2)
+        self.assertTrue(0.15 < lifetimes[1] <= 0.2)
+
+    def test_shared_query_runs_for_full_lifetime(self, query):
+        query.return_value = make_answer('A', answers=['10.0.0.1'])
+        resp, code = self.get('A/%s' % TEST_DOMAIN, '?timeout=0.4')
+        self.assert200(code)
+        self.assertEqual(query.call_args[0][3], 3.0)
+
+    def test_timeout_header_never_extends_lifetime(self, query):
+        query.return_value = make_answer('A', answers=['10.0.0.1'])
+        self.test_client.get('/A/%s' % TEST_DOMAIN,
+                             headers={'X-Timeout': '10'})
+        self.assertEqual(query.call_args[0][3], 3.0)
+
+    def test_expired_before_upstream(self, query):
+        r = self.test_client.get(
+            '/A/%s?timeout=0.5' % TEST_DOMAIN,
+            headers={'X-Request-Start': 't=%.3f' % (time.time() - 0.8)})
+        self.assert503(r.status_code)
+        self.assertFalse(query.called)
+
+    def test_invalid_timeout(self, query):
+        for value in ('soon', '0', '-1', 'inf'):
+            resp, code = self.get('A/%s' % TEST_DOMAIN, '?timeout=%s' % value)
+            self.assert400(code)
+        self.assertFalse(query.called)
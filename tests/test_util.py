@@ -1,9 +1,10 @@
 from tests import BaseTest
 
-from mock import patch
+from mock import patch, Mock
 import dns
+import json
 
-from resolverapi.util.dns_query import parse_query
+from resolverapi.util.dns_query import parse_query, EncodedResponse
 
 
 TEST_DOMAIN = 'testdomain.com.'
@@ -42,7 +43,7 @@ def make_answer(rdtype, answers=None, additionals=None, authorities=None):
     return answer
 
 
-@patch('resolverapi.endpoints.dns_resolver.query')
+@patch('resolverapi.endpoints.resolver_pool.query')
 class ParseQueryTests(BaseTest):
 
     def setUp(self):
@@ -221,14 +222,16 @@ class ParseQueryTests(BaseTest):
             ],
         }, resp)
 
-    @patch('resolverapi.endpoints.parse_query')
-    def test_query_section(self, parse_query_mock, query, rdtype='A'):
+    @patch('resolverapi.endpoints.EncodedResponse')
+    def test_query_section(self, encoded_mock, query, rdtype='A'):
         query.return_value = make_answer(rdtype)
 
-        def mod_parse_query(answer, *args, **kwargs):
+        def mod_encoded(answer, *args, **kwargs):
             # replace the nameserver and duration
-            return parse_query(answer, '1.1.1.1', 1)
-        parse_query_mock.side_effect = mod_parse_query
+            encoded = EncodedResponse(answer, '1.1.1.1')
+            return Mock(render=lambda *args: encoded.render(1),
+                        etag=encoded.etag)
+        encoded_mock.side_effect = mod_encoded
 
         resp, code = self.lookup(rdtype)
         self.assert200(code)
@@ -238,3 +241,29 @@ class ParseQueryTests(BaseTest):
                 'Duration': 1
             }
         }, resp)
+
+
+class EncodedResponseTests(BaseTest):
+
+    def test_render_matches_parse_query(self):
+        answer = make_answer(
+            'MX', answers=['10 mail.%s' % TEST_DOMAIN, '20 mx.%s' % TEST_DOMAIN],
+            authorities=['5 ns.%s' % TEST_DOMAIN])
+        encoded = EncodedResponse(answer, '1.1.1.1')
+
+        for args in [(0.5,), (0.25, 10), (0.25, 90), (0.1, 0, 30)]:
+            self.assertEqual(json.loads(encoded.render(*args).decode('utf-8')),
+                             parse_query(answer, '1.1.1.1', *args))
+
+    def test_cache_hit_reuses_encoding(self):
+        with patch('resolverapi.endpoints.resolver_pool.query') as query:
+            query.return_value = make_answer('A', answers=['10.0.0.1'])
+            self.get('A/%s' % TEST_DOMAIN)
+            with patch('resolverapi.endpoints.EncodedResponse') as encoded:
+                encoded.return_value.render.return_value = b'{}'
+                encoded.return_value.size.return_value = 100
+                self.get('A/%s' % TEST_DOMAIN)
+                self.get('A/%s' % TEST_DOMAIN)
+
+        self.assertEqual(encoded.call_count, 1)
+        self.assertEqual(encoded.return_value.render.call_count, 2)